@@ -0,0 +1,705 @@
+# -*- coding: utf-8 -*-
+# Benchmark du bridge contre un faux ComfyUI local (fake_comfyui.py).
+#
+#   python bench_bridge.py --clients 200 --jobs-per-client 2
+#
+# Lance le faux ComfyUI et le bridge (uvicorn) en sous-processus, puis
+# mesure la latence de /generate et /result sous N clients concurrents.
+#
+#   python bench_bridge.py --backends 3 --sdxl-share 0.5
+#
+# Avec --backends N, N faux ComfyUI sont lancés ; le premier ne possède pas
+# le checkpoint SDXL, ce qui permet de vérifier le routage par checkpoint.
+#
+#   python bench_bridge.py --mode ws --download --output avant.json
+#   python bench_bridge.py --mode ws --download --baseline avant.json --max-regression 0.1
+#
+# --mode ws suit chaque job sur /ws/progress/{id} au lieu de sonder /result.
+# Le rapport JSON (--json / --output) ajoute le retard de la boucle asyncio du
+# bridge (/metrics + sonde HTTP) et sa mémoire résidente ; --baseline compare
+# deux rapports (code de sortie 1 si une métrique régresse au-delà du seuil).
+#
+#   python bench_bridge.py --mode ws --workers 4
+#
+# --workers N lance uvicorn avec N process (BRIDGE_STATE_BACKEND=sqlite) ; la
+# mémoire résidente est alors la somme des workers. /metrics ne décrit qu'un worker.
+#
+#   python bench_bridge.py --mode ws --preview --preview-every 1
+#
+# --preview demande les previews latentes (frames binaires) sur /ws/progress et les compte.
+#
+#   python bench_bridge.py --runway --mode ws --download --clients 20
+#   python bench_bridge.py --runway-check
+#
+# --runway envoie les jobs sur le workflow Runway, contre un faux Runway local (fake_runway.py).
+# --runway-check déroule des vérifications : vidéo produite et téléchargeable, tâche FAILED,
+# annulation, clé manquante (code de sortie 1 si l'une échoue).
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import platform
+import subprocess
+
+import httpx
+import websockets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SD15_CHECKPOINT = "v1-5-pruned-emaonly-fp16.safetensors"
+SDXL_CHECKPOINT = "sd_xl_base_1.0.safetensors"
+
+RUNWAY_WORKFLOW = "runwayml_i2v_gen4.json"
+# Reconnu par fake_runway.py : la tâche passe en FAILED
+RUNWAY_FAIL_MARKER = "[fake:fail]"
+JOB_FINAL_STATES = ("completed", "failed", "cancelled")
+
+BENCH_WORKFLOW = {
+    "prompt": {
+        "3": {"class_type": "KSampler", "inputs": {
+            "seed": "{{seed}}", "steps": "{{steps}}", "cfg": "{{cfg_scale}}", "sampler_name": "{{sampler}}",
+            "scheduler": "normal", "denoise": 1, "model": ["4", 0], "positive": ["6", 0],
+            "negative": ["7", 0], "latent_image": ["5", 0]}},
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "{{checkpoint}}"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": "{{width}}", "height": "{{height}}", "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{prompt}}", "clip": ["4", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{negative_prompt}}", "clip": ["4", 1]}},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]}},
+    }
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+TERMINAL_MESSAGES = ("output", "error", "final_result")
+
+# (nom, chemin dans le rapport, plus grand = meilleur)
+COMPARE_METRICS = [
+    ("throughput_jobs_s", ("throughput_jobs_s",), True),
+    ("generate_p99_ms", ("generate", "p99_ms"), False),
+    ("e2e_p50_ms", ("e2e", "p50_ms"), False),
+    ("e2e_p99_ms", ("e2e", "p99_ms"), False),
+    ("loop_lag_p99_ms", ("loop_lag", "bridge", "p99_ms"), False),
+    ("probe_p99_ms", ("loop_lag", "probe", "p99_ms"), False),
+    ("rss_peak_mb", ("rss_mb", "peak"), False),
+]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "mean_ms": round(statistics.mean(values) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+async def wait_http(url, timeout=20):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.monotonic() < deadline:
+            try:
+                await c.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} ne répond pas")
+
+
+def start_fake_comfy(port, args, extra_env=None):
+    env = dict(os.environ, **(extra_env or {}))
+    cmd = [sys.executable, os.path.join(HERE, "fake_comfyui.py"), "--port", str(port),
+           "--latency", str(args.comfy_latency), "--job-duration", str(args.job_duration),
+           "--steps", str(args.steps), "--parallel", str(args.comfy_parallel),
+           "--failure-rate", str(args.failure_rate), "--reject-rate", str(args.reject_rate),
+           "--preview-every", str(args.preview_every)]
+    return subprocess.Popen(cmd, env=env)
+
+
+def start_fake_runway(port, args):
+    cmd = [sys.executable, os.path.join(HERE, "fake_runway.py"), "--port", str(port),
+           "--pending-duration", "0.2", "--task-duration", str(args.runway_duration),
+           "--failure-rate", str(args.failure_rate), "--concurrency", str(args.runway_concurrency),
+           "--video-size", str(args.runway_video_size)]
+    return subprocess.Popen(cmd)
+
+
+def start_bridge(port, comfy_urls, workflows_dir, args, extra_env=None):
+    # État du bridge (journal, caches, galerie) isolé dans le dossier temporaire du benchmark
+    env = dict(os.environ, COMFYUI_URL=comfy_urls[0], COMFYUI_BACKENDS=",".join(comfy_urls),
+               BRIDGE_WORKFLOWS_DIR=workflows_dir, BACKEND_POLL_INTERVAL="0.5",
+               BRIDGE_MAX_INFLIGHT_JOBS=str(args.comfy_parallel),
+               RESULT_STORE_DIR=os.path.join(workflows_dir, "results"),
+               BRIDGE_OUTPUT_CACHE_DIR=os.path.join(workflows_dir, "output_cache"),
+               BRIDGE_JOURNAL_DIR=os.path.join(workflows_dir, "journal"),
+               BRIDGE_GALLERY_DIRS=f"none={os.path.join(workflows_dir, 'none')}",
+               BRIDGE_GALLERY_CACHE_DIR=os.path.join(workflows_dir, "gallery"),
+               BRIDGE_WARMUP_COUNT="0", **(extra_env or {}))
+    cmd = [sys.executable, "-m", "uvicorn", "bridge_api:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning", "--timeout-keep-alive", "60"]
+    if args.workers > 1:
+        # Plusieurs process : progression et résultats passent par l'état partagé SQLite
+        env["BRIDGE_STATE_BACKEND"] = "sqlite"
+        cmd += ["--workers", str(args.workers)]
+    return subprocess.Popen(cmd, cwd=args.bridge_dir, env=env)
+
+
+async def follow_ws(ws_url, prompt_id, lat, preview=False):
+    # Suivi du job sur /ws/progress : délai du premier évènement, nombre de messages, message final
+    t0 = time.perf_counter()
+    first = True
+    query = "?preview=1" if preview else ""
+    async with websockets.connect(f"{ws_url}/ws/progress/{prompt_id}{query}", max_size=None) as ws:
+        async for raw in ws:
+            if first:
+                lat["ws_first_event"].append(time.perf_counter() - t0)
+                first = False
+            if isinstance(raw, bytes):
+                lat["ws_previews"] += 1
+                lat["ws_preview_bytes"] += len(raw)
+                continue
+            lat["ws_messages"] += 1
+            msg = json.loads(raw)
+            if msg.get("type") in TERMINAL_MESSAGES:
+                return msg
+    return None
+
+
+async def poll_result(client, prompt_id, args, lat):
+    deadline = time.monotonic() + args.job_timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(args.poll_interval)
+        t0 = time.perf_counter()
+        r = await client.get(f"/result/{prompt_id}")
+        dt = time.perf_counter() - t0
+        if r.status_code == 200:
+            lat["result"].append(dt)
+            return r.json()
+        if r.status_code == 500:
+            # Job en échec côté ComfyUI : /result renvoie l'erreur
+            return {"type": "error", "detail": r.json().get("detail")}
+        lat["result_pending"].append(dt)
+    return None
+
+
+def generate_form(idx, j, args):
+    if args.runway:
+        # Le faux Runway n'ouvre pas l'image : un nom quelconque suffit
+        return RUNWAY_WORKFLOW, {"prompt": f"bench {idx}-{j}", "seed": str(idx * 1000 + j),
+                                 "input_image_path": "bench.png", "runway_api_key": f"bench-{idx}"}
+    sdxl = (idx * args.jobs_per_client + j) % 100 < args.sdxl_share * 100
+    return "bench_t2i.json", {"prompt": f"bench {idx}-{j}", "seed": str(idx * 1000 + j),
+                              "checkpoint": SDXL_CHECKPOINT if sdxl else SD15_CHECKPOINT}
+
+
+async def client_loop(client, ws_url, idx, args, lat):
+    for j in range(args.jobs_per_client):
+        try:
+            t_start = t0 = time.perf_counter()
+            # Une clé par client simulé : la file équitable du bridge les traite comme des utilisateurs distincts
+            workflow_name, form = generate_form(idx, j, args)
+            r = await client.post("/generate", params={"workflow_name": workflow_name}, data=form,
+                                  headers={"X-API-Key": f"bench-{idx}"})
+            lat["generate"].append(time.perf_counter() - t0)
+            if r.status_code != 200:
+                lat["errors"] += 1
+                continue
+            prompt_id = r.json()["prompt_id"]
+
+            if args.mode == "ws":
+                final = await asyncio.wait_for(follow_ws(ws_url, prompt_id, lat, args.preview), args.job_timeout)
+                if final is not None and final.get("type") == "output":
+                    t0 = time.perf_counter()
+                    r = await client.get(f"/result/{prompt_id}")
+                    lat["result"].append(time.perf_counter() - t0)
+            else:
+                final = await poll_result(client, prompt_id, args, lat)
+
+            if final is None:
+                lat["errors"] += 1
+                continue
+            if final.get("type") != "output":
+                lat["failed"] += 1
+                continue
+            if final.get("source") == "local":
+                # Vidéos Runway : écrites dans images/ du bridge, supprimées en fin de benchmark
+                lat["local_files"].append(final["filename"])
+
+            if args.download:
+                t0 = time.perf_counter()
+                r = await client.get(final["url"])
+                r.raise_for_status()
+                lat["download"].append(time.perf_counter() - t0)
+                lat["download_bytes"] += len(r.content)
+            lat["e2e"].append(time.perf_counter() - t_start)
+            lat["completed"] += 1
+        except (httpx.HTTPError, websockets.WebSocketException, OSError, asyncio.TimeoutError):
+            lat["errors"] += 1
+
+
+async def count_checkpoint_jobs(comfy_url, checkpoint):
+    # Nombre de jobs exécutés sur ce backend qui utilisent le checkpoint donné
+    async with httpx.AsyncClient() as c:
+        history = (await c.get(f"{comfy_url}/history", params={"max_items": 100000})).json()
+    count = 0
+    for item in history.values():
+        graph = item["prompt"][2]
+        count += any(n.get("inputs", {}).get("ckpt_name") == checkpoint for n in graph.values())
+    return count
+
+# ---------------------------------------------------------------------
+# RETARD DE LA BOUCLE + MÉMOIRE DU BRIDGE
+# ---------------------------------------------------------------------
+
+def parse_histogram(text, name):
+    # Buckets cumulés {borne: nombre} d'un histogramme /metrics (série unique)
+    buckets = {}
+    for line in text.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float("inf") if le == "+Inf" else float(le)] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith(f"{name}_sum"):
+            buckets["sum"] = float(line.rsplit(" ", 1)[1])
+    return buckets
+
+
+def histogram_delta(before, after):
+    # Percentiles par borne supérieure de bucket, sur les observations faites pendant la charge
+    if not after:
+        return None
+    bounds = sorted(k for k in after if k != "sum")
+    cumulative = [after[b] - before.get(b, 0) for b in bounds]
+    count = cumulative[-1] if cumulative else 0
+    if not count:
+        return {"count": 0}
+
+    def upper(p):
+        for bound, c in zip(bounds, cumulative):
+            if c >= count * p / 100.0:
+                return None if bound == float("inf") else round(bound * 1000, 2)
+
+    return {
+        "count": int(count),
+        "mean_ms": round((after.get("sum", 0) - before.get("sum", 0)) / count * 1000, 3),
+        "p50_ms": upper(50),
+        "p99_ms": upper(99),
+    }
+
+
+async def scrape_lag(client):
+    try:
+        r = await client.get("/metrics")
+        return parse_histogram(r.text, "bridge_event_loop_lag_seconds") if r.status_code == 200 else {}
+    except httpx.HTTPError:
+        return {}
+
+
+def read_rss_mb(pid):
+    # Process et ses enfants (workers uvicorn avec --workers)
+    total = None
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total = int(line.split()[1]) / 1024.0
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            for child in f.read().split():
+                total += read_rss_mb(int(child)) or 0.0
+    except (OSError, ValueError, TypeError):
+        pass
+    return total
+
+
+async def probe_loop(client, interval, samples, stop):
+    # Requête triviale à intervalle fixe : sa latence suit le retard de la boucle sous charge
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        try:
+            await client.get("/")
+            samples.append(time.perf_counter() - t0)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def rss_loop(pid, samples, stop):
+    while not stop.is_set():
+        rss = read_rss_mb(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(0.25)
+
+
+def git_commit(path):
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# ---------------------------------------------------------------------
+# BENCHMARK
+# ---------------------------------------------------------------------
+
+async def run_bench(args):
+    workflows_dir = tempfile.mkdtemp(prefix="bench_wf_")
+    with open(os.path.join(workflows_dir, "bench_t2i.json"), "w", encoding="utf-8") as f:
+        json.dump(BENCH_WORKFLOW, f)
+
+    comfy_urls = [f"http://127.0.0.1:{args.comfy_port + i}" for i in range(args.backends)]
+    bridge_url = f"http://127.0.0.1:{args.bridge_port}"
+    procs = []
+    local_files = []
+    try:
+        bridge = await start_stack(args, comfy_urls, workflows_dir, procs)
+
+        lat = {"local_files": local_files, "generate": [], "result": [], "result_pending": [], "e2e": [], "download": [], "ws_first_event": [],
+               "ws_messages": 0, "ws_previews": 0, "ws_preview_bytes": 0, "download_bytes": 0, "completed": 0, "failed": 0, "errors": 0}
+        limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+        async with httpx.AsyncClient(base_url=bridge_url, limits=limits, timeout=args.job_timeout) as client, \
+                httpx.AsyncClient(base_url=bridge_url, timeout=args.job_timeout) as probe:
+            # Référence au repos, puis mesures pendant toute la charge
+            idle = []
+            for _ in range(20):
+                t0 = time.perf_counter()
+                await probe.get("/")
+                idle.append(time.perf_counter() - t0)
+            lag_before = await scrape_lag(probe)
+            rss_start = read_rss_mb(bridge.pid)
+            probe_samples, rss_samples, stop = [], [], asyncio.Event()
+            monitors = [asyncio.create_task(probe_loop(probe, args.probe_interval, probe_samples, stop)),
+                        asyncio.create_task(rss_loop(bridge.pid, rss_samples, stop))]
+
+            t0 = time.perf_counter()
+            ws_url = bridge_url.replace("http", "ws", 1)
+            await asyncio.gather(*(client_loop(client, ws_url, i, args, lat) for i in range(args.clients)))
+            elapsed = time.perf_counter() - t0
+
+            stop.set()
+            await asyncio.gather(*monitors)
+            lag_after = await scrape_lag(probe)
+            rss_end = read_rss_mb(bridge.pid)
+            backends = (await client.get("/backends")).json().get("backends", []) if args.backends > 1 else []
+
+        routing = {}
+        if args.backends > 1:
+            routing = {"dispatched": {b["name"]: b["dispatched"] for b in backends},
+                       "sdxl_on_sd15_only_backend": await count_checkpoint_jobs(comfy_urls[0], SDXL_CHECKPOINT)}
+
+        return {
+            "mode": args.mode,
+            "clients": args.clients,
+            "jobs": args.clients * args.jobs_per_client,
+            "completed": lat["completed"],
+            "failed": lat["failed"],
+            "errors": lat["errors"],
+            "elapsed_s": round(elapsed, 3),
+            "throughput_jobs_s": round(lat["completed"] / elapsed, 2) if elapsed else None,
+            "generate": summarize(lat["generate"]),
+            "result": summarize(lat["result"]),
+            "result_pending": summarize(lat["result_pending"]),
+            "e2e": summarize(lat["e2e"]),
+            "ws_first_event": summarize(lat["ws_first_event"]),
+            "ws_messages": lat["ws_messages"],
+            "ws_previews": {"frames": lat["ws_previews"], "bytes": lat["ws_preview_bytes"]},
+            "download": dict(summarize(lat["download"]), bytes=lat["download_bytes"]),
+            "loop_lag": {
+                "bridge": histogram_delta(lag_before, lag_after),
+                "probe": dict(summarize(probe_samples), idle_p50_ms=summarize(idle)["p50_ms"]),
+            },
+            "rss_mb": {
+                "start": round(rss_start, 1) if rss_start else None,
+                "peak": round(max(rss_samples), 1) if rss_samples else None,
+                "end": round(rss_end, 1) if rss_end else None,
+            },
+            "routing": routing,
+            "meta": {
+                "commit": git_commit(args.bridge_dir),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "args": {k: v for k, v in vars(args).items() if k not in ("baseline", "current", "output")},
+            },
+        }
+    finally:
+        stop_stack(procs, workflows_dir, args, local_files)
+
+
+async def start_stack(args, comfy_urls, workflows_dir, procs):
+    # Faux ComfyUI (+ faux Runway), puis le bridge ; renvoie le process du bridge
+    for i in range(args.backends):
+        # Le premier backend n'a pas le checkpoint SDXL (multi-backend uniquement)
+        env = {"FAKE_COMFY_CHECKPOINTS": SD15_CHECKPOINT} if i == 0 and args.backends > 1 else {}
+        procs.append(start_fake_comfy(args.comfy_port + i, args, env))
+    for url in comfy_urls:
+        await wait_http(f"{url}/queue")
+    extra_env = {}
+    if args.runway or args.runway_check:
+        procs.append(start_fake_runway(args.runway_port, args))
+        await wait_http(f"http://127.0.0.1:{args.runway_port}/stats")
+        extra_env["RUNWAY_API_BASE"] = f"http://127.0.0.1:{args.runway_port}/v1"
+    bridge = start_bridge(args.bridge_port, comfy_urls, workflows_dir, args, extra_env)
+    procs.append(bridge)
+    await wait_http(f"http://127.0.0.1:{args.bridge_port}/")
+    await asyncio.sleep(1.0)  # premier sondage des backends
+    return bridge
+
+
+def stop_stack(procs, workflows_dir, args, local_files):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        p.wait()
+    shutil.rmtree(workflows_dir, ignore_errors=True)
+    for name in local_files:
+        try:
+            os.remove(os.path.join(args.bridge_dir, "images", name))
+        except OSError:
+            pass
+
+# ---------------------------------------------------------------------
+# VÉRIFICATIONS DU CHEMIN RUNWAY (--runway-check)
+# ---------------------------------------------------------------------
+
+async def wait_job_state(client, prompt_id, timeout):
+    # État final du job dans le journal du bridge (/jobs/{id})
+    deadline = time.monotonic() + timeout
+    state = None
+    while time.monotonic() < deadline:
+        r = await client.get(f"/jobs/{prompt_id}")
+        if r.status_code == 200:
+            state = r.json().get("state")
+            if state in JOB_FINAL_STATES:
+                return state
+        await asyncio.sleep(0.2)
+    return state
+
+
+async def runway_checks(client, args, local_files):
+    checks = []
+
+    def check(name, ok, detail=""):
+        checks.append({"name": name, "ok": bool(ok), "detail": detail})
+
+    async def submit(prompt, **extra):
+        form = dict({"prompt": prompt, "input_image_path": "check.png", "runway_api_key": "check"}, **extra)
+        return await client.post("/generate", params={"workflow_name": RUNWAY_WORKFLOW}, data=form)
+
+    # Tâche SUCCEEDED : job terminé, vidéo complète servie par /result/{id}/file
+    r = await submit("runway check ok")
+    prompt_id = r.json().get("prompt_id") if r.status_code == 200 else None
+    check("submit", prompt_id is not None, f"HTTP {r.status_code}")
+    if prompt_id:
+        state = await wait_job_state(client, prompt_id, args.job_timeout)
+        check("succeeded: état completed", state == "completed", f"état {state}")
+        r = await client.get(f"/result/{prompt_id}")
+        result = r.json() if r.status_code == 200 else {}
+        check("succeeded: /result", result.get("media_type") == "video" and result.get("mime_type") == "video/mp4",
+              f"HTTP {r.status_code} {result.get('mime_type')}")
+        if result.get("filename"):
+            local_files.append(result["filename"])
+        r = await client.get(f"/result/{prompt_id}/file")
+        check("succeeded: téléchargement", r.status_code == 200 and len(r.content) == args.runway_video_size
+              and r.content[4:8] == b"ftyp", f"HTTP {r.status_code}, {len(r.content)} octets")
+
+    # Tâche FAILED : job en échec, erreur Runway remontée par /result
+    r = await submit(f"runway check {RUNWAY_FAIL_MARKER}")
+    prompt_id = r.json().get("prompt_id") if r.status_code == 200 else None
+    if prompt_id:
+        state = await wait_job_state(client, prompt_id, args.job_timeout)
+        check("failed: état failed", state == "failed", f"état {state}")
+        r = await client.get(f"/result/{prompt_id}")
+        detail = str(r.json().get("detail", "")) if r.status_code != 200 else ""
+        check("failed: /result en erreur", r.status_code == 500 and "Simulated generation failure" in detail,
+              f"HTTP {r.status_code} {detail[:120]}")
+        r = await client.get(f"/result/{prompt_id}/file")
+        check("failed: pas de fichier", r.status_code != 200, f"HTTP {r.status_code}")
+    else:
+        check("failed: submit", False, f"HTTP {r.status_code}")
+
+    # Annulation pendant la tâche
+    r = await submit("runway check cancel")
+    prompt_id = r.json().get("prompt_id") if r.status_code == 200 else None
+    if prompt_id:
+        await asyncio.sleep(0.5)
+        r = await client.delete(f"/jobs/{prompt_id}")
+        check("cancel: DELETE", r.status_code == 200, f"HTTP {r.status_code}")
+        state = await wait_job_state(client, prompt_id, args.job_timeout)
+        check("cancel: état cancelled", state == "cancelled", f"état {state}")
+        r = await client.get(f"/result/{prompt_id}")
+        check("cancel: /result 410", r.status_code == 410, f"HTTP {r.status_code}")
+    else:
+        check("cancel: submit", False, f"HTTP {r.status_code}")
+
+    # Requêtes invalides : refusées avant tout appel à Runway
+    r = await client.post("/generate", params={"workflow_name": RUNWAY_WORKFLOW},
+                          data={"prompt": "x", "input_image_path": "check.png"})
+    check("clé manquante: 400", r.status_code == 400, f"HTTP {r.status_code}")
+    r = await client.post("/generate", params={"workflow_name": RUNWAY_WORKFLOW},
+                          data={"prompt": "x", "runway_api_key": "check"})
+    check("image manquante: 400", r.status_code == 400, f"HTTP {r.status_code}")
+    return checks
+
+
+async def run_runway_check(args):
+    workflows_dir = tempfile.mkdtemp(prefix="bench_wf_")
+    procs, local_files = [], []
+    try:
+        await start_stack(args, [f"http://127.0.0.1:{args.comfy_port}"], workflows_dir, procs)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.bridge_port}", timeout=args.job_timeout) as client:
+            checks = await runway_checks(client, args, local_files)
+        return {"mode": "runway-check", "ok": all(c["ok"] for c in checks), "checks": checks}
+    finally:
+        stop_stack(procs, workflows_dir, args, local_files)
+
+# ---------------------------------------------------------------------
+# COMPARAISON ENTRE DEUX RAPPORTS
+# ---------------------------------------------------------------------
+
+def metric_value(report, path):
+    for key in path:
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report if isinstance(report, (int, float)) else None
+
+
+def compare_reports(baseline, current, max_regression):
+    rows, regressions = [], []
+    for name, path, higher_is_better in COMPARE_METRICS:
+        base, cur = metric_value(baseline, path), metric_value(current, path)
+        if base is None or cur is None or base == 0:
+            continue
+        change = (cur - base) / base
+        worse = -change if higher_is_better else change
+        rows.append({"metric": name, "baseline": base, "current": cur, "change": round(change, 4),
+                     "regression": worse > max_regression})
+        if worse > max_regression:
+            regressions.append(name)
+    return {"baseline_commit": baseline.get("meta", {}).get("commit"),
+            "current_commit": current.get("meta", {}).get("commit"),
+            "max_regression": max_regression, "metrics": rows, "regressions": regressions}
+
+
+def print_report(report):
+    print(f"mode={report['mode']} clients={report['clients']} jobs={report['jobs']} completed={report['completed']} "
+          f"failed={report['failed']} errors={report['errors']} elapsed={report['elapsed_s']}s "
+          f"throughput={report['throughput_jobs_s']} jobs/s")
+    for name in ("generate", "result", "result_pending", "e2e", "ws_first_event", "download"):
+        s = report[name]
+        if s["count"]:
+            print(f"  {name:15s} n={s['count']:5d}  p50={s['p50_ms']:8.2f} ms  p99={s['p99_ms']:8.2f} ms  max={s['max_ms']:8.2f} ms")
+    lag = report["loop_lag"]
+    if lag["bridge"] and lag["bridge"].get("count"):
+        b = lag["bridge"]
+        print(f"  loop lag (bridge /metrics) n={b['count']} mean={b['mean_ms']} ms p50<={b['p50_ms']} ms p99<={b['p99_ms']} ms")
+    if lag["probe"]["count"]:
+        p = lag["probe"]
+        print(f"  loop lag (sonde GET /)    p50={p['p50_ms']} ms p99={p['p99_ms']} ms max={p['max_ms']} ms (repos {p['idle_p50_ms']} ms)")
+    previews = report.get("ws_previews") or {}
+    if previews.get("frames"):
+        print(f"  previews ws: {previews['frames']} frames, {previews['bytes']} octets")
+    rss = report["rss_mb"]
+    if rss["peak"]:
+        print(f"  rss bridge: début={rss['start']} Mo  pic={rss['peak']} Mo  fin={rss['end']} Mo")
+    if report["routing"]:
+        print(f"  routing: {report['routing']}")
+
+
+def print_comparison(comparison):
+    print(f"comparaison {comparison['baseline_commit']} -> {comparison['current_commit']} "
+          f"(seuil {comparison['max_regression']:.0%})")
+    for row in comparison["metrics"]:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"  {row['metric']:18s} {row['baseline']:>10} -> {row['current']:>10}  {row['change']:+8.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /generate et /result du bridge")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--jobs-per-client", type=int, default=1)
+    parser.add_argument("--mode", choices=("poll", "ws"), default="poll",
+                        help="suivi des jobs : sondage de /result ou /ws/progress")
+    parser.add_argument("--download", action="store_true", help="télécharge chaque fichier de sortie")
+    parser.add_argument("--comfy-port", type=int, default=8188)
+    parser.add_argument("--bridge-port", type=int, default=8011)
+    parser.add_argument("--workers", type=int, default=1, help="workers uvicorn du bridge (état partagé SQLite au-delà de 1)")
+    parser.add_argument("--backends", type=int, default=1, help="nombre de faux ComfyUI (ports consécutifs)")
+    parser.add_argument("--sdxl-share", type=float, default=0.0, help="part des jobs demandant le checkpoint SDXL")
+    parser.add_argument("--comfy-latency", type=float, default=0.02, help="latence HTTP du faux ComfyUI (s)")
+    parser.add_argument("--comfy-parallel", type=int, default=50, help="jobs simultanés côté faux ComfyUI")
+    parser.add_argument("--job-duration", type=float, default=0.5)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="part des jobs en échec côté faux ComfyUI")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="part des /prompt refusés par le faux ComfyUI")
+    parser.add_argument("--preview-every", type=int, default=5, help="preview binaire tous les N steps (0 = aucune)")
+    parser.add_argument("--preview", action="store_true", help="demande les previews sur /ws/progress (--mode ws)")
+    parser.add_argument("--runway", action="store_true", help="jobs Runway contre un faux Runway local")
+    parser.add_argument("--runway-check", action="store_true", help="vérifie le chemin Runway (succès, FAILED, annulation)")
+    parser.add_argument("--runway-port", type=int, default=8190)
+    parser.add_argument("--runway-duration", type=float, default=1.0, help="durée d'une tâche du faux Runway (s)")
+    parser.add_argument("--runway-concurrency", type=int, default=50, help="tâches RUNNING simultanées par clé")
+    parser.add_argument("--runway-video-size", type=int, default=256 * 1024)
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="période de la sonde de latence (s)")
+    parser.add_argument("--job-timeout", type=float, default=120)
+    parser.add_argument("--bridge-dir", default=HERE, help="dossier contenant bridge_api.py (comparaison entre commits)")
+    parser.add_argument("--json", action="store_true", help="sortie JSON uniquement")
+    parser.add_argument("--output", help="écrit le rapport JSON dans ce fichier")
+    parser.add_argument("--baseline", help="rapport JSON de référence à comparer")
+    parser.add_argument("--current", help="rapport JSON à comparer à --baseline (sans relancer le benchmark)")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="dégradation tolérée par métrique (0.1 = 10 %%)")
+    args = parser.parse_args()
+
+    if args.runway_check:
+        report = asyncio.run(run_runway_check(args))
+        if args.json:
+            print(json.dumps(report))
+        else:
+            for c in report["checks"]:
+                print(f"  {'OK ' if c['ok'] else 'ÉCHEC'} {c['name']:28s} {c['detail']}")
+        sys.exit(0 if report["ok"] else 1)
+
+    if args.current:
+        with open(args.current, "r", encoding="utf-8") as f:
+            report = json.load(f)
+    else:
+        report = asyncio.run(run_bench(args))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            comparison = compare_reports(json.load(f), report, args.max_regression)
+
+    if args.json:
+        print(json.dumps(dict(report, comparison=comparison) if comparison else report))
+    else:
+        if not args.current:
+            print_report(report)
+        if comparison:
+            print_comparison(comparison)
+    if comparison and comparison["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
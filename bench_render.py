@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmark du rendu de workflow : ancien chemin (lecture disque + apply_placeholders)
+# contre le template compilé (cache + slots précalculés).
+#
+#   python bench_render.py --extra-nodes 300 --seconds 3
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+VALUES = {
+    "prompt": "a cinematic photo of a lighthouse at dawn, volumetric light, 35mm",
+    "negative_prompt": "blurry, lowres, watermark",
+    "width": 1024, "height": 1024, "steps": 30, "cfg_scale": 7.0, "cfg": 7.0,
+    "sampler": "dpmpp_2m", "seed": 123456789, "checkpoint": "sd_xl_base_1.0.safetensors",
+    "input_image_path": None, "duration": None, "ratio": None,
+    "base_end_step": 18.0, "refiner_start_step": 18.0, "refiner_end_step": 30.0,
+    "positive_style": "cinematic", "negative_style": "cartoon", "vae_name": "sdxl_vae.safetensors",
+    "sdxl_mode": "base_refiner", "sdxl_quality": "high",
+}
+
+
+def apply_placeholders(obj, values):
+    # Ancien moteur du bridge (parcours récursif de tout le graphe), gardé ici comme référence
+    if isinstance(obj, dict):
+        return {k: apply_placeholders(v, values) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [apply_placeholders(v, values) for v in obj]
+    if isinstance(obj, str):
+        for key, val in values.items():
+            obj = obj.replace("{{"+key+"}}", "" if val is None else str(val))
+        return obj
+    return obj
+
+
+def sdxl_graph(extra_nodes: int) -> dict:
+    g = {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "{{checkpoint}}"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": "{{width}}", "height": "{{height}}", "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{prompt}}, {{positive_style}}", "clip": ["4", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{negative_prompt}}, {{negative_style}}", "clip": ["4", 1]}},
+        "10": {"class_type": "KSamplerAdvanced", "inputs": {
+            "add_noise": "enable", "noise_seed": "{{seed}}", "steps": "{{steps}}", "cfg": "{{cfg_scale}}",
+            "sampler_name": "{{sampler}}", "scheduler": "normal", "start_at_step": 0,
+            "end_at_step": "{{base_end_step}}", "return_with_leftover_noise": "enable",
+            "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["5", 0]}},
+        "12": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_refiner_1.0.safetensors"}},
+        "15": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{prompt}}", "clip": ["12", 1]}},
+        "16": {"class_type": "CLIPTextEncode", "inputs": {"text": "{{negative_prompt}}", "clip": ["12", 1]}},
+        "11": {"class_type": "KSamplerAdvanced", "inputs": {
+            "add_noise": "disable", "noise_seed": "{{seed}}", "steps": "{{steps}}", "cfg": "{{cfg_scale}}",
+            "sampler_name": "{{sampler}}", "scheduler": "normal", "start_at_step": "{{refiner_start_step}}",
+            "end_at_step": "{{refiner_end_step}}", "return_with_leftover_noise": "disable",
+            "model": ["12", 0], "positive": ["15", 0], "negative": ["16", 0], "latent_image": ["10", 0]}},
+        "19": {"class_type": "VAELoader", "inputs": {"vae_name": "{{vae_name}}"}},
+        "17": {"class_type": "VAEDecode", "inputs": {"samples": ["11", 0], "vae": ["19", 0]}},
+        "18": {"class_type": "SaveImage", "inputs": {"filename_prefix": "SDXL_{{sdxl_quality}}", "images": ["17", 0]}},
+    }
+    # Nœuds sans placeholder (LoRA, previews, notes...) : typiques des gros graphes
+    for i in range(extra_nodes):
+        g[str(100 + i)] = {"class_type": "Note", "inputs": {
+            "text": f"node {i} " * 4, "strength_model": 0.8, "strength_clip": 0.8,
+            "links": [["4", 0], ["4", 1]]}, "_meta": {"title": f"Extra {i}"}}
+    return {"prompt": g}
+
+
+def throughput(fn, seconds):
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        fn()
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Débit de rendu des workflows")
+    parser.add_argument("--extra-nodes", type=int, default=300)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    workflows_dir = tempfile.mkdtemp(prefix="bench_render_")
+    os.environ["BRIDGE_WORKFLOWS_DIR"] = workflows_dir
+    import bridge_api as b
+
+    with open(os.path.join(workflows_dir, "sdxl_bench.json"), "w", encoding="utf-8") as f:
+        json.dump(sdxl_graph(args.extra_nodes), f)
+
+    def before():
+        # Ancien chemin de /generate : relecture + parse + parcours récursif de tout le graphe
+        with open(os.path.join(workflows_dir, "sdxl_bench.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return apply_placeholders(data.get("prompt", data), VALUES)
+
+    def after():
+        return b.get_workflow_template("sdxl_bench.json").render(VALUES)
+
+    tpl = b.get_workflow_template("sdxl_bench.json")
+
+    report = {
+        "nodes": len(tpl.graph),
+        "slots": len(tpl.slots),
+        "before_renders_s": round(throughput(before, args.seconds), 1),
+        "before_render_only_s": round(throughput(lambda: apply_placeholders(tpl.graph, VALUES), args.seconds), 1),
+        "after_renders_s": round(throughput(after, args.seconds), 1),
+    }
+    report["speedup"] = round(report["after_renders_s"] / report["before_renders_s"], 1)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"graphe: {report['nodes']} nœuds, {report['slots']} placeholders")
+        print(f"  avant (disque + apply_placeholders) : {report['before_renders_s']:10.1f} rendus/s")
+        print(f"  avant (apply_placeholders seul)     : {report['before_render_only_s']:10.1f} rendus/s")
+        print(f"  après (template compilé)            : {report['after_renders_s']:10.1f} rendus/s  (x{report['speedup']})")
+
+
+if __name__ == "__main__":
+    main()
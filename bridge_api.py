@@ -3,18 +3,35 @@ import os
 import uvicorn
 import json
 import uuid
+import io
+import gzip
 import base64
+import hashlib
+import mimetypes
+import re
 import random
+import time
+import heapq
+import itertools
 import asyncio
+import sqlite3
+import statistics
+import struct
 import traceback
-from typing import Optional, Dict
-
-import requests
+import multiprocessing
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Dict, List
+from urllib.parse import quote, urlencode
+
+import httpx
 import websockets
 
-from fastapi import FastAPI, HTTPException, Form, BackgroundTasks, UploadFile, File, Query
+from fastapi import FastAPI, HTTPException, Form, BackgroundTasks, UploadFile, File, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse, FileResponse, PlainTextResponse
+from pydantic import BaseModel, Field
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 # GPU
@@ -23,19 +40,151 @@ try:
 except ImportError:
     GPU = None
 
+# Verrous des emplacements de worker (fcntl sous Unix, msvcrt sous Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# Traitement d'image (réduction des uploads, variantes de la galerie, post-traitement des sorties),
+# exécuté dans le pool de processus
+try:
+    from PIL import Image, features as pil_features
+except ImportError:
+    Image = None
+from bridge_images import downscale_image, make_gallery_variants, render_variant, render_preview
+
 # ---------------------------------------------------------------------
 # CONFIG
 # ---------------------------------------------------------------------
 
 BRIDGE_VERSION = "BRIDGE_MULTI_WORKFLOW_FINAL_SDXL_V10_FINAL" 
-COMFYUI_HOST = "http://127.0.0.1:8000"
-COMFYUI_WS_URL = "ws://127.0.0.1:8000/ws"
+COMFYUI_HOST = os.environ.get("COMFYUI_URL", "http://127.0.0.1:8000").rstrip("/")
+# Plusieurs ComfyUI : COMFYUI_BACKENDS="http://gpu1:8188,http://gpu2:8188" (défaut : COMFYUI_HOST seul)
+COMFYUI_BACKENDS = [u.strip().rstrip("/") for u in os.environ.get("COMFYUI_BACKENDS", COMFYUI_HOST).split(",") if u.strip()]
+BACKEND_POLL_INTERVAL = float(os.environ.get("BACKEND_POLL_INTERVAL", "2"))
+# Schéma /object_info de chaque backend : relu en tâche de fond, sert aux listes (/checkpoints...) et à la validation
+OBJECT_INFO_REFRESH = float(os.environ.get("BRIDGE_OBJECT_INFO_REFRESH", "60"))
+# Validation locale des workflows rendus avant soumission (classes, entrées requises, énumérations, bornes)
+VALIDATE_WORKFLOWS = os.environ.get("BRIDGE_VALIDATE_WORKFLOWS", "1") == "1"
+VALIDATION_MAX_ERRORS = 5
 DEBUG = True
+# Durée max d'exécution d'un job, comptée à partir du démarrage effectif côté ComfyUI
 MAX_WAIT_TIME = 180
+# Attente max dans la file ComfyUI avant le démarrage
+MAX_QUEUE_WAIT_TIME = 3600
+
+# Ordonnanceur : file équitable par utilisateur, priorités, jobs simultanés par backend ComfyUI
+MAX_INFLIGHT_JOBS = int(os.environ.get("BRIDGE_MAX_INFLIGHT_JOBS", "2"))
+SCHEDULER_MAX_QUEUED = int(os.environ.get("BRIDGE_MAX_QUEUED", "500"))
+SCHEDULER_MAX_QUEUED_PER_USER = int(os.environ.get("BRIDGE_MAX_QUEUED_PER_USER", "50"))
+# Au-delà, un job "batch" en attente passe devant les jobs interactifs (anti-famine)
+SCHEDULER_BATCH_MAX_WAIT = 300
+JOB_PRIORITIES = {"interactive": 0, "batch": 1, "idle": 2}
+# Affinité de modèle : parmi les premiers utilisateurs de la file équitable (fenêtre), un job dont les
+# modèles sont déjà chargés sur un backend libre passe devant ; un même job n'est doublé que MAX_SKIPS fois
+SCHEDULER_AFFINITY_WINDOW = int(os.environ.get("BRIDGE_AFFINITY_WINDOW", "4"))
+SCHEDULER_AFFINITY_MAX_SKIPS = int(os.environ.get("BRIDGE_AFFINITY_MAX_SKIPS", "3"))
+# Réveils sans changement de l'ordre (poll des backends) : un message "queue" n'est renvoyé à un job que si sa
+# position bouge ou si son attente prévue varie d'au moins ETA_MIN_CHANGE secondes
+SCHEDULER_ETA_MIN_CHANGE = float(os.environ.get("BRIDGE_QUEUE_ETA_MIN_CHANGE", "5"))
+# Jobs abandonnés : un job en file déjà suivi par un client (WS, SSE ou /progress), puis plus suivi par personne
+# depuis ABANDON_GRACE secondes, est annulé (0 = désactivé). BRIDGE_ABANDON_RUNNING=1 interrompt aussi les jobs
+# en cours d'exécution.
+JOB_ABANDON_GRACE = float(os.environ.get("BRIDGE_ABANDON_GRACE", "0"))
+JOB_ABANDON_RUNNING = os.environ.get("BRIDGE_ABANDON_RUNNING", "0") == "1"
+JOB_ABANDON_CHECK_INTERVAL = 2.0
+
+# Préchauffage au démarrage : checkpoints listés, sinon les plus demandés d'après le journal (0 = désactivé).
+# /ready répond 503 tant qu'il n'est pas terminé.
+WARMUP_CHECKPOINTS = [c.strip() for c in os.environ.get("BRIDGE_WARMUP_CHECKPOINTS", "").split(",") if c.strip()]
+WARMUP_COUNT = int(os.environ.get("BRIDGE_WARMUP_COUNT", "1"))
+WARMUP_TIMEOUT = float(os.environ.get("BRIDGE_WARMUP_TIMEOUT", "300"))
+
+# Génération par lots (/generate/batch) : variations max par lot, exécutions d'un lot
+# présentes en même temps dans l'ordonnanceur, seeds regroupés par exécution (batch_size)
+BATCH_MAX_ITEMS = int(os.environ.get("BRIDGE_BATCH_MAX_ITEMS", "500"))
+BATCH_WINDOW = int(os.environ.get("BRIDGE_BATCH_WINDOW", "8"))
+BATCH_LATENT_MAX = int(os.environ.get("BRIDGE_BATCH_LATENT_MAX", "4"))
+BATCH_MAX_RUNS = 200
+
+WS_RECONNECT_MIN_DELAY = 0.5
+WS_RECONNECT_MAX_DELAY = 10.0
+# Évènements reçus avant l'abonnement du job (entre queue_prompt et le stream)
+WS_PENDING_MAX_EVENTS = 200
+WS_PENDING_TTL = 60
+
+# Progression : canaux gardés en mémoire (snapshot /progress, rejeu à la connexion), file bornée par abonné
+PROGRESS_MAX_CHANNELS = int(os.environ.get("BRIDGE_PROGRESS_MAX_CHANNELS", "10000"))
+PROGRESS_SUBSCRIBER_QUEUE = 64
+SSE_KEEPALIVE_INTERVAL = 15
+
+# Client HTTP async partagé (keep-alive + pool) pour tous les appels ComfyUI
+COMFY_HTTP_MAX_CONNECTIONS = int(os.environ.get("COMFY_HTTP_MAX_CONNECTIONS", "100"))
+COMFY_HTTP_MAX_KEEPALIVE = int(os.environ.get("COMFY_HTTP_MAX_KEEPALIVE", "20"))
+COMFY_HTTP_TIMEOUT = float(os.environ.get("COMFY_HTTP_TIMEOUT", "30"))
+COMFY_HTTP_CONNECT_TIMEOUT = float(os.environ.get("COMFY_HTTP_CONNECT_TIMEOUT", "5"))
+
+# Résultats : URL de téléchargement par défaut, base64 inline uniquement sur demande
+RESULT_INLINE_BASE64 = os.environ.get("RESULT_INLINE_BASE64", "0") == "1"
+RESULT_STREAM_CHUNK_SIZE = 256 * 1024
+
+# Cache des résultats : budget mémoire + disque, TTL, éviction LRU
+RESULT_STORE_MAX_BYTES = int(os.environ.get("RESULT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+RESULT_STORE_TTL = float(os.environ.get("RESULT_STORE_TTL", "3600"))
+RESULT_STORE_PURGE_INTERVAL = 60
+
+# Cache dédupliqué des sorties (seed fixe uniquement) : workflow rendu identique -> sortie déjà générée
+OUTPUT_CACHE_ENABLED = os.environ.get("BRIDGE_OUTPUT_CACHE", "1") == "1"
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get("BRIDGE_OUTPUT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+OUTPUT_CACHE_MAX_ENTRIES = int(os.environ.get("BRIDGE_OUTPUT_CACHE_MAX_ENTRIES", "20000"))
+
+# Télémétrie GPU (GPUtil) échantillonnée en tâche de fond, /gpu_status lit le dernier échantillon
+GPU_SAMPLE_INTERVAL = float(os.environ.get("GPU_SAMPLE_INTERVAL", "5"))
+
+# État partagé entre workers (uvicorn --workers N) : "local" (un seul process) ou "sqlite" (base WAL commune :
+# progression, résultats et état des jobs visibles depuis tous les workers)
+SHARED_STATE_BACKEND = os.environ.get("BRIDGE_STATE_BACKEND", "local")
+SHARED_STATE_POLL_INTERVAL = float(os.environ.get("BRIDGE_STATE_POLL_INTERVAL", "0.05"))
+SHARED_STATE_EVENT_TTL = 120
+SHARED_STATE_JOB_TTL = 7 * 24 * 3600
+SHARED_STATE_PURGE_INTERVAL = 30
+
+# Progression : au plus un message par intervalle et par job (pourcentage global pondéré par nœud + ETA)
+PROGRESS_MIN_INTERVAL = float(os.environ.get("BRIDGE_PROGRESS_INTERVAL", "0.25"))
+# Durées apprises par profil (workflow, checkpoint, steps, résolution) : moyenne mobile, profils gardés
+ETA_ALPHA = 0.3
+ETA_MAX_PROFILES = 2000
+ETA_SAVE_EVERY = 10
+
+# Previews latentes (frames binaires ComfyUI) relayées aux clients WS qui les demandent (?preview=1) :
+# au plus une image par intervalle et par job, réduite à PREVIEW_MAX_SIZE pixels (plus grand côté), en JPEG
+PREVIEW_MIN_INTERVAL = float(os.environ.get("BRIDGE_PREVIEW_INTERVAL", "0.5"))
+PREVIEW_MAX_SIZE = int(os.environ.get("BRIDGE_PREVIEW_MAX_SIZE", "256"))
+PREVIEW_QUALITY = 70
+
+# Histogrammes /metrics (secondes)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Mesure du retard de la boucle asyncio (réveil d'un sleep de cette durée)
+LOOP_LAG_INTERVAL = float(os.environ.get("BRIDGE_LOOP_LAG_INTERVAL", "0.1"))
 
 MODEL_CHECKPOINT = "v1-5-pruned-emaonly-fp16.safetensors"
 
-RUNWAY_API_URL = "https://api.runwayml.com/v1/images-to-video"
+# Runway : URL de base configurable (faux serveur local : fake_runway.py)
+RUNWAY_API_BASE = os.environ.get("RUNWAY_API_BASE", "https://api.runwayml.com/v1").rstrip("/")
+RUNWAY_API_URL = f"{RUNWAY_API_BASE}/images-to-video"
+RUNWAY_API_VERSION = os.environ.get("RUNWAY_API_VERSION", "")
+RUNWAY_MAX_CONCURRENT_PER_KEY = int(os.environ.get("RUNWAY_MAX_CONCURRENT_PER_KEY", "2"))
+RUNWAY_POLL_MIN_INTERVAL = float(os.environ.get("RUNWAY_POLL_MIN_INTERVAL", "1"))
+RUNWAY_POLL_MAX_INTERVAL = float(os.environ.get("RUNWAY_POLL_MAX_INTERVAL", "10"))
+RUNWAY_MAX_WAIT_TIME = 900
+RUNWAY_SUBMIT_RETRIES = 5
+RUNWAY_HTTP_TIMEOUT = 30
+RUNWAY_DOWNLOAD_TIMEOUT = 120
 
 NODE_IDS = {
     "CHECKPOINT_LOADER": "4",
@@ -50,16 +199,122 @@ NODE_IDS = {
 }
 
 NODE_TYPE_CHECKPOINT = "CheckpointLoaderSimple"
-
-WORKFLOWS_DIR = os.path.join(os.path.dirname(__file__), "workflows")
+NODE_TYPE_VAE = "VAELoader"
+
+# Uploads : écriture en flux + sha256, une image déjà reçue n'est pas renvoyée à ComfyUI
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_MAX_BYTES = int(os.environ.get("BRIDGE_UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+# Pool de processus pour le traitement d'image (hors boucle asyncio)
+IMAGE_WORKERS = int(os.environ.get("BRIDGE_IMAGE_WORKERS", "2"))
+
+# Journal des jobs (JSONL append-only, fsync groupé) : reprise après redémarrage, /jobs
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("BRIDGE_JOURNAL_FLUSH_INTERVAL", "0.2"))
+JOURNAL_MAX_JOBS = int(os.environ.get("BRIDGE_JOURNAL_MAX_JOBS", "20000"))
+# Compaction dès que le fichier dépasse ce nombre de lignes
+JOURNAL_COMPACT_LINES = JOURNAL_MAX_JOBS * 5
+
+# Galerie : index automatique (sondage des mtime), vignettes + variantes WebP/AVIF
+GALLERY_SCAN_INTERVAL = float(os.environ.get("BRIDGE_GALLERY_SCAN_INTERVAL", "10"))
+GALLERY_WIDTHS = (320, 768, 1600)
+GALLERY_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+GALLERY_PAGE_MAX = 200
+
+# Post-traitement des sorties à la demande (/result/{id}/file?format=webp&width=768) : conversion, réduction,
+# métadonnées. Rendu dans le pool de processus, variantes gardées sur disque (LRU borné en octets).
+VARIANT_CACHE_MAX_BYTES = int(os.environ.get("BRIDGE_VARIANT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+VARIANT_QUALITY = {"webp": 82, "jpeg": 85, "avif": 60}
+VARIANT_MAX_WIDTH = 8192
+
+# Affiches pré-générées (/affiche/random) : tant que tous les backends ComfyUI sont vides, le worker 0 remplit
+# un pool d'affiches aléatoires (random_affiche_data.json), en priorité "idle" ; tout autre job les préempte
+# (annulation). Pool borné en nombre et en octets. 0 = désactivé.
+AFFICHE_POOL_SIZE = int(os.environ.get("BRIDGE_AFFICHE_POOL_SIZE", "0"))
+AFFICHE_POOL_MAX_BYTES = int(os.environ.get("BRIDGE_AFFICHE_POOL_MAX_BYTES", str(256 * 1024 * 1024)))
+AFFICHE_WORKFLOW = os.environ.get("BRIDGE_AFFICHE_WORKFLOW", "affiche.json")
+AFFICHE_SIZE = tuple(int(v) for v in os.environ.get("BRIDGE_AFFICHE_SIZE", "1080x1920").lower().split("x"))
+AFFICHE_IDLE_CHECK_INTERVAL = 2.0
+
+# Templates de workflow : relecture du fichier seulement si son mtime change
+TEMPLATE_STAT_INTERVAL = 1.0
+# Réponses JSON servies depuis la mémoire (catalogue, listes) : gzip au-delà de cette taille
+GZIP_MIN_SIZE = 1024
+
+WORKFLOWS_DIR = os.environ.get("BRIDGE_WORKFLOWS_DIR", os.path.join(os.path.dirname(__file__), "workflows"))
 IMAGES_DIR = os.path.join(os.path.dirname(__file__), "images")
+RESULT_STORE_DIR = os.environ.get("RESULT_STORE_DIR", os.path.join(os.path.dirname(__file__), "results_cache"))
+OUTPUT_CACHE_DIR = os.environ.get("BRIDGE_OUTPUT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "output_cache"))
+GALLERY_CACHE_DIR = os.environ.get("BRIDGE_GALLERY_CACHE_DIR", os.path.join(os.path.dirname(__file__), "gallery_cache"))
+VARIANT_CACHE_DIR = os.environ.get("BRIDGE_VARIANT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "variants_cache"))
+# Même système de fichiers que IMAGES_DIR : une affiche servie y est déplacée (renommage atomique)
+AFFICHE_POOL_DIR = os.environ.get("BRIDGE_AFFICHE_POOL_DIR", os.path.join(IMAGES_DIR, "affiche_pool"))
+AFFICHE_DATA_PATH = os.path.join(os.path.dirname(__file__), "random_affiche_data.json")
 os.makedirs(WORKFLOWS_DIR, exist_ok=True)
 os.makedirs(IMAGES_DIR, exist_ok=True)
+JOURNAL_DIR = os.environ.get("BRIDGE_JOURNAL_DIR", os.path.join(os.path.dirname(__file__), "journal"))
+os.makedirs(JOURNAL_DIR, exist_ok=True)
+SHARED_STATE_PATH = os.environ.get("BRIDGE_STATE_PATH", os.path.join(JOURNAL_DIR, "state.sqlite"))
+
+# uvicorn --workers N : chaque process prend le premier emplacement libre (verrou tenu jusqu'à sa sortie).
+# L'emplacement sépare journal, client ID ComfyUI et caches disque du worker, stables d'un démarrage à l'autre.
+# Pris au démarrage de l'app (claim_worker_slot), pas à l'import : importer le module ne réserve rien.
+def _claim_worker_slot(directory: str) -> int:
+    slot = 0
+    while True:
+        # Descripteur non héritable : un process lancé par le bridge ne garde pas le verrou après sa sortie
+        fd = os.open(os.path.join(directory, f"worker-{slot}.lock"),
+                     os.O_RDWR | os.O_CREAT | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_NOINHERIT", 0), 0o644)
+        os.set_inheritable(fd, False)
+        f = os.fdopen(fd, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            slot += 1
+            continue
+        _worker_locks.append(f)
+        return slot
+
+_worker_locks = []
+# Fixé par claim_worker_slot() au démarrage de l'app
+WORKER_SLOT = 0
+
+def worker_dir(base: str) -> str:
+    # Le worker 0 garde les dossiers d'origine (déploiement à un seul process inchangé)
+    return base if WORKER_SLOT == 0 else os.path.join(base, f"worker-{WORKER_SLOT}")
+
+OUTPUT_CACHE_BASE_DIR = OUTPUT_CACHE_DIR
+
+# Client ID fixe du bridge : une seule connexion WS vers ComfyUI, partagée par tous les jobs du worker.
+# Gardé d'un démarrage à l'autre : ComfyUI continue d'envoyer les évènements des jobs repris.
+BRIDGE_CLIENT_ID = os.environ.get("BRIDGE_CLIENT_ID")
+
+def worker_client_id(journal_dir: str) -> str:
+    client_id = os.environ.get("BRIDGE_CLIENT_ID")
+    if client_id:
+        return f"{client_id}-{WORKER_SLOT}" if WORKER_SLOT else client_id
+    try:
+        with open(os.path.join(journal_dir, "client_id"), "r", encoding="utf-8") as f:
+            client_id = f.read().strip()
+    except OSError:
+        pass
+    if not client_id:
+        client_id = f"bridge-{uuid.uuid4().hex[:12]}"
+        with open(os.path.join(journal_dir, "client_id"), "w", encoding="utf-8") as f:
+            f.write(client_id)
+    return client_id
 
 COMFYUI_OUTPUT_DIR = "output"
 
-active_connections: Dict[str, WebSocket] = {}
-prompt_results: Dict[str, dict] = {}
+# Dossiers indexés par la galerie : BRIDGE_GALLERY_DIRS="carrousel=/chemin,output=/chemin"
+GALLERY_DIRS = {"carrousel": os.path.join(os.path.dirname(__file__), "carrousel")}
+if os.path.isdir(os.path.join(os.path.dirname(__file__), COMFYUI_OUTPUT_DIR)):
+    GALLERY_DIRS["output"] = os.path.join(os.path.dirname(__file__), COMFYUI_OUTPUT_DIR)
+if os.environ.get("BRIDGE_GALLERY_DIRS"):
+    GALLERY_DIRS = dict(d.split("=", 1) for d in os.environ["BRIDGE_GALLERY_DIRS"].split(",") if "=" in d)
 
 _warmup_done = False
 
@@ -78,6 +333,47 @@ class TextToImageParams(BaseModel):
     negative: str
     checkpoint: str
 
+
+class GenerateParams(BaseModel):
+    # Mêmes champs (et défauts) que le formulaire de /generate
+    prompt: str = ""
+    negative_prompt: str = ""
+    width: int = 1024
+    height: int = 1024
+    steps: int = 30
+    sampler: str = "euler"
+    cfg_scale: float = 7.0
+    seed: int = -1
+    checkpoint: str = MODEL_CHECKPOINT
+    input_image_path: Optional[str] = None
+    base_end_step: Optional[float] = None
+    refiner_start_step: Optional[float] = None
+    refiner_end_step: Optional[float] = None
+    positive_style: Optional[str] = None
+    negative_style: Optional[str] = None
+    vae_name: Optional[str] = None
+    sdxl_mode: Optional[str] = None
+    sdxl_quality: Optional[str] = None
+
+
+class BatchSweep(BaseModel):
+    # Axes du balayage ; un axe absent reprend la valeur de base
+    seeds: Optional[List[int]] = None
+    seed_start: Optional[int] = None
+    seed_count: Optional[int] = Field(None, ge=1)
+    cfg_scales: Optional[List[float]] = None
+    samplers: Optional[List[str]] = None
+    prompts: Optional[List[str]] = None
+
+
+class BatchRequest(BaseModel):
+    workflow_name: str
+    params: GenerateParams = GenerateParams()
+    sweep: BatchSweep = BatchSweep()
+    priority: str = "batch"
+    # Plage de seeds : plusieurs images par exécution via EmptyLatentImage.batch_size
+    latent_batch: bool = True
+
 # ---------------------------------------------------------------------
 # APP
 # ---------------------------------------------------------------------
@@ -93,18 +389,112 @@ app.add_middleware(
 )
 
 # ---------------------------------------------------------------------
-# UTILS
+# MÉTRIQUES (format texte Prometheus)
 # ---------------------------------------------------------------------
 
-async def get_checkpoints_from_comfy():
+def _metric_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+
+class Histogram:
+    # Une série par valeur du label (ex. stage="history")
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series: Dict[str, dict] = {}
+
+    def observe(self, value_label: str, seconds: float):
+        serie = self.series.get(value_label)
+        if serie is None:
+            serie = self.series[value_label] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                serie["counts"][i] += 1
+                break
+        serie["sum"] += seconds
+        serie["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for value_label, serie in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, serie["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_metric_labels({self.label: value_label, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_metric_labels({self.label: value_label, 'le': '+Inf'})} {serie['count']}")
+            lines.append(f"{self.name}_sum{_metric_labels({self.label: value_label})} {serie['sum']:.6f}")
+            lines.append(f"{self.name}_count{_metric_labels({self.label: value_label})} {serie['count']}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values: Dict[str, float] = {}
+
+    def inc(self, value_label: str, amount: float = 1):
+        self.values[value_label] = self.values.get(value_label, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_metric_labels({self.label: k})} {v}" for k, v in sorted(self.values.items())]
+        return lines
+
+
+def render_gauge(name: str, help_text: str, samples, kind: str = "gauge") -> List[str]:
+    # samples : [(labels, valeur)]
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_metric_labels(labels)} {value}" for labels, value in samples]
+    return lines
+
+
+stage_seconds = Histogram("bridge_stage_seconds", "Durée de chaque étape d'un job", "stage")
+jobs_total = Counter("bridge_jobs_total", "Jobs terminés, par issue", "outcome")
+loop_lag_seconds = Histogram("bridge_event_loop_lag_seconds", "Retard de réveil de la boucle asyncio", "loop")
+progress_messages_total = Counter("bridge_progress_messages_total", "Mises à jour de progression, envoyées ou fusionnées", "result")
+previews_total = Counter("bridge_previews_total", "Previews latentes, envoyées ou sautées", "result")
+cancellations_total = Counter("bridge_cancellations_total", "Annulations de jobs, par origine", "origin")
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
     try:
-        loop = asyncio.get_event_loop()
-        resp = await loop.run_in_executor(None, requests.get, f"{COMFYUI_HOST}/object_info/CheckpointLoaderSimple")
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("CheckpointLoaderSimple", {}).get("input", {}).get("required", {}).get("ckpt_name", [[]])[0]
-    except:
-        return []
+        yield
+    finally:
+        stage_seconds.observe(stage, time.perf_counter() - t0)
+
+# ---------------------------------------------------------------------
+# UTILS
+# ---------------------------------------------------------------------
+
+_comfy_http: Optional[httpx.AsyncClient] = None
+
+def get_comfy_http() -> httpx.AsyncClient:
+    global _comfy_http
+    if _comfy_http is None or _comfy_http.is_closed:
+        _comfy_http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=COMFY_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=COMFY_HTTP_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(COMFY_HTTP_TIMEOUT, connect=COMFY_HTTP_CONNECT_TIMEOUT),
+        )
+    return _comfy_http
+
+async def close_comfy_http():
+    global _comfy_http
+    if _comfy_http is not None:
+        await _comfy_http.aclose()
+        _comfy_http = None
 
 def get_gpu_status_sync():
     try:
@@ -120,10 +510,60 @@ def get_gpu_status_sync():
             print(f"GPU check error: {e}")
         return {"status": "error", "name": "GPU indisponible", "load": 0, "memory_total": 0, "memory_used": 0}
 
-def queue_prompt(prompt_workflow: dict):
-    client_id = str(uuid.uuid4())
+def sample_gpu_sync():
+    gpus = GPU.getGPUs()
+    if not gpus:
+        return {"status": "error", "name": "GPU indisponible", "load": 0, "memory_total": 0, "memory_used": 0}
+    details = [{
+        "id": g.id,
+        "name": g.name,
+        "load": round(g.load * 100, 1),
+        "memory_total": round(g.memoryTotal / 1024, 1),
+        "memory_used": round(g.memoryUsed / 1024, 1),
+        "temperature": g.temperature,
+    } for g in gpus]
+    # Champs à plat = premier GPU (format attendu par le front)
+    return dict(details[0], status="ok", gpus=details, sampled_at=time.time())
+
+gpu_telemetry: dict = {}
+_gpu_task: Optional[asyncio.Task] = None
+
+async def gpu_sampler_loop():
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            gpu_telemetry.update(await loop.run_in_executor(None, sample_gpu_sync))
+        except Exception as e:
+            if DEBUG:
+                print(f"GPU check error: {e}")
+            gpu_telemetry.update({"status": "error", "name": "GPU indisponible", "load": 0,
+                                  "memory_total": 0, "memory_used": 0, "sampled_at": time.time()})
+        await asyncio.sleep(GPU_SAMPLE_INTERVAL)
+
+_lag_task: Optional[asyncio.Task] = None
+
+async def loop_lag_monitor():
+    # Un callback bloquant (CPU, I/O synchrone) retarde tous les autres : on mesure l'écart au réveil
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.observe("main", max(0.0, time.perf_counter() - t0 - LOOP_LAG_INTERVAL))
+
+def process_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+async def queue_prompt(prompt_workflow: dict, prompt_id: Optional[str] = None, backend=None):
+    client_id = BRIDGE_CLIENT_ID
     payload = {"prompt": prompt_workflow, "client_id": client_id}
-    resp = requests.post(f"{COMFYUI_HOST}/prompt", json=payload)
+    if prompt_id:
+        payload["prompt_id"] = prompt_id
+    backend = backend or backend_pool.default
+    with timed("queue_prompt"):
+        resp = await get_comfy_http().post(f"{backend.url}/prompt", json=payload)
     if resp.status_code != 200:
         msg = resp.json().get("error", {}).get("message", "Invalid prompt")
         detail = resp.json().get("error", {}).get("details", "")
@@ -131,24 +571,26 @@ def queue_prompt(prompt_workflow: dict):
     j = resp.json()
     return j["prompt_id"], client_id
 
-async def get_image(filename, subfolder, folder_type):
-    url = f"{COMFYUI_HOST}/view?filename={filename}&subfolder={subfolder}&type={folder_type}"
-    loop = asyncio.get_event_loop()
-    resp = await loop.run_in_executor(None, requests.get, url)
-    if resp.status_code != 200:
-        return "image/png", None
-    mime = resp.headers.get("Content-Type", "image/png")
-    return mime, base64.b64encode(resp.content).decode("utf-8")
+async def get_history(prompt_id: str, backend=None) -> dict:
+    with timed("history"):
+        return await _get_history(prompt_id, backend)
 
-def get_history(prompt_id: str) -> dict:
-    try:
-        resp = requests.get(f"{COMFYUI_HOST}/history/{prompt_id}")
-        resp.raise_for_status()
-        return resp.json()
-    except Exception as e:
-        if DEBUG:
-            print(f"Error fetching history for {prompt_id}: {e}")
-        return {}
+async def _get_history(prompt_id: str, backend=None) -> dict:
+    # Sans backend connu pour ce prompt, on interroge tous les backends
+    backend = backend or backend_pool.lookup(prompt_id)
+    for candidate in ([backend] if backend else backend_pool.backends):
+        try:
+            resp = await get_comfy_http().get(f"{candidate.url}/history/{prompt_id}")
+            resp.raise_for_status()
+            history = resp.json()
+        except Exception as e:
+            if DEBUG:
+                print(f"Error fetching history for {prompt_id} on {candidate.name}: {e}")
+            continue
+        if prompt_id in history:
+            backend_pool.remember(prompt_id, candidate)
+            return history
+    return {}
 
 def find_save_image_node_id(prompt_workflow, history_outputs):
     for nid, outputs in history_outputs.items():
@@ -157,123 +599,3095 @@ def find_save_image_node_id(prompt_workflow, history_outputs):
     return None
 
 # ---------------------------------------------------------------------
-# 🚀 run_prompt_and_stream AVEC PROGRESSION ACTIVÉE
+# RESULT STORE (borné : octets, TTL, LRU)
 # ---------------------------------------------------------------------
 
-async def run_prompt_and_stream(prompt_id, client_id, prompt_workflow):
+class ResultStore:
+    # Métadonnées en mémoire + blob optionnel sur disque (fichier de sortie déjà téléchargé).
+    # La lecture n'est pas destructive : /result et /ws/progress sont idempotents.
+
+    def __init__(self, max_bytes: int, ttl: float, blob_dir: str):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.blob_dir = blob_dir
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._last_purge = time.monotonic()
+
+    def __contains__(self, key: str) -> bool:
+        return self._lookup(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry["meta"]
+
+    def put(self, key: str, meta: dict, ttl: Optional[float] = None):
+        self._drop(key)
+        entry = {
+            "meta": meta,
+            "meta_size": len(json.dumps(meta, default=str)),
+            "blob_size": 0,
+            "expires": time.monotonic() + (self.ttl if ttl is None else ttl),
+        }
+        self.entries[key] = entry
+        self.total_bytes += entry["meta_size"]
+        self._enforce()
+
+    async def put_blob(self, key: str, data: bytes):
+        entry = self._lookup(key)
+        if entry is None or len(data) > self.max_bytes:
+            return
+        path = self._blob_file(key)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, _write_file, path, data)
+        # L'entrée a pu être évincée pendant l'écriture
+        if self.entries.get(key) is not entry:
+            _remove_file(path)
+            return
+        self.total_bytes += len(data) - entry["blob_size"]
+        entry["blob_size"] = len(data)
+        self._enforce()
+
+    def blob_path(self, key: str) -> Optional[str]:
+        entry = self._lookup(key)
+        if entry is None or not entry["blob_size"]:
+            return None
+        return self._blob_file(key)
+
+    def discard(self, key: str):
+        self._drop(key)
+
+    def clear_orphan_blobs(self):
+        # Blobs d'un process précédent : plus référencés par le cache mémoire
+        for name in os.listdir(self.blob_dir):
+            _remove_file(os.path.join(self.blob_dir, name))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _blob_file(self, key: str) -> str:
+        return os.path.join(self.blob_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _lookup(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is not None and entry["expires"] <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry["meta_size"] + entry["blob_size"]
+        if entry["blob_size"]:
+            _remove_file(self._blob_file(key))
+
+    def _enforce(self):
+        now = time.monotonic()
+        if now - self._last_purge > RESULT_STORE_PURGE_INTERVAL:
+            self._last_purge = now
+            for key in [k for k, e in self.entries.items() if e["expires"] <= now]:
+                self._drop(key)
+                self.expirations += 1
+        while self.total_bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self._drop(key)
+            self.evictions += 1
+
+
+def _write_file(path: str, data: bytes):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _remove_file(path: str):
     try:
-        async with websockets.connect(COMFYUI_WS_URL + f"?clientId={client_id}") as ws_comfy:
+        os.remove(path)
+    except OSError:
+        pass
 
-            while True:
-                raw = await asyncio.wait_for(ws_comfy.recv(), timeout=MAX_WAIT_TIME)
-                msg = json.loads(raw)
-
-                # -------------------------------------------
-                # 🔥 FIX : MESSAGES DE PROGRESSION
-                # -------------------------------------------
-
-                # Format direct "progress"
-                if msg.get("type") == "progress":
-                    if prompt_id in active_connections:
-                        await active_connections[prompt_id].send_json({
-                            "type": "progress",
-                            "value": msg["data"].get("value", 0),
-                            "max_value": msg["data"].get("max", 100)
-                        })
 
-                # Format "executing" (node en cours)
-                if msg.get("type") == "executing" and msg["data"].get("node") is not None:
-                    if prompt_id in active_connections:
-                        await active_connections[prompt_id].send_json({
-                            "type": "progress",
-                            "value": 0,           # obligatoire pour éviter NaN%
-                            "max_value": 100,     # idem
-                            "node": msg["data"]["node"]
-                        })
+prompt_results = ResultStore(RESULT_STORE_MAX_BYTES, RESULT_STORE_TTL, RESULT_STORE_DIR)
 
-                # -------------------------------------------
-                # 💡 FIN DU WORKFLOW (node == null)
-                # -------------------------------------------
-                if msg.get("type") == "executing" and msg["data"].get("node") is None:
+# ---------------------------------------------------------------------
+# CACHE DES SORTIES (dédupliqué, adressé par contenu)
+# ---------------------------------------------------------------------
+
+def workflow_cache_key(workflow: dict) -> str:
+    # JSON canonique du workflow rendu ; "_meta" (titres de l'UI) n'influe pas sur la sortie
+    graph = {nid: {k: v for k, v in node.items() if k != "_meta"} if isinstance(node, dict) else node
+             for nid, node in workflow.items()}
+    canonical = json.dumps(graph, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class OutputCache:
+    # keys/<hash workflow>.json -> liste de fichiers ; blobs/<sha256 contenu> stocké une seule fois.
+    # Éviction LRU (mtime du fichier de clé) selon le nombre d'entrées et les octets de blobs.
+
+    def __init__(self, root: str, max_bytes: int, max_entries: int):
+        self.set_root(root)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.blob_refs: Dict[str, int] = {}
+        self.blob_sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        # Job en cours par clé (coalescence) et demandes identiques qui l'attendent
+        self.inflight: Dict[str, "BridgeJob"] = {}
+        self.followers: Dict[str, List[str]] = {}
+        self._writing = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def load(self):
+        # Index reconstruit depuis le disque (ordre LRU = mtime des fichiers de clé)
+        paths = []
+        for name in os.listdir(self.key_dir):
+            path = os.path.join(self.key_dir, name)
+            if not name.endswith(".json"):
+                _remove_file(path)
+                continue
+            try:
+                paths.append((os.stat(path).st_mtime, name[:-5], path))
+            except OSError:
+                pass
+        for _, key, path in sorted(paths):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                _remove_file(path)
+                continue
+            if all(os.path.isfile(self._blob_file(fi["sha256"])) for fi in entry["files"]):
+                self._add(key, entry)
+            else:
+                _remove_file(path)
+
+        for sub in os.listdir(self.blob_dir):
+            sub_dir = os.path.join(self.blob_dir, sub)
+            for name in os.listdir(sub_dir) if os.path.isdir(sub_dir) else ():
+                if name not in self.blob_refs:
+                    _remove_file(os.path.join(sub_dir, name))
+        self._enforce()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        try:
+            os.utime(self._key_file(key))
+        except OSError:
+            pass
+        return entry
+
+    async def store(self, key: str, msg: dict):
+        if key in self.entries:
+            return
+        loop = asyncio.get_event_loop()
+        files = []
+        try:
+            for file_info in msg.get("items") or [msg]:
+                data = await read_output_bytes(dict(msg, **file_info))
+                sha = hashlib.sha256(data).hexdigest()
+                self._writing.add(sha)
+                if sha not in self.blob_refs:
+                    await loop.run_in_executor(None, _write_blob, self._blob_file(sha), data)
+                files.append({"sha256": sha, "size": len(data), "filename": file_info["filename"],
+                              "mime_type": file_info["mime_type"]})
+            if sum(fi["size"] for fi in files) > self.max_bytes:
+                return
+            entry = {"media_type": msg["media_type"], "files": files}
+            if msg.get("generation"):
+                entry["generation"] = msg["generation"]
+            await loop.run_in_executor(None, _write_file, self._key_file(key), json.dumps(entry).encode("utf-8"))
+            self._add(key, entry)
+            self.stores += 1
+        finally:
+            for fi in files:
+                self._writing.discard(fi["sha256"])
+                if fi["sha256"] not in self.blob_refs:
+                    _remove_file(self._blob_file(fi["sha256"]))
+        self._enforce()
+
+    def output_message(self, prompt_id: str, entry: dict) -> dict:
+        files = entry["files"]
+        msg = {
+            "type": "output",
+            "prompt_id": prompt_id,
+            "media_type": entry["media_type"],
+            "mime_type": files[0]["mime_type"],
+            "filename": files[0]["filename"],
+            "subfolder": "",
+            "folder_type": "output",
+            "source": "cache",
+            "backend": None,
+            "blob": files[0]["sha256"],
+            "url": f"/result/{prompt_id}/file",
+        }
+        if len(files) > 1:
+            msg["items"] = [{
+                "mime_type": fi["mime_type"],
+                "filename": fi["filename"],
+                "subfolder": "",
+                "folder_type": "output",
+                "blob": fi["sha256"],
+                "url": f"/result/{prompt_id}/file?index={i}",
+            } for i, fi in enumerate(files)]
+        if entry.get("generation"):
+            msg["generation"] = entry["generation"]
+        return msg
+
+    def set_root(self, root: str):
+        self.root = root
+        self.key_dir = os.path.join(root, "keys")
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.key_dir, exist_ok=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def blob_path(self, sha: str) -> Optional[str]:
+        if sha in self.blob_refs:
+            return self._blob_file(sha)
+        # Sortie servie par un autre worker (uvicorn --workers) : blob d'un cache voisin
+        base = OUTPUT_CACHE_BASE_DIR
+        for root in [base] + [os.path.join(base, n) for n in os.listdir(base) if n.startswith("worker-")]:
+            path = os.path.join(root, "blobs", sha[:2], sha)
+            if root != self.root and os.path.isfile(path):
+                return path
+        return None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "enabled": OUTPUT_CACHE_ENABLED,
+            "entries": len(self.entries),
+            "blobs": len(self.blob_refs),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "dedup_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "inflight": len(self.inflight),
+        }
+
+    def _key_file(self, key: str) -> str:
+        return os.path.join(self.key_dir, key + ".json")
+
+    def _blob_file(self, sha: str) -> str:
+        return os.path.join(self.blob_dir, sha[:2], sha)
+
+    def _add(self, key: str, entry: dict):
+        self.entries[key] = entry
+        for fi in entry["files"]:
+            sha = fi["sha256"]
+            if sha not in self.blob_refs:
+                self.blob_refs[sha] = 0
+                self.blob_sizes[sha] = fi["size"]
+                self.total_bytes += fi["size"]
+            self.blob_refs[sha] += 1
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        _remove_file(self._key_file(key))
+        for fi in entry["files"]:
+            sha = fi["sha256"]
+            self.blob_refs[sha] -= 1
+            if self.blob_refs[sha] <= 0:
+                del self.blob_refs[sha]
+                self.total_bytes -= self.blob_sizes.pop(sha)
+                if sha not in self._writing:
+                    _remove_file(self._blob_file(sha))
+
+    def _enforce(self):
+        while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+
+def _write_blob(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not os.path.isfile(path):
+        _write_file(path, data)
+
+
+output_cache = OutputCache(OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_MAX_ENTRIES)
+
+# ---------------------------------------------------------------------
+# ÉTAT PARTAGÉ ENTRE WORKERS (uvicorn --workers N)
+# ---------------------------------------------------------------------
+
+class SharedState:
+    # Un seul process : la progression, les résultats et le journal en mémoire font foi, rien à partager.
+    name = "local"
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def publish(self, prompt_id: str, msg: Optional[dict]):
+        pass
+
+    def put_job(self, prompt_id: str, entry: dict, owner: Optional[str] = None):
+        pass
+
+    def touch(self, seen: Dict[str, float]):
+        pass
+
+    async def last_seen(self, prompt_id: str) -> Optional[float]:
+        return None
+
+    async def get_result(self, prompt_id: str) -> Optional[dict]:
+        return None
+
+    async def get_job(self, prompt_id: str) -> Optional[dict]:
+        return None
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "worker": WORKER_SLOT}
+
+
+class SqliteState(SharedState):
+    # Base SQLite (WAL) commune aux workers d'une machine :
+    #   events  : flux des messages de progression (None = fin), relu en continu par chaque worker
+    #   results : message final des jobs (output / error), pour /result et /progress d'un autre worker
+    #   jobs    : état public du journal et propriétaire du job, pour /jobs/{id} et DELETE /jobs/{id}
+    #   watchers: dernier passage d'un client par job et par worker (jobs abandonnés)
+    # Écritures groupées, lectures et écritures dans un thread dédié : la boucle asyncio ne touche pas au disque.
+
+    name = "sqlite"
+
+    def __init__(self, path: str, origin: str, poll_interval: float):
+        self.path = path
+        self.origin = origin
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self.conn: Optional[sqlite3.Connection] = None
+        self.last_id = 0
+        self._events: List[tuple] = []
+        self._results: Dict[str, tuple] = {}
+        self._jobs: Dict[str, tuple] = {}
+        self._watchers: Dict[str, tuple] = {}
+        self._last_purge = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.received = 0
+        self.flushes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, prompt_id TEXT,
+                                               msg TEXT, created REAL);
+            CREATE INDEX IF NOT EXISTS events_created ON events (created);
+            CREATE TABLE IF NOT EXISTS results (prompt_id TEXT PRIMARY KEY, msg TEXT, expires REAL);
+            CREATE TABLE IF NOT EXISTS jobs (prompt_id TEXT PRIMARY KEY, entry TEXT, updated REAL);
+            CREATE TABLE IF NOT EXISTS watchers (prompt_id TEXT, origin TEXT, seen REAL, PRIMARY KEY (prompt_id, origin));
+        """)
+        # Seuls les évènements postérieurs au démarrage sont diffusés
+        self.last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self.conn = conn
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
+    def publish(self, prompt_id: str, msg: Optional[dict]):
+        now = time.time()
+        self._events.append((self.origin, prompt_id, json.dumps(msg), now))
+        if msg is not None and msg.get("type") in ("output", "error"):
+            self._results[prompt_id] = (prompt_id, json.dumps(msg), now + RESULT_STORE_TTL)
+        self.published += 1
+
+    def put_job(self, prompt_id: str, entry: dict, owner: Optional[str] = None):
+        self._jobs[prompt_id] = (prompt_id, json.dumps(dict(entry, user=owner), ensure_ascii=False), time.time())
+
+    def touch(self, seen: Dict[str, float]):
+        for prompt_id, t in seen.items():
+            self._watchers[prompt_id] = (prompt_id, self.origin, t)
+
+    async def flush(self):
+        # Aussi appelé avant de rendre un prompt_id au client : un autre worker le connaît déjà
+        if not (self._events or self._results or self._jobs or self._watchers) or self.conn is None:
+            return
+        batch = (self._events, list(self._results.values()), list(self._jobs.values()), list(self._watchers.values()))
+        self._events, self._results, self._jobs, self._watchers = [], {}, {}, {}
+        await asyncio.get_event_loop().run_in_executor(self.executor, self._write, *batch)
+        self.flushes += 1
+
+    def _write(self, events, results, jobs, watchers):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO events (origin, prompt_id, msg, created) VALUES (?, ?, ?, ?)", events)
+            conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", results)
+            conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", jobs)
+            conn.executemany("INSERT OR REPLACE INTO watchers VALUES (?, ?, ?)", watchers)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _read(self) -> List[tuple]:
+        # Les id sont attribués sous le verrou d'écriture : rien ne peut apparaître derrière last_id
+        rows = self.conn.execute("SELECT id, origin, prompt_id, msg FROM events WHERE id > ? ORDER BY id LIMIT 5000",
+                                 (self.last_id,)).fetchall()
+        if rows:
+            self.last_id = rows[-1][0]
+        now = time.time()
+        if now - self._last_purge > SHARED_STATE_PURGE_INTERVAL:
+            self._last_purge = now
+            conn = self.conn
+            conn.execute("DELETE FROM events WHERE created < ?", (now - SHARED_STATE_EVENT_TTL,))
+            conn.execute("DELETE FROM results WHERE expires < ?", (now,))
+            conn.execute("DELETE FROM jobs WHERE updated < ?", (now - SHARED_STATE_JOB_TTL,))
+            conn.execute("DELETE FROM watchers WHERE seen < ?", (now - SHARED_STATE_EVENT_TTL,))
+        return [(prompt_id, msg) for _, origin, prompt_id, msg in rows if origin != self.origin]
+
+    def _lookup(self, sql: str, *params) -> Optional[str]:
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    async def get_result(self, prompt_id: str) -> Optional[dict]:
+        if self.conn is None:
+            return None
+        raw = await asyncio.get_event_loop().run_in_executor(
+            self.executor, self._lookup, "SELECT msg FROM results WHERE prompt_id = ? AND expires > ?",
+            prompt_id, time.time())
+        return json.loads(raw) if raw else None
+
+    async def get_job(self, prompt_id: str) -> Optional[dict]:
+        if self.conn is None:
+            return None
+        raw = await asyncio.get_event_loop().run_in_executor(
+            self.executor, self._lookup, "SELECT entry FROM jobs WHERE prompt_id = ?", prompt_id)
+        return json.loads(raw) if raw else None
+
+    async def last_seen(self, prompt_id: str) -> Optional[float]:
+        # Client vu par n'importe quel worker (il peut suivre son job ailleurs que là où il tourne)
+        if self.conn is None:
+            return None
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, self._lookup, "SELECT MAX(seen) FROM watchers WHERE prompt_id = ?", prompt_id)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                if self.conn is None:
+                    await loop.run_in_executor(self.executor, self._connect)
+                await self.flush()
+                for prompt_id, raw in await loop.run_in_executor(self.executor, self._read):
+                    self.received += 1
+                    msg = json.loads(raw)
+                    # Annulation reçue par un autre worker : seul celui qui exécute le job la traite,
+                    # et seulement si elle vient du propriétaire du job
+                    if msg is not None and msg.get("type") == "cancel_request":
+                        entry = journal.get(prompt_id)
+                        if entry is not None and entry.get("user") not in (None, msg.get("user")):
+                            print(f"Annulation de {prompt_id} refusée: demandée par un autre utilisateur")
+                            continue
+                        asyncio.create_task(cancel_quietly(prompt_id, msg["detail"], "remote"))
+                        continue
+                    # Message d'un autre worker : abonnés et cache de résultats de ce process seulement
+                    if msg is not None and msg.get("type") in ("output", "error"):
+                        prompt_results.put(prompt_id, msg)
+                    progress_hub.deliver(prompt_id, msg)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"État partagé: {e}")
+                await asyncio.sleep(1)
+            await asyncio.sleep(self.poll_interval)
+
+    def stats(self) -> dict:
+        return dict(super().stats(), path=self.path, origin=self.origin, published=self.published,
+                    received=self.received, flushes=self.flushes, pending=len(self._events))
+
+
+if SHARED_STATE_BACKEND == "sqlite":
+    shared_state: SharedState = SqliteState(SHARED_STATE_PATH, str(os.getpid()), SHARED_STATE_POLL_INTERVAL)
+elif SHARED_STATE_BACKEND == "local":
+    shared_state = SharedState()
+else:
+    raise RuntimeError(f"BRIDGE_STATE_BACKEND inconnu: {SHARED_STATE_BACKEND} (local ou sqlite)")
+
+# ---------------------------------------------------------------------
+# JOURNAL DES JOBS (JSONL append-only, reprise après redémarrage)
+# ---------------------------------------------------------------------
+
+# États après lesquels un job n'est plus repris
+JOURNAL_FINAL_STATES = ("completed", "failed", "cancelled")
+
+
+class JobJournal:
+    # Une ligne JSON par transition (soumission, backend, état, sortie). Les lignes sont
+    # regroupées et écrites par la tâche de fond : un seul write + fsync par lot.
+    # Le workflow rendu n'est gardé en mémoire que pour les jobs non terminés (reprise).
+
+    def __init__(self, path: str, max_jobs: int, flush_interval: float):
+        self.path = path
+        self.max_jobs = max_jobs
+        self.flush_interval = flush_interval
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self.workflows: Dict[str, dict] = {}
+        self.lines = 0
+        self.flushes = 0
+        self.recovered = 0
+        self.requeued = 0
+        self._buffer: List[str] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, prompt_id: str, state: str, **fields):
+        workflow = fields.pop("workflow", None)
+        now = time.time()
+        entry = self.jobs.get(prompt_id)
+        if entry is None:
+            entry = self.jobs[prompt_id] = {"prompt_id": prompt_id, "created_at": now}
+            self._trim()
+        entry.update(fields, state=state, updated_at=now)
+
+        line = dict(fields, id=prompt_id, state=state, t=now)
+        if workflow is not None:
+            line["workflow"] = workflow
+            self.workflows[prompt_id] = workflow
+        if state in JOURNAL_FINAL_STATES:
+            self.workflows.pop(prompt_id, None)
+        self._buffer.append(json.dumps(line, ensure_ascii=False))
+        self._wakeup.set()
+        shared_state.put_job(prompt_id, self.public(entry), entry.get("user"))
+
+    def finish(self, prompt_id: str, msg: dict):
+        # Jobs non journalisés (/result relu depuis l'historique ComfyUI) : rien à faire
+        if prompt_id not in self.jobs:
+            return
+        if msg.get("type") == "error":
+            self.record(prompt_id, "cancelled" if msg.get("cancelled") else "failed", detail=msg.get("detail"))
+        else:
+            self.record(prompt_id, "completed", result=msg if msg.get("type") == "output" else None)
+
+    def get(self, prompt_id: str) -> Optional[dict]:
+        return self.jobs.get(prompt_id)
+
+    def unfinished(self) -> List[dict]:
+        return [e for e in self.jobs.values() if e["state"] not in JOURNAL_FINAL_STATES]
+
+    def page(self, offset: int, limit: int, state: Optional[str] = None, user: Optional[str] = None):
+        # Plus récents d'abord
+        entries = [e for e in reversed(self.jobs.values())
+                   if (state is None or e["state"] == state) and (user is None or e.get("user") == user)]
+        return entries[offset:offset + limit], len(entries)
+
+    def _trim(self):
+        # Les jobs terminés les plus anciens sortent en premier ; un job en cours n'est jamais oublié
+        if len(self.jobs) <= self.max_jobs:
+            return
+        for prompt_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[prompt_id]["state"] in JOURNAL_FINAL_STATES:
+                del self.jobs[prompt_id]
+
+    def load(self):
+        # Rejoue le fichier (dernière ligne éventuellement tronquée par un crash), puis le compacte
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for raw in f:
+                    try:
+                        line = json.loads(raw)
+                    except ValueError:
+                        continue
+                    prompt_id = line.pop("id", None)
+                    if not prompt_id:
+                        continue
+                    t = line.pop("t", 0)
+                    entry = self.jobs.get(prompt_id)
+                    if entry is None:
+                        entry = self.jobs[prompt_id] = {"prompt_id": prompt_id, "created_at": t}
+                    workflow = line.pop("workflow", None)
+                    if workflow is not None:
+                        self.workflows[prompt_id] = workflow
+                    entry.update(line, updated_at=t)
+        except OSError:
+            pass
+        for prompt_id in [p for p in self.workflows if self.jobs[p]["state"] in JOURNAL_FINAL_STATES]:
+            del self.workflows[prompt_id]
+        self._trim()
+        self.compact()
+
+    def snapshot_lines(self) -> List[str]:
+        lines = []
+        for prompt_id, entry in self.jobs.items():
+            line = {k: v for k, v in entry.items() if k not in ("prompt_id", "updated_at")}
+            line.update(id=prompt_id, t=entry["updated_at"])
+            if prompt_id in self.workflows:
+                line["workflow"] = self.workflows[prompt_id]
+            lines.append(json.dumps(line, ensure_ascii=False))
+        return lines
+
+    def compact(self):
+        self._buffer = []
+        self._rewrite(self.snapshot_lines())
+
+    def _append(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    def flush(self):
+        lines, self._buffer = self._buffer, []
+        if lines:
+            self._append(lines)
+            self.lines += len(lines)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._wakeup.wait()
+            # Les transitions des prochaines millisecondes partent dans le même fsync
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                if self.lines + len(self._buffer) > JOURNAL_COMPACT_LINES:
+                    lines = self.snapshot_lines()
+                    self._buffer = []
+                    await loop.run_in_executor(None, self._rewrite, lines)
+                else:
+                    lines, self._buffer = self._buffer, []
+                    if lines:
+                        await loop.run_in_executor(None, self._append, lines)
+                        self.lines += len(lines)
+                self.flushes += 1
+            except OSError as e:
+                print(f"Journal: écriture impossible: {e}")
+
+    def _rewrite(self, lines: List[str]):
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.lines = len(lines)
+
+    def stats(self) -> dict:
+        states = {}
+        for entry in self.jobs.values():
+            states[entry["state"]] = states.get(entry["state"], 0) + 1
+        return {"jobs": len(self.jobs), "states": states, "lines": self.lines, "flushes": self.flushes,
+                "pending_lines": len(self._buffer), "recovered": self.recovered, "requeued": self.requeued}
+
+    def public(self, entry: dict) -> dict:
+        result = entry.get("result") or {}
+        return {
+            "prompt_id": entry["prompt_id"],
+            "kind": entry.get("kind"),
+            "workflow_name": entry.get("workflow_name"),
+            "priority": entry.get("priority"),
+            "state": entry["state"],
+            "backend": entry.get("backend"),
+            "created_at": entry["created_at"],
+            "updated_at": entry["updated_at"],
+            "url": result.get("url"),
+            "detail": entry.get("detail"),
+            "recovered": entry.get("recovered", False),
+        }
 
-                    history = requests.get(f"{COMFYUI_HOST}/history/{prompt_id}").json()
-                    outputs = history.get(prompt_id, {}).get("outputs", {})
-
-                    save_id = NODE_IDS.get("SAVE_IMAGE_T2I")
-
-                    # Détection du mode SDXL (présence du Refiner Loader)
-                    if NODE_IDS.get("SDXL_REFINER_LOADER") in prompt_workflow and \
-                        prompt_workflow[NODE_IDS["SDXL_REFINER_LOADER"]].get("class_type") == NODE_TYPE_CHECKPOINT:
-                        save_id = NODE_IDS.get("SAVE_IMAGE_SDXL")
-
-                    # Fallback si ID invalide
-                    if save_id not in outputs:
-                        save_id = find_save_image_node_id(prompt_workflow, outputs)
-
-                    final_msg = {"type": "final_result", "prompt_id": prompt_id}
-
-                    # Image
-                    if save_id and outputs.get(save_id, {}).get("images"):
-                        img = outputs[save_id]["images"][0]
-                        mime, b64 = await get_image(img["filename"], img["subfolder"], img["type"])
-                        final_msg = {
-                            "type": "output",
-                            "media_type": "image",
-                            "mime_type": mime,
-                            "image_base64": b64,
-                            "filename": img["filename"]
-                        }
-
-                    # Vidéo / GIF
-                    if save_id and outputs.get(save_id, {}).get("gifs"):
-                        gif = outputs[save_id]["gifs"][0]
-                        final_msg = {
-                            "type": "output",
-                            "media_type": "video",
-                            "mime_type": "image/gif",
-                            "filename": gif["filename"]
-                        }
-
-                    # Envoi au client
-                    if prompt_id in active_connections:
-                        prompt_results[prompt_id] = final_msg
-                        await active_connections[prompt_id].send_json(final_msg)
 
+journal = JobJournal(os.path.join(JOURNAL_DIR, "jobs.jsonl"), JOURNAL_MAX_JOBS, JOURNAL_FLUSH_INTERVAL)
+
+# ---------------------------------------------------------------------
+# DIFFUSION DE LA PROGRESSION (hub multi-abonnés : WS, SSE, /progress)
+# ---------------------------------------------------------------------
+
+# Messages qui terminent un job (le dernier envoyé aux abonnés)
+TERMINAL_MESSAGES = ("output", "error", "final_result")
+# Marqueur dans la file d'un abonné : une preview binaire l'attend (jamais envoyé tel quel)
+PREVIEW_READY = {"type": "preview_ready"}
+
+
+class ProgressSubscriber:
+    # File bornée par abonné : publier ne bloque jamais. Un client lent perd les messages
+    # intermédiaires les plus anciens (progression, position), remplacés par des plus récents.
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        # Previews binaires (WS ?preview=1) : une seule en attente, remplacée tant que le client ne l'a pas lue
+        self.wants_preview = False
+        self.preview: Optional[bytes] = None
+
+    def offer(self, msg: Optional[dict]):
+        if self.queue.full():
+            try:
+                if self.queue.get_nowait() is PREVIEW_READY:
+                    self.preview = None
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(msg)
+
+    def offer_preview(self, frame: bytes):
+        if self.preview is not None:
+            # Client lent : la preview précédente n'est jamais envoyée
+            previews_total.inc("dropped")
+            self.preview = frame
+            return
+        self.preview = frame
+        self.offer(PREVIEW_READY)
+
+    def take_preview(self) -> Optional[bytes]:
+        frame, self.preview = self.preview, None
+        return frame
+
+    async def get(self) -> Optional[dict]:
+        return await self.queue.get()
+
+
+class ProgressChannel:
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.subscribers: List[ProgressSubscriber] = []
+        self.state = "queued"
+        self.queue_msg: Optional[dict] = None
+        self.progress_msg: Optional[dict] = None
+        self.final: Optional[dict] = None
+        self.ended_at: Optional[float] = None
+        self.updated_at = time.time()
+        # Dernier passage d'un client (abonnement, désabonnement, /progress) ; None : jamais suivi
+        self.seen_at: Optional[float] = None
+
+    def apply(self, msg: dict):
+        kind = msg.get("type")
+        if kind == "queue":
+            self.queue_msg = msg
+        elif kind in ("progress", "status"):
+            self.state = "running"
+            self.queue_msg = None
+            if kind == "progress":
+                self.progress_msg = msg
+        elif kind in TERMINAL_MESSAGES:
+            if kind == "error":
+                self.state = "cancelled" if msg.get("cancelled") else "failed"
+            else:
+                self.state = "completed"
+            self.final = msg
+        self.updated_at = time.time()
+
+    def replay(self) -> List[dict]:
+        # Dernier état connu : position ou progression, puis le résultat final s'il existe
+        msgs = [m for m in (self.queue_msg, self.progress_msg) if m is not None]
+        if self.final is not None:
+            msgs.append(self.final)
+        return msgs
+
+
+class ProgressHub:
+
+    def __init__(self, max_channels: int, ttl: float, subscriber_queue: int):
+        self.max_channels = max_channels
+        self.ttl = ttl
+        self.subscriber_queue = subscriber_queue
+        self.channels: "OrderedDict[str, ProgressChannel]" = OrderedDict()
+        self._last_purge = time.monotonic()
+
+    def open(self, prompt_id: str) -> ProgressChannel:
+        ch = self.channels.get(prompt_id)
+        if ch is None:
+            ch = self.channels[prompt_id] = ProgressChannel(prompt_id)
+            self._prune()
+        return ch
+
+    def get(self, prompt_id: str) -> Optional[ProgressChannel]:
+        return self.channels.get(prompt_id)
+
+    def publish(self, prompt_id: str, msg: dict):
+        self.deliver(prompt_id, msg)
+        shared_state.publish(prompt_id, msg)
+
+    def end(self, prompt_id: str):
+        # Fin du flux : les abonnés ferment leur connexion après le dernier message
+        ch = self.channels.get(prompt_id)
+        if ch is None or ch.ended_at is not None:
+            return
+        self.deliver(prompt_id, None)
+        shared_state.publish(prompt_id, None)
+
+    def deliver(self, prompt_id: str, msg: Optional[dict]):
+        # Abonnés de ce process uniquement (message local, ou reçu d'un autre worker par l'état partagé)
+        if msg is None:
+            ch = self.channels.get(prompt_id)
+            if ch is not None and ch.ended_at is None:
+                ch.ended_at = time.time()
+                for sub in ch.subscribers:
+                    sub.offer(None)
+            return
+        ch = self.open(prompt_id)
+        ch.apply(msg)
+        for sub in ch.subscribers:
+            sub.offer(msg)
+
+    def discard(self, prompt_id: str):
+        ch = self.channels.pop(prompt_id, None)
+        if ch is not None:
+            for sub in ch.subscribers:
+                sub.offer(None)
+
+    def subscribe(self, prompt_id: str) -> ProgressSubscriber:
+        ch = self.open(prompt_id)
+        ch.seen_at = time.time()
+        sub = ProgressSubscriber(self.subscriber_queue)
+        for msg in ch.replay():
+            sub.offer(msg)
+        if ch.ended_at is not None:
+            sub.offer(None)
+        else:
+            ch.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, prompt_id: str, sub: ProgressSubscriber):
+        ch = self.channels.get(prompt_id)
+        if ch is not None and sub in ch.subscribers:
+            ch.subscribers.remove(sub)
+            ch.seen_at = time.time()
+
+    def touch(self, prompt_id: str):
+        ch = self.channels.get(prompt_id)
+        if ch is not None:
+            ch.seen_at = time.time()
+
+    def watched(self) -> Dict[str, float]:
+        # Jobs non terminés suivis par un client de ce worker : dernier passage (maintenant si abonné)
+        now = time.time()
+        return {prompt_id: now if ch.subscribers else ch.seen_at for prompt_id, ch in self.channels.items()
+                if ch.ended_at is None and ch.seen_at is not None}
+
+    def wants_preview(self, prompt_id: str) -> bool:
+        ch = self.channels.get(prompt_id)
+        return ch is not None and ch.ended_at is None and any(sub.wants_preview for sub in ch.subscribers)
+
+    def publish_preview(self, prompt_id: str, frame: bytes):
+        # Abonnés de ce process uniquement : les previews ne passent pas par l'état partagé
+        ch = self.channels.get(prompt_id)
+        if ch is None or ch.ended_at is not None:
+            return
+        for sub in ch.subscribers:
+            if sub.wants_preview:
+                sub.offer_preview(frame)
+
+    def subscriber_count(self) -> int:
+        return sum(len(ch.subscribers) for ch in self.channels.values())
+
+    def snapshot(self, prompt_id: str) -> Optional[dict]:
+        ch = self.channels.get(prompt_id)
+        if ch is None:
+            return None
+        progress = ch.progress_msg or {}
+        return {
+            "prompt_id": prompt_id,
+            "state": ch.state,
+            # Même forme que l'historique ComfyUI (le front lit status.completed)
+            "status": {"status_str": ch.state, "completed": ch.state in ("completed", "failed", "cancelled")},
+            "queue_position": ch.queue_msg["position"] if ch.queue_msg else None,
+            "queue_length": ch.queue_msg["queue_length"] if ch.queue_msg else None,
+            "queue_eta": ch.queue_msg.get("eta_wait") if ch.queue_msg else None,
+            "progress": {"value": progress.get("value", 0), "max_value": progress.get("max_value", 100),
+                         "node": progress.get("node"), "eta": progress.get("eta")} if progress else None,
+            "result": ch.final,
+            "subscribers": len(ch.subscribers),
+            "updated_at": ch.updated_at,
+        }
+
+    def _prune(self):
+        if time.monotonic() - self._last_purge > RESULT_STORE_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            now = time.time()
+            for prompt_id, ch in list(self.channels.items()):
+                if ch.ended_at is not None and now - ch.ended_at > self.ttl and not ch.subscribers:
+                    del self.channels[prompt_id]
+        while len(self.channels) > self.max_channels:
+            self.discard(next(iter(self.channels)))
+
+
+progress_hub = ProgressHub(PROGRESS_MAX_CHANNELS, RESULT_STORE_TTL, PROGRESS_SUBSCRIBER_QUEUE)
+
+# ---------------------------------------------------------------------
+# RÉSULTATS (métadonnées + fichier binaire)
+# ---------------------------------------------------------------------
+
+def build_output_message(prompt_id, file_info, media_type, source="comfyui", backend=None):
+    filename = file_info["filename"]
+    default_mime = "image/png" if media_type == "image" else "application/octet-stream"
+    backend = backend or (backend_pool.lookup(prompt_id) if source == "comfyui" else None)
+    return {
+        "type": "output",
+        "prompt_id": prompt_id,
+        "media_type": media_type,
+        "mime_type": mimetypes.guess_type(filename)[0] or default_mime,
+        "filename": filename,
+        "subfolder": file_info.get("subfolder", ""),
+        "folder_type": file_info.get("type", "output"),
+        "source": source,
+        "backend": backend.name if backend else None,
+        "url": f"/result/{prompt_id}/file",
+    }
+
+def build_outputs_message(prompt_id, files, media_type, backend=None):
+    # Plusieurs fichiers (batch_size > 1) : le premier reste à la racine, tous sont listés dans "items"
+    msg = build_output_message(prompt_id, files[0], media_type, backend=backend)
+    if len(files) > 1:
+        msg["items"] = []
+        for i, file_info in enumerate(files):
+            item = build_output_message(prompt_id, file_info, media_type, backend=backend)
+            msg["items"].append({
+                "mime_type": item["mime_type"],
+                "filename": item["filename"],
+                "subfolder": item["subfolder"],
+                "folder_type": item["folder_type"],
+                "url": f"/result/{prompt_id}/file?index={i}",
+            })
+    return msg
+
+def find_output_in_history(prompt_id, outputs):
+    for _, node_output in outputs.items():
+        if node_output.get("images"):
+            return build_outputs_message(prompt_id, node_output["images"], "image")
+        if node_output.get("gifs"):
+            return build_outputs_message(prompt_id, node_output["gifs"], "video")
+    return None
+
+def result_from_history(prompt_id, entry):
+    # Sortie retrouvée dans /history : le graphe soumis donne les paramètres de génération
+    result = find_output_in_history(prompt_id, entry.get("outputs", {}))
+    prompt = entry.get("prompt")
+    if result and isinstance(prompt, list) and len(prompt) > 2 and isinstance(prompt[2], dict):
+        result["generation"] = workflow_generation(prompt[2])
+    return result
+
+def output_location(msg) -> str:
+    return f"{msg.get('backend')}/{msg.get('folder_type')}/{msg.get('subfolder')}/{msg['filename']}"
+
+async def read_output_bytes(msg) -> bytes:
+    if msg.get("source") in ("local", "cache"):
+        path = os.path.join(IMAGES_DIR, msg["filename"]) if msg["source"] == "local" else output_cache.blob_path(msg["blob"])
+        if path is None:
+            raise FileNotFoundError(msg["blob"])
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, _read_file, path)
+
+    with timed("download"):
+        resp = await get_comfy_http().get(
+            f"{backend_pool.get(msg.get('backend')).url}/view",
+            params={"filename": msg["filename"], "subfolder": msg.get("subfolder", ""), "type": msg.get("folder_type", "output")}
+        )
+        resp.raise_for_status()
+    return resp.content
+
+async def with_inline_base64(msg):
+    # Ancien format (image_base64 dans le JSON), uniquement sur demande explicite
+    if msg.get("type") != "output" or "image_base64" in msg:
+        return msg
+    # Variante post-traitée si demandée, sinon la sortie brute
+    if msg.get("variant"):
+        blob = await result_variant_path(msg["prompt_id"], 0, msg, msg["variant"])
+    else:
+        blob = prompt_results.blob_path(msg["prompt_id"])
+    if blob:
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, _read_file, blob)
+    else:
+        data = await read_output_bytes(msg)
+        if msg.get("source") == "comfyui":
+            await prompt_results.put_blob(msg["prompt_id"], data)
+    with timed("encode"):
+        encoded = base64.b64encode(data).decode("utf-8")
+    return dict(msg, image_base64=encoded)
+
+async def publish_error(prompt_id: str, detail: str, cancelled: bool = False):
+    # L'erreur est gardée dans le cache pour /result et les reconnexions WS
+    error_msg = {"type": "error", "prompt_id": prompt_id, "detail": detail}
+    if cancelled:
+        error_msg["cancelled"] = True
+    output_variants.pop(prompt_id, None)
+    prompt_results.put(prompt_id, error_msg)
+    progress_hub.publish(prompt_id, error_msg)
+    journal.finish(prompt_id, error_msg)
+
+def publish_result(prompt_id: str, msg: dict):
+    # Message final : cache des résultats (/result), abonnés, journal
+    msg = with_variant_urls(msg, output_variants.pop(prompt_id, None))
+    if msg.get("type") == "output":
+        prompt_results.put(prompt_id, msg)
+    progress_hub.publish(prompt_id, msg)
+    journal.finish(prompt_id, msg)
+
+async def send_output(ws: WebSocket, msg):
+    if RESULT_INLINE_BASE64 or getattr(ws.state, "inline_base64", False):
+        msg = await with_inline_base64(msg)
+    await ws.send_json(msg)
+
+def parse_byte_range(header: str, total: int):
+    # Un seul intervalle "bytes=a-b" / "bytes=a-" / "bytes=-n" ; None = en-tête ignoré
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[6:].strip().partition("-")
+    try:
+        if start_s == "":
+            suffix = int(end_s)
+            start, end = max(0, total - suffix), total - 1
+            if suffix <= 0:
+                start = total
+        else:
+            start = int(start_s)
+            end = min(int(end_s), total - 1) if end_s else total - 1
+    except ValueError:
+        return None
+    if start >= total or start > end:
+        raise HTTPException(416, "Range non satisfaisable", headers={"Content-Range": f"bytes */{total}"})
+    return start, end
+
+async def stream_comfy_output(msg, range_header, etag):
+    client = get_comfy_http()
+    req = client.build_request(
+        "GET", f"{backend_pool.get(msg.get('backend')).url}/view",
+        params={"filename": msg["filename"], "subfolder": msg.get("subfolder", ""), "type": msg.get("folder_type", "output")},
+        headers={"Range": range_header} if range_header else {},
+    )
+    with timed("download_headers"):
+        upstream = await client.send(req, stream=True)
+    if upstream.status_code not in (200, 206):
+        await upstream.aclose()
+        raise HTTPException(status_code=404, detail="Fichier introuvable sur ComfyUI.")
+
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=31536000, immutable"}
+    status = upstream.status_code
+    length = upstream.headers.get("content-length")
+    length = int(length) if length is not None else None
+    skip, sliced = 0, False
+
+    if status == 206:
+        headers["Content-Range"] = upstream.headers.get("content-range", "")
+    elif range_header and length is not None:
+        # ComfyUI a ignoré le Range : on découpe nous-mêmes
+        try:
+            rng = parse_byte_range(range_header, length)
+        except HTTPException:
+            await upstream.aclose()
+            raise
+        if rng:
+            start, end = rng
+            skip, length, status, sliced = start, end - start + 1, 206, True
+            headers["Content-Range"] = f"bytes {start}-{end}/{upstream.headers['content-length']}"
+
+    if length is not None:
+        headers["Content-Length"] = str(length)
+
+    async def body():
+        to_skip, remaining = skip, (length if sliced else None)
+        try:
+            async for chunk in upstream.aiter_raw(RESULT_STREAM_CHUNK_SIZE):
+                if to_skip:
+                    if len(chunk) <= to_skip:
+                        to_skip -= len(chunk)
+                        continue
+                    chunk, to_skip = chunk[to_skip:], 0
+                if remaining is not None:
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                if chunk:
+                    yield chunk
+                if remaining == 0:
                     break
+        finally:
+            await upstream.aclose()
+
+    return StreamingResponse(body(), status_code=status, media_type=msg["mime_type"], headers=headers)
+
+# ---------------------------------------------------------------------
+# WEBSOCKET COMFYUI PARTAGÉ (multiplexé par prompt_id)
+# ---------------------------------------------------------------------
+
+class ComfyEventRouter:
+    # Une seule connexion WS longue durée vers ComfyUI (client_id du bridge).
+    # Chaque évènement est routé vers la file du job correspondant (prompt_id).
+
+    def __init__(self, ws_url: str, client_id: str, backend=None):
+        self.ws_url = ws_url
+        self.client_id = client_id
+        self.backend = backend
+        self.subscribers: Dict[str, asyncio.Queue] = {}
+        self.pending: Dict[str, deque] = {}
+        self.pending_since: Dict[str, float] = {}
+        self.connected = asyncio.Event()
+        self._current_prompt: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, prompt_id: str) -> asyncio.Queue:
+        queue = self.subscribers.get(prompt_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self.subscribers[prompt_id] = queue
+        # Rejoue les évènements arrivés avant l'abonnement
+        for msg in self.pending.pop(prompt_id, ()):
+            queue.put_nowait(msg)
+        self.pending_since.pop(prompt_id, None)
+        return queue
+
+    def unsubscribe(self, prompt_id: str):
+        self.subscribers.pop(prompt_id, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.connected.clear()
+
+    async def _run(self):
+        delay = WS_RECONNECT_MIN_DELAY
+        first = True
+        while True:
+            try:
+                async with websockets.connect(f"{self.ws_url}?clientId={self.client_id}", max_size=None) as ws:
+                    self.connected.set()
+                    delay = WS_RECONNECT_MIN_DELAY
+                    if DEBUG:
+                        print(f"[WS] Connecté à {self.ws_url} (clientId={self.client_id})")
+                    if not first:
+                        await self._resync()
+                    first = False
+                    async for raw in ws:
+                        self._dispatch(raw)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if DEBUG:
+                    print(f"[WS] Connexion ComfyUI perdue ({e}), reconnexion dans {delay:.1f}s")
+            self.connected.clear()
+            self._current_prompt = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+
+    def _dispatch(self, raw):
+        # Frames binaires : previews latentes, relayées à part (jamais dans la file du job)
+        if isinstance(raw, (bytes, bytearray)):
+            self._dispatch_binary(raw)
+            return
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            return
+
+        data = msg.get("data") or {}
+        prompt_id = data.get("prompt_id")
+
+        if msg.get("type") == "executing":
+            self._current_prompt = prompt_id if data.get("node") is not None else None
+        elif msg.get("type") == "progress" and prompt_id is None:
+            # Anciennes versions de ComfyUI : pas de prompt_id dans "progress"
+            prompt_id = self._current_prompt
+
+        if prompt_id:
+            self._route(prompt_id, msg)
+
+    def _dispatch_binary(self, raw: bytes):
+        # Type d'évènement (uint32 big-endian), puis :
+        #   1 PREVIEW_IMAGE               : format (1 JPEG, 2 PNG) + image ; job = prompt en cours d'exécution
+        #   4 PREVIEW_IMAGE_WITH_METADATA : longueur + JSON (prompt_id, image_type...) + image
+        # Les autres (texte de progression...) sont ignorés.
+        if len(raw) < 8:
+            return
+        event, header = struct.unpack(">II", raw[:8])
+        if event == 1:
+            prompt_id, image_type, image = self._current_prompt, header, raw[8:]
+        elif event == 4:
+            try:
+                meta = json.loads(raw[8:8 + header])
+            except ValueError:
+                return
+            image_type = 2 if meta.get("image_type") == "image/png" else 1
+            prompt_id, image = meta.get("prompt_id") or self._current_prompt, raw[8 + header:]
+        else:
+            return
+        if prompt_id and image:
+            preview_relay.offer(prompt_id, bytes(image), image_type)
+
+    def _route(self, prompt_id: str, msg: dict):
+        queue = self.subscribers.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(msg)
+            return
+
+        now = time.monotonic()
+        for pid, since in list(self.pending_since.items()):
+            if now - since > WS_PENDING_TTL:
+                self.pending.pop(pid, None)
+                self.pending_since.pop(pid, None)
+
+        if prompt_id not in self.pending:
+            self.pending[prompt_id] = deque(maxlen=WS_PENDING_MAX_EVENTS)
+            self.pending_since[prompt_id] = now
+        self.pending[prompt_id].append(msg)
+
+    def notify_done(self, prompt_id: str):
+        # Fin de job constatée dans /history : même évènement que la fin d'exécution ComfyUI
+        self._route(prompt_id, {
+            "type": "executing",
+            "data": {"node": None, "prompt_id": prompt_id}
+        })
+
+    def cancel(self, prompt_id: str, reason: str):
+        # Annulation décidée par le bridge : le stream du job s'arrête sans attendre ComfyUI
+        self._route(prompt_id, {
+            "type": "bridge_cancelled",
+            "data": {"prompt_id": prompt_id, "reason": reason}
+        })
+
+    async def _resync(self):
+        # Jobs terminés pendant la coupure : on relit /history
+        for prompt_id in list(self.subscribers):
+            history = await get_history(prompt_id, self.backend)
+            if prompt_id in history:
+                self.notify_done(prompt_id)
+
+
+# ---------------------------------------------------------------------
+# PREVIEWS LATENTES (frames binaires ComfyUI -> clients WS)
+# ---------------------------------------------------------------------
+
+
+
+class PreviewRelay:
+    # Au plus une preview par intervalle et par job : une image arrivée entre-temps remplace celle en attente
+    # (la plus récente gagne). Rien n'est décodé si aucun client ne regarde.
+    # Les frames relayées gardent le format ComfyUI : struct ">II" (1 = PREVIEW_IMAGE, 1 JPEG / 2 PNG) + image.
+
+    def __init__(self, interval: float, max_size: int, quality: int):
+        self.interval = interval
+        self.max_size = max_size
+        self.quality = quality
+        self.pending: Dict[str, tuple] = {}
+        self.last_sent: Dict[str, float] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def offer(self, prompt_id: str, image: bytes, image_type: int):
+        if not progress_hub.wants_preview(prompt_id):
+            previews_total.inc("unwatched")
+            return
+        if prompt_id in self.pending:
+            previews_total.inc("coalesced")
+        self.pending[prompt_id] = (image, image_type)
+        if prompt_id not in self.tasks:
+            self.tasks[prompt_id] = asyncio.create_task(self._pump(prompt_id))
+
+    async def _pump(self, prompt_id: str):
+        loop = asyncio.get_event_loop()
+        try:
+            while prompt_id in self.pending:
+                wait = self.last_sent.get(prompt_id, 0.0) + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                image, image_type = self.pending.pop(prompt_id, (None, None))
+                if image is None:
+                    return
+                # Sans Pillow, la preview ComfyUI part telle quelle
+                if Image is not None:
+                    try:
+                        with timed("preview"):
+                            image = await loop.run_in_executor(get_image_pool(), render_preview, image,
+                                                               self.max_size, self.quality)
+                        image_type = 1
+                    except Exception as e:
+                        previews_total.inc("failed")
+                        if DEBUG:
+                            print(f"Preview illisible pour {prompt_id}: {e}")
+                        continue
+                ch = progress_hub.get(prompt_id)
+                if ch is None or ch.ended_at is not None:
+                    return
+                self.last_sent[prompt_id] = time.monotonic()
+                progress_hub.publish_preview(prompt_id, struct.pack(">II", 1, image_type) + image)
+                previews_total.inc("sent")
+        finally:
+            self.tasks.pop(prompt_id, None)
+
+    def forget(self, prompt_id: str):
+        self.pending.pop(prompt_id, None)
+        self.last_sent.pop(prompt_id, None)
+
+
+preview_relay = PreviewRelay(PREVIEW_MIN_INTERVAL, PREVIEW_MAX_SIZE, PREVIEW_QUALITY)
+
+# ---------------------------------------------------------------------
+# POOL DE BACKENDS COMFYUI (routage selon la charge et les checkpoints)
+# ---------------------------------------------------------------------
+
+class ComfySchema:
+    # /object_info d'un backend, indexé pour les listes de valeurs et la validation locale des workflows
+
+    def __init__(self, info: dict, etag: str):
+        self.etag = etag
+        self.nodes: Dict[str, dict] = {}
+        for class_type, node in info.items():
+            inputs = node.get("input") or {}
+            self.nodes[class_type] = {
+                "required": inputs.get("required") or {},
+                "optional": inputs.get("optional") or {},
+                "output_node": bool(node.get("output_node")),
+            }
+
+    @staticmethod
+    def _spec(spec):
+        # ["INT", {...}] / [[valeurs...], {...}] / ["COMBO", {"options": [...]}]
+        kind = spec[0] if isinstance(spec, (list, tuple)) and spec else None
+        options = spec[1] if isinstance(spec, (list, tuple)) and len(spec) > 1 and isinstance(spec[1], dict) else {}
+        if kind == "COMBO":
+            kind = list(options.get("options", []))
+        return kind, options
+
+    def enum(self, class_type: str, name: str) -> list:
+        node = self.nodes.get(class_type)
+        if node is None:
+            return []
+        kind, _ = self._spec(node["required"].get(name) or node["optional"].get(name))
+        return list(kind) if isinstance(kind, list) else []
+
+    def validate(self, workflow: dict) -> List[str]:
+        errors = []
+        has_output = False
+        for node_id, node in workflow.items():
+            class_type = node.get("class_type") if isinstance(node, dict) else None
+            schema = self.nodes.get(class_type)
+            if schema is None:
+                errors.append(f"Nœud {node_id}: classe inconnue '{class_type}'")
+                continue
+            has_output = has_output or schema["output_node"]
+            inputs = node.get("inputs") or {}
+            for name, spec in schema["required"].items():
+                if name not in inputs:
+                    errors.append(f"Nœud {node_id} ({class_type}): entrée requise '{name}' manquante")
+                else:
+                    self._check(node_id, class_type, name, spec, inputs[name], workflow, errors)
+            for name, spec in schema["optional"].items():
+                if name in inputs:
+                    self._check(node_id, class_type, name, spec, inputs[name], workflow, errors)
+            if len(errors) >= VALIDATION_MAX_ERRORS:
+                return errors
+        if not has_output and not errors:
+            errors.append("Aucun nœud de sortie dans le workflow")
+        return errors
+
+    def _check(self, node_id, class_type, name, spec, value, workflow, errors):
+        if isinstance(value, list):
+            # Lien [id du nœud source, index de sortie]
+            if len(value) != 2 or str(value[0]) not in workflow:
+                errors.append(f"Nœud {node_id} ({class_type}): lien invalide pour '{name}'")
+            return
+        kind, options = self._spec(spec)
+        if isinstance(kind, list):
+            # Images d'entrée : envoyées à ComfyUI juste avant la soumission, absentes de la liste
+            if kind and value not in kind and not options.get("image_upload"):
+                errors.append(f"Nœud {node_id} ({class_type}): valeur '{value}' invalide pour '{name}'")
+        elif kind in ("INT", "FLOAT"):
+            try:
+                number = int(value) if kind == "INT" else float(value)
+            except (TypeError, ValueError):
+                errors.append(f"Nœud {node_id} ({class_type}): '{name}' doit être un nombre ({kind})")
+                return
+            if "min" in options and number < options["min"]:
+                errors.append(f"Nœud {node_id} ({class_type}): '{name}'={value} inférieur au minimum {options['min']}")
+            elif "max" in options and number > options["max"]:
+                errors.append(f"Nœud {node_id} ({class_type}): '{name}'={value} supérieur au maximum {options['max']}")
+
+
+class ComfyBackend:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.events = ComfyEventRouter(url.replace("http", "ws", 1) + "/ws", BRIDGE_CLIENT_ID, self)
+        self.healthy = False
+        self.queue_depth = 0
+        self.external_depth = 0
+        self.inflight = 0
+        self.dispatched = 0
+        self.checkpoints: Optional[set] = None
+        self.schema: Optional[ComfySchema] = None
+        self.schema_at = 0.0
+        self.last_error: Optional[str] = None
+        # Modèles (checkpoints + VAE) du dernier job envoyé : ceux qui resteront chargés après la file
+        self.loaded: frozenset = frozenset()
+        self.model_switches = 0
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.events.connected.is_set()
+
+    def load(self) -> int:
+        # Jobs des autres clients ComfyUI + nos jobs en cours sur ce backend
+        return self.external_depth + self.inflight
+
+    def has_checkpoints(self, names) -> bool:
+        # Liste inconnue (object_info pas encore lu) : on ne filtre pas
+        return self.checkpoints is None or all(n in self.checkpoints for n in names)
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "ws_connected": self.events.connected.is_set(),
+            "queue_depth": self.queue_depth,
+            "inflight": self.inflight,
+            "dispatched": self.dispatched,
+            "checkpoints": sorted(self.checkpoints) if self.checkpoints is not None else None,
+            "schema_etag": self.schema.etag if self.schema else None,
+            "loaded_models": sorted(self.loaded),
+            "model_switches": self.model_switches,
+            "last_error": self.last_error,
+        }
+
+
+class BackendPool:
+    PROMPT_MAP_MAX = 10000
+
+    def __init__(self, urls):
+        self.backends = [ComfyBackend(f"comfy{i}", url) for i, url in enumerate(urls)]
+        self.by_name = {b.name: b for b in self.backends}
+        self.default = self.backends[0]
+        self.prompt_backends: "OrderedDict[str, str]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, name: Optional[str]) -> ComfyBackend:
+        return self.by_name.get(name) or self.default
+
+    def remember(self, prompt_id: str, backend: ComfyBackend):
+        self.prompt_backends[prompt_id] = backend.name
+        self.prompt_backends.move_to_end(prompt_id)
+        while len(self.prompt_backends) > self.PROMPT_MAP_MAX:
+            self.prompt_backends.popitem(last=False)
+
+    def lookup(self, prompt_id: str) -> Optional[ComfyBackend]:
+        name = self.prompt_backends.get(prompt_id)
+        return self.by_name.get(name) if name else None
+
+    def all_checkpoints(self):
+        names = set()
+        for b in self.backends:
+            if b.healthy and b.checkpoints:
+                names |= b.checkpoints
+        return sorted(names)
+
+    def catalog(self, class_type: str, name: str) -> list:
+        # Union des valeurs proposées par les backends sains (schéma en mémoire)
+        values = set()
+        for b in self.backends:
+            if b.healthy and b.schema:
+                values.update(v for v in b.schema.enum(class_type, name) if isinstance(v, str))
+        return sorted(values)
+
+    def validate(self, workflow: dict) -> List[str]:
+        # Valide si au moins un backend accepte le graphe ; sans schéma connu, ComfyUI tranchera
+        first_errors = None
+        for b in self.backends:
+            if b.schema is None:
+                continue
+            errors = b.schema.validate(workflow)
+            if not errors:
+                return []
+            first_errors = first_errors or errors
+        return first_errors or []
+
+    def supports(self, checkpoints) -> bool:
+        return any(b.has_checkpoints(checkpoints) for b in self.backends)
+
+    def choose(self, checkpoints=(), max_inflight: Optional[int] = None, models=()) -> Optional[ComfyBackend]:
+        # Backend sain le moins chargé, qui possède les checkpoints et a un slot libre ;
+        # à charge égale, celui qui a déjà les modèles chargés
+        candidates = [
+            b for b in self.backends
+            if b.available and b.has_checkpoints(checkpoints)
+            and (max_inflight is None or b.inflight < max_inflight)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.load(), not (models and b.loaded.issuperset(models)), b.dispatched))
+
+    def choose_loaded(self, models, max_inflight: Optional[int] = None) -> Optional[ComfyBackend]:
+        # Backend libre sur lequel ces modèles sont déjà chargés (pas de rechargement)
+        if not models:
+            return None
+        candidates = [
+            b for b in self.backends
+            if b.available and b.loaded.issuperset(models)
+            and (max_inflight is None or b.inflight < max_inflight)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.load(), b.dispatched))
+
+    def start(self):
+        for b in self.backends:
+            b.events.start()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for b in self.backends:
+            await b.events.stop()
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.gather(*(self._poll(b) for b in self.backends))
+            scheduler.wakeup()
+            await asyncio.sleep(BACKEND_POLL_INTERVAL)
+
+    async def _refresh_schema(self, backend: ComfyBackend):
+        # /object_info complet (plusieurs Mo avec des nœuds custom) : décodé hors boucle, seulement s'il a changé
+        resp = await get_comfy_http().get(f"{backend.url}/object_info")
+        resp.raise_for_status()
+        etag = hashlib.sha1(resp.content).hexdigest()[:16]
+        if backend.schema is None or backend.schema.etag != etag:
+            loop = asyncio.get_event_loop()
+            backend.schema = await loop.run_in_executor(None, lambda: ComfySchema(json.loads(resp.content), etag))
+            backend.checkpoints = set(backend.schema.enum(NODE_TYPE_CHECKPOINT, "ckpt_name"))
+        backend.schema_at = time.monotonic()
+
+    async def _poll(self, backend: ComfyBackend):
+        try:
+            resp = await get_comfy_http().get(f"{backend.url}/queue", timeout=COMFY_HTTP_CONNECT_TIMEOUT)
+            resp.raise_for_status()
+            queue = resp.json()
+            entries = queue.get("queue_running", []) + queue.get("queue_pending", [])
+            backend.queue_depth = len(entries)
+            backend.external_depth = sum(
+                1 for e in entries
+                if len(e) > 3 and isinstance(e[3], dict) and e[3].get("client_id") != BRIDGE_CLIENT_ID
+            )
+            if backend.schema is None or time.monotonic() - backend.schema_at > OBJECT_INFO_REFRESH:
+                await self._refresh_schema(backend)
+            backend.healthy = True
+            backend.last_error = None
+        except Exception as e:
+            if backend.healthy and DEBUG:
+                print(f"[BACKEND] {backend.name} ({backend.url}) indisponible: {e}")
+            backend.healthy = False
+            backend.last_error = str(e) or e.__class__.__name__
+
+
+def workflow_checkpoints(workflow: dict):
+    return sorted({
+        node["inputs"]["ckpt_name"]
+        for node in workflow.values()
+        if isinstance(node, dict) and node.get("class_type") == NODE_TYPE_CHECKPOINT
+        and isinstance(node.get("inputs", {}).get("ckpt_name"), str)
+    })
+
+
+def workflow_models(workflow: dict):
+    # Poids chargés par ComfyUI pour ce graphe : checkpoints + VAE séparés
+    vaes = {
+        node["inputs"]["vae_name"]
+        for node in workflow.values()
+        if isinstance(node, dict) and node.get("class_type") == NODE_TYPE_VAE
+        and isinstance(node.get("inputs", {}).get("vae_name"), str)
+    }
+    return tuple(workflow_checkpoints(workflow) + sorted(vaes))
+
+
+def workflow_generation(workflow: dict) -> dict:
+    # Paramètres lisibles de la génération (prompt, seed...) : premier sampler du graphe et ses entrées
+    info = {}
+    samplers = [k for k, n in workflow.items() if isinstance(n, dict) and str(n.get("class_type", "")).startswith("KSampler")]
+    if not samplers:
+        return info
+    inputs = workflow[min(samplers, key=lambda k: (len(k), k))].get("inputs", {})
+    for field, name in (("seed", "seed"), ("noise_seed", "seed"), ("steps", "steps"), ("cfg", "cfg"),
+                        ("sampler_name", "sampler"), ("scheduler", "scheduler")):
+        if isinstance(inputs.get(field), (int, float, str)):
+            info[name] = inputs[field]
+    for field, name in (("positive", "prompt"), ("negative", "negative_prompt")):
+        link = inputs.get(field)
+        text = workflow.get(str(link[0]), {}).get("inputs", {}).get("text") if isinstance(link, list) and link else None
+        if isinstance(text, str):
+            info[name] = text
+    model = inputs.get("model")
+    ckpt = workflow.get(str(model[0]), {}).get("inputs", {}).get("ckpt_name") if isinstance(model, list) and model else None
+    checkpoints = workflow_checkpoints(workflow)
+    if isinstance(ckpt, str) or checkpoints:
+        info["checkpoint"] = ckpt if isinstance(ckpt, str) else checkpoints[0]
+    return info
+
+
+backend_pool = BackendPool(COMFYUI_BACKENDS)
+
+# ---------------------------------------------------------------------
+# PROGRESSION GLOBALE ET ETA (durées apprises par profil de job)
+# ---------------------------------------------------------------------
+
+def workflow_profile(workflow: dict, workflow_name: Optional[str] = None) -> tuple:
+    # Ce qui fait varier la durée d'exécution : graphe, modèle, steps, résolution
+    info = workflow_generation(workflow)
+    width = height = None
+    for node in workflow.values():
+        if isinstance(node, dict) and str(node.get("class_type", "")).startswith("Empty") \
+                and "Latent" in str(node.get("class_type", "")):
+            inputs = node.get("inputs", {})
+            if isinstance(inputs.get("width"), int) and isinstance(inputs.get("height"), int):
+                width, height = inputs["width"], inputs["height"]
+                break
+    steps = info.get("steps") if isinstance(info.get("steps"), int) else None
+    return (workflow_name or "", info.get("checkpoint") or "", steps, width, height)
+
+def profile_work(profile: tuple) -> Optional[float]:
+    # Volume de calcul relatif (steps x pixels) : transpose une durée connue à un autre réglage
+    _, _, steps, width, height = profile
+    if not steps or not width or not height:
+        return None
+    return steps * width * height
+
+def heuristic_node_seconds(node: dict) -> float:
+    # Poids par défaut d'un nœud tant qu'aucune exécution du profil n'a été mesurée
+    kind = str(node.get("class_type", ""))
+    inputs = node.get("inputs", {})
+    if "Sampler" in kind:
+        steps = inputs.get("steps") if isinstance(inputs.get("steps"), int) else 20
+        start, end = inputs.get("start_at_step"), inputs.get("end_at_step")
+        if isinstance(start, int) and isinstance(end, int):
+            steps = max(1, min(end, steps) - start)
+        return 0.1 * steps
+    if kind.startswith(("VAEDecode", "VAEEncode")):
+        return 0.5
+    if "Loader" in kind:
+        return 1.0
+    if kind.startswith(("Save", "Preview")):
+        return 0.2
+    return 0.05
+
+
+class EtaModel:
+    # Moyennes mobiles des durées d'exécution par profil (workflow, checkpoint, steps, résolution) :
+    # durée totale et durée de chaque nœud exécuté. Sert aux poids de la progression, à l'ETA
+    # et à l'attente prévue des jobs en file. Gardé sur disque d'un démarrage à l'autre.
+
+    def __init__(self, path: str, max_profiles: int):
+        self.path = path
+        self.max_profiles = max_profiles
+        self.profiles: "OrderedDict[str, dict]" = OrderedDict()
+        # Index par workflow (clé -> profil déjà décodé), dans l'ordre de self.profiles : predict()
+        # ne parcourt que les profils du même workflow, sans relire les clés JSON
+        self.by_workflow: Dict[str, "OrderedDict[str, tuple]"] = {}
+        self.observations = 0
+        self.unsaved = 0
+
+    @staticmethod
+    def key(profile: tuple) -> str:
+        return json.dumps(profile)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.profiles = OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            self.profiles = OrderedDict()
+        self.by_workflow = {}
+        for key in self.profiles:
+            self._index(key, tuple(json.loads(key)))
+
+    def _index(self, key: str, profile: tuple):
+        index = self.by_workflow.setdefault(profile[0], OrderedDict())
+        index.pop(key, None)
+        index[key] = profile
+
+    def _unindex(self, key: str):
+        workflow = json.loads(key)[0]
+        index = self.by_workflow.get(workflow)
+        if index is not None:
+            index.pop(key, None)
+            if not index:
+                del self.by_workflow[workflow]
+
+    def snapshot(self) -> bytes:
+        # Sérialisé sur la boucle (le dict change entre deux jobs), écrit ensuite hors boucle
+        self.unsaved = 0
+        return json.dumps(self.profiles).encode("utf-8")
+
+    def get(self, profile: tuple) -> Optional[dict]:
+        return self.profiles.get(self.key(profile))
+
+    def predict(self, profile: tuple) -> Optional[float]:
+        # Profil connu ; sinon même workflow à un autre réglage, ramené au volume de calcul
+        entry = self.get(profile)
+        if entry is not None:
+            return entry["total"]
+        work = profile_work(profile)
+        if work is None:
+            return None
+        rates = []
+        for key, other in reversed(self.by_workflow.get(profile[0], {}).items()):
+            other_work = profile_work(other)
+            if other_work:
+                rates.append(self.profiles[key]["total"] / other_work)
+                if len(rates) >= 20:
+                    break
+        return statistics.median(rates) * work if rates else None
+
+    def default(self) -> Optional[float]:
+        # Aucun indice sur le job : durée médiane des profils récents
+        totals = [e["total"] for e in itertools.islice(reversed(self.profiles.values()), 50)]
+        return statistics.median(totals) if totals else None
+
+    def node_weights(self, profile: tuple, workflow: dict) -> Dict[str, float]:
+        entry = self.get(profile)
+        if entry is not None and entry["nodes"]:
+            return dict(entry["nodes"])
+        weights = {nid: heuristic_node_seconds(node) for nid, node in workflow.items() if isinstance(node, dict)}
+        # Durée prévue connue (autre réglage du même workflow) : les poids heuristiques y sont ramenés
+        predicted = self.predict(profile)
+        total = sum(weights.values())
+        if predicted and total:
+            weights = {nid: w * predicted / total for nid, w in weights.items()}
+        return weights
+
+    def observe(self, profile: tuple, nodes: Dict[str, float], total: float):
+        key = self.key(profile)
+        entry = self.profiles.pop(key, None)
+        if entry is None:
+            entry = {"total": total, "nodes": dict(nodes), "n": 0}
+        else:
+            entry["total"] += ETA_ALPHA * (total - entry["total"])
+            for nid, seconds in nodes.items():
+                old = entry["nodes"].get(nid)
+                entry["nodes"][nid] = seconds if old is None else old + ETA_ALPHA * (seconds - old)
+        entry["n"] += 1
+        self.profiles[key] = entry
+        self._index(key, tuple(profile))
+        while len(self.profiles) > self.max_profiles:
+            evicted, _ = self.profiles.popitem(last=False)
+            self._unindex(evicted)
+        self.observations += 1
+        self.unsaved += 1
+
+    def stats(self) -> dict:
+        return {"profiles": len(self.profiles), "observations": self.observations}
+
+
+eta_model = EtaModel(os.path.join(JOURNAL_DIR, "eta.json"), ETA_MAX_PROFILES)
+
+
+class ProgressTracker:
+    # Progression globale d'une exécution ComfyUI : chaque nœud compte selon sa durée habituelle,
+    # le pourcentage ne recule jamais. Les messages sont espacés d'au moins min_interval ;
+    # le dernier état retenu part à la fin de l'intervalle.
+
+    def __init__(self, prompt_id: str, workflow: dict, weights: Dict[str, float], min_interval: float):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.weights = weights
+        self.total = sum(weights.values()) or 1.0
+        self.min_interval = min_interval
+        self.started_at = time.monotonic()
+        self.done = 0.0
+        self.done_actual = 0.0
+        self.current: Optional[str] = None
+        self.current_started = 0.0
+        self.value = 0
+        self.max_value = 1
+        self.percent = 0.0
+        self.durations: Dict[str, float] = {}
+        self.cached_nodes: List[str] = []
+        self.last_sent = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def cached(self, nodes: List[str]):
+        # Nœuds repris du cache ComfyUI : ils ne s'exécuteront pas
+        for nid in nodes:
+            self.cached_nodes.append(nid)
+            self.total -= self.weights.pop(nid, 0.0)
+        self.total = max(self.total, 1e-6)
+        self.update()
+
+    def executing(self, node: str):
+        now = time.monotonic()
+        self._close(now)
+        if node not in self.weights:
+            self.weights[node] = heuristic_node_seconds(self.workflow.get(node, {}))
+            self.total += self.weights[node]
+        self.current, self.current_started = node, now
+        self.value, self.max_value = 0, 1
+        self.update()
+
+    def step(self, value: int, max_value: int):
+        self.value, self.max_value = value, max(1, max_value)
+        self.update()
+
+    def finish(self):
+        self._close(time.monotonic())
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _close(self, now: float):
+        if self.current is None:
+            return
+        self.durations[self.current] = now - self.current_started
+        self.done += self.weights.get(self.current, 0.0)
+        self.done_actual += now - self.current_started
+        self.current = None
+
+    def message(self) -> dict:
+        now = time.monotonic()
+        weight = self.weights.get(self.current, 0.0) if self.current else 0.0
+        fraction = min(1.0, self.value / self.max_value)
+        self.percent = max(self.percent, min(99.0, 100.0 * (self.done + weight * fraction) / self.total))
+
+        # Rythme réel du job par rapport aux durées habituelles, puis nœud courant mesuré en direct
+        speed = min(4.0, max(0.25, self.done_actual / self.done)) if self.done > 0.5 else 1.0
+        elapsed = now - self.current_started if self.current else 0.0
+        if self.current and fraction >= 0.1:
+            current_left = elapsed / fraction * (1 - fraction)
+        else:
+            current_left = max(0.0, weight * speed - elapsed)
+        eta = max(0.0, self.total - self.done - weight) * speed + current_left
+
+        return {
+            "type": "progress",
+            "value": round(self.percent, 1),
+            "max_value": 100,
+            "node": self.current,
+            "node_value": self.value,
+            "node_max": self.max_value,
+            "eta": round(eta, 1),
+            "elapsed": round(now - self.started_at, 1),
+        }
+
+    def update(self):
+        now = time.monotonic()
+        wait = self.last_sent + self.min_interval - now
+        if wait <= 0:
+            self._send()
+        else:
+            progress_messages_total.inc("coalesced")
+            if self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(wait, self._send)
+
+    def _send(self):
+        self._timer = None
+        self.last_sent = time.monotonic()
+        progress_messages_total.inc("sent")
+        progress_hub.publish(self.prompt_id, self.message())
+
+
+def observe_execution(profile: tuple, durations: Dict[str, float], total: float):
+    eta_model.observe(profile, durations, total)
+    if eta_model.unsaved >= ETA_SAVE_EVERY:
+        asyncio.get_event_loop().run_in_executor(None, _write_file, eta_model.path, eta_model.snapshot())
+
+
+def predicted_waits(queued: List["BridgeJob"], inflight: List["BridgeJob"]) -> List[Optional[float]]:
+    # Attente prévue de chaque job en file, avec les durées apprises. ComfyUI exécute un prompt à la fois :
+    # chaque backend est libre après ses jobs soumis ; un job en file part sur le premier backend libre.
+    # Inconnue tant qu'aucune exécution n'a été mesurée.
+    # Une prédiction par profil et par appel : une file de lots répète souvent le même profil
+    fallback = eta_model.default()
+    predicted: Dict[tuple, Optional[float]] = {}
+    def duration(job):
+        if job.profile not in predicted:
+            predicted[job.profile] = eta_model.predict(job.profile) or fallback
+        return predicted[job.profile]
+    now = time.monotonic()
+    busy = {b.name: 0.0 for b in backend_pool.backends if b.available}
+    started: Dict[str, float] = {}
+    for job in inflight:
+        d = duration(job)
+        if d is None:
+            return [None] * len(queued)
+        name = job.backend.name if job.backend else ""
+        busy[name] = busy.get(name, 0.0) + d
+        started[name] = min(started.get(name, now), job.dispatched_at or now)
+    slots = [max(0.0, t - (now - started.get(name, now))) for name, t in busy.items()] or [0.0]
+    heapq.heapify(slots)
+    waits = []
+    for job in queued:
+        d = duration(job)
+        if d is None:
+            return waits + [None] * (len(queued) - len(waits))
+        start = heapq.heappop(slots)
+        waits.append(round(start, 1))
+        heapq.heappush(slots, start + d)
+    return waits
+
+# ---------------------------------------------------------------------
+# 🚀 run_prompt_and_stream AVEC PROGRESSION ACTIVÉE
+# ---------------------------------------------------------------------
+
+async def run_prompt_and_stream(prompt_id, client_id, prompt_workflow, backend=None, submitted_at=None, profile=None):
+    backend = backend or backend_pool.lookup(prompt_id) or backend_pool.default
+    events = backend.events.subscribe(prompt_id)
+    submitted_at = submitted_at or time.monotonic()
+    started_at = None
+    profile = profile or workflow_profile(prompt_workflow)
+    tracker = ProgressTracker(prompt_id, prompt_workflow, eta_model.node_weights(profile, prompt_workflow),
+                              PROGRESS_MIN_INTERVAL)
+    try:
+        while True:
+            # Le timeout d'exécution démarre avec le job, pas à la soumission
+            if started_at is None:
+                timeout = MAX_QUEUE_WAIT_TIME
+            else:
+                timeout = max(0.0, started_at + MAX_WAIT_TIME - time.monotonic())
+            msg = await asyncio.wait_for(events.get(), timeout=timeout)
+
+            if started_at is None and msg.get("type") in ("execution_start", "execution_cached", "executing", "progress"):
+                started_at = tracker.started_at = time.monotonic()
+                stage_seconds.observe("comfy_queue_wait", started_at - submitted_at)
+
+            # Annulation demandée au bridge (DELETE /jobs/{id}, client parti)
+            if msg.get("type") == "bridge_cancelled":
+                raise JobCancelled(msg["data"]["reason"])
+
+            # Erreur d'exécution côté ComfyUI
+            if msg.get("type") in ("execution_error", "execution_interrupted"):
+                raise RuntimeError(msg["data"].get("exception_message") or "Exécution interrompue par ComfyUI")
+
+            # -------------------------------------------
+            # MESSAGES DE PROGRESSION (pourcentage global, espacés)
+            # -------------------------------------------
+
+            # Nœuds repris du cache ComfyUI : retirés du total
+            if msg.get("type") == "execution_cached":
+                tracker.cached(msg["data"].get("nodes") or [])
+
+            # Steps du nœud en cours
+            if msg.get("type") == "progress":
+                tracker.step(msg["data"].get("value", 0), msg["data"].get("max", 100))
+
+            # Nœud suivant : la progression globale continue (plus de retour à 0)
+            if msg.get("type") == "executing" and msg["data"].get("node") is not None:
+                tracker.executing(msg["data"]["node"])
+
+            # -------------------------------------------
+            # 💡 FIN DU WORKFLOW (node == null)
+            # -------------------------------------------
+            if msg.get("type") == "executing" and msg["data"].get("node") is None:
+                tracker.finish()
+                if started_at is not None:
+                    stage_seconds.observe("execution", time.monotonic() - started_at)
+                    if tracker.durations:
+                        observe_execution(profile, tracker.durations, time.monotonic() - started_at)
+
+                history = await get_history(prompt_id, backend)
+                outputs = history.get(prompt_id, {}).get("outputs", {})
+
+                save_id = NODE_IDS.get("SAVE_IMAGE_T2I")
+
+                # Détection du mode SDXL (présence du Refiner Loader)
+                if NODE_IDS.get("SDXL_REFINER_LOADER") in prompt_workflow and \
+                    prompt_workflow[NODE_IDS["SDXL_REFINER_LOADER"]].get("class_type") == NODE_TYPE_CHECKPOINT:
+                    save_id = NODE_IDS.get("SAVE_IMAGE_SDXL")
+
+                # Fallback si ID invalide
+                if save_id not in outputs:
+                    save_id = find_save_image_node_id(prompt_workflow, outputs)
+
+                final_msg = {"type": "final_result", "prompt_id": prompt_id}
+
+                # Image
+                if save_id and outputs.get(save_id, {}).get("images"):
+                    final_msg = build_outputs_message(prompt_id, outputs[save_id]["images"], "image", backend=backend)
+
+                # Vidéo / GIF
+                if save_id and outputs.get(save_id, {}).get("gifs"):
+                    final_msg = build_outputs_message(prompt_id, outputs[save_id]["gifs"], "video", backend=backend)
+
+                if final_msg["type"] == "output":
+                    final_msg["generation"] = workflow_generation(prompt_workflow)
+                    await prerender_variants(prompt_id, final_msg)
+
+                # Envoi au client (URL + métadonnées, le binaire passe par /result/{id}/file)
+                jobs_total.inc("success" if final_msg["type"] == "output" else "no_output")
+                publish_result(prompt_id, final_msg)
+
+                break
 
     except asyncio.TimeoutError:
-        print(f"TIMEOUT: Prompt {prompt_id} non terminé après {MAX_WAIT_TIME} sec.")
-        if prompt_id in active_connections:
-            await active_connections[prompt_id].send_json({
-                "type": "error",
-                "detail": "Timeout ComfyUI atteint"
-            })
+        limit = MAX_QUEUE_WAIT_TIME if started_at is None else MAX_WAIT_TIME
+        print(f"TIMEOUT: Prompt {prompt_id} non terminé après {limit} sec.")
+        # Le prompt est encore en file ou en cours sur ComfyUI : retiré avant de rendre le slot,
+        # sinon le backend reçoit un job de plus que son plafond
+        await cancel_on_backend(backend, prompt_id)
+        jobs_total.inc("timeout")
+        await publish_error(prompt_id, "Timeout ComfyUI atteint")
+
+    except JobCancelled as e:
+        jobs_total.inc("cancelled")
+        await publish_error(prompt_id, str(e), cancelled=True)
 
     except Exception as e:
         print(f"ERREUR dans run_prompt_and_stream: {traceback.format_exc()}")
-        if prompt_id in active_connections:
-            await active_connections[prompt_id].send_json({
-                "type": "error",
-                "detail": str(e)
-            })
+        jobs_total.inc("error")
+        await publish_error(prompt_id, str(e))
 
     finally:
-        if prompt_id in active_connections:
+        tracker.finish()
+        preview_relay.forget(prompt_id)
+        backend.events.unsubscribe(prompt_id)
+        progress_hub.end(prompt_id)
+
+# ---------------------------------------------------------------------
+# ORDONNANCEUR (admission + file équitable devant ComfyUI)
+# ---------------------------------------------------------------------
+
+class BridgeJob:
+    def __init__(self, prompt_id: str, user_key: str, priority: str, workflow: dict,
+                 input_image: Optional[str] = None, workflow_name: Optional[str] = None):
+        self.prompt_id = prompt_id
+        self.user_key = user_key
+        self.priority = priority
+        self.workflow = workflow
+        self.checkpoints = workflow_checkpoints(workflow)
+        self.models = workflow_models(workflow)
+        self.profile = workflow_profile(workflow, workflow_name)
+        self.skipped = 0
+        self.input_image = input_image
+        self.backend: Optional[ComfyBackend] = None
+        self.state = "queued"
+        self.submitted_at = time.monotonic()
+        self.dispatched_at: Optional[float] = None
+        self.done = asyncio.Event()
+        self.cache_key: Optional[str] = None
+        self.workflow_name = workflow_name
+        # Job déjà soumis à ComfyUI avant un redémarrage du bridge (repris depuis le journal)
+        self.reattach = False
+        # Motif d'annulation (DELETE /jobs/{id}, job abandonné)
+        self.cancelled: Optional[str] = None
+        # Dernier message "queue" envoyé : (position, longueur de la file, attente prévue)
+        self.last_queue: Optional[tuple] = None
+
+
+class JobScheduler:
+    # Une file par (priorité, utilisateur) ; round-robin entre utilisateurs d'une même priorité.
+    # Au plus max_inflight jobs sont soumis en même temps à chaque backend ComfyUI.
+
+    def __init__(self, max_inflight: int):
+        self.max_inflight = max_inflight
+        self.queues: Dict[int, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in sorted(JOB_PRIORITIES.values())}
+        self.queued: Dict[str, BridgeJob] = {}
+        self.inflight: Dict[str, BridgeJob] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._reordered = False
+        self.affinity_picks = 0
+
+    def submit(self, job: BridgeJob):
+        if len(self.queued) >= SCHEDULER_MAX_QUEUED:
+            raise HTTPException(status_code=429, detail="File d'attente pleine, réessayez plus tard.")
+        user_queued = sum(len(q.get(job.user_key, ())) for q in self.queues.values())
+        if user_queued >= SCHEDULER_MAX_QUEUED_PER_USER:
+            raise HTTPException(status_code=429, detail="Trop de jobs en attente pour cet utilisateur.")
+        if not backend_pool.supports(job.checkpoints):
+            raise HTTPException(status_code=400, detail=f"Aucun backend ComfyUI ne possède: {', '.join(job.checkpoints)}")
+        if VALIDATE_WORKFLOWS:
+            with timed("validate"):
+                errors = backend_pool.validate(job.workflow)
+            if errors:
+                jobs_total.inc("invalid")
+                raise HTTPException(status_code=400, detail="Workflow invalide: " + "; ".join(errors))
+
+        prio = JOB_PRIORITIES[job.priority]
+        self.queues[prio].setdefault(job.user_key, deque()).append(job)
+        self.queued[job.prompt_id] = job
+        self._reordered = True
+        self._wakeup.set()
+        # Une affiche pré-générée en cours laisse aussitôt la place
+        if job.priority != "idle":
+            affiche_pool.preempt()
+
+    def remove(self, prompt_id: str) -> Optional[BridgeJob]:
+        # Job retiré de la file avant sa soumission à ComfyUI (annulation)
+        job = self.queued.pop(prompt_id, None)
+        if job is None:
+            return None
+        users = self.queues[JOB_PRIORITIES[job.priority]]
+        lane = users.get(job.user_key)
+        if lane is not None and job in lane:
+            lane.remove(job)
+            if not lane:
+                del users[job.user_key]
+        self.broadcast_positions()
+        return job
+
+    def wakeup(self):
+        if self.queued:
+            self._wakeup.set()
+
+    def position(self, prompt_id: str) -> Optional[int]:
+        for i, job in enumerate(self.order()):
+            if job.prompt_id == prompt_id:
+                return i + 1
+        return None
+
+    def order(self):
+        # Ordre de passage prévu (simulation du round-robin, sans modifier les files)
+        result = []
+        for prio in self.queues:
+            lanes = [list(q) for q in self.queues[prio].values()]
+            depth = 0
+            while any(depth < len(lane) for lane in lanes):
+                result.extend(lane[depth] for lane in lanes if depth < len(lane))
+                depth += 1
+        return result
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
             try:
-                await active_connections[prompt_id].close()
-            except:
+                await self._task
+            except asyncio.CancelledError:
                 pass
-            active_connections.pop(prompt_id, None)
+            self._task = None
+
+    def _pick(self) -> Optional[BridgeJob]:
+        now = time.monotonic()
+        lanes = []
+        # Anti-famine : un job batch trop ancien passe en tête
+        for prio, users in self.queues.items():
+            if prio != JOB_PRIORITIES["batch"]:
+                continue
+            lanes += [(prio, user) for user, lane in users.items()
+                      if lane and now - lane[0].submitted_at > SCHEDULER_BATCH_MAX_WAIT]
+        for prio, users in self.queues.items():
+            lanes += [(prio, user) for user in users]
+        heads = [(prio, user, self.queues[prio][user][0]) for prio, user in lanes]
+
+        # Affinité : dans la fenêtre, un job de même priorité dont les modèles sont déjà chargés
+        # passe devant, tant que le premier job n'a pas été doublé trop souvent
+        if heads and heads[0][2].skipped < SCHEDULER_AFFINITY_MAX_SKIPS:
+            for i, (prio, user, job) in enumerate(heads[:SCHEDULER_AFFINITY_WINDOW]):
+                if prio != heads[0][0]:
+                    break
+                backend = backend_pool.choose_loaded(job.models, self.max_inflight)
+                if backend is not None:
+                    for _, _, passed in heads[:i]:
+                        passed.skipped += 1
+                    if i:
+                        self.affinity_picks += 1
+                    return self._take(prio, user, backend)
+
+        # Premier job (dans l'ordre équitable) pour lequel un backend compatible a un slot libre
+        for prio, user, job in heads:
+            backend = backend_pool.choose(job.checkpoints, self.max_inflight, job.models)
+            if backend is not None:
+                return self._take(prio, user, backend)
+        return None
+
+    def _take(self, prio: int, user: str, backend: ComfyBackend) -> BridgeJob:
+        job = self._pop(prio, user)
+        job.backend = backend
+        return job
+
+    def _pop(self, prio: int, user: str) -> BridgeJob:
+        users = self.queues[prio]
+        lane = users.pop(user)
+        job = lane.popleft()
+        if lane:
+            users[user] = lane  # l'utilisateur repasse en fin de tour
+        self.queued.pop(job.prompt_id, None)
+        return job
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            dispatched = False
+            while self.queued:
+                job = self._pick()
+                if job is None:
+                    break
+                job.state = "submitting"
+                job.dispatched_at = time.monotonic()
+                stage_seconds.observe("scheduler_wait", job.dispatched_at - job.submitted_at)
+                job.backend.inflight += 1
+                job.backend.dispatched += 1
+                if job.models and not job.backend.loaded.issuperset(job.models):
+                    job.backend.model_switches += 1
+                    job.backend.loaded = frozenset(job.models)
+                backend_pool.remember(job.prompt_id, job.backend)
+                self.inflight[job.prompt_id] = job
+                journal.record(job.prompt_id, "submitting", backend=job.backend.name)
+                asyncio.create_task(self._execute(job))
+                dispatched = True
+            if dispatched or self._reordered:
+                self._reordered = False
+                self.broadcast_positions()
+            elif self.queued:
+                self.broadcast_positions(changed_only=True)
+
+    def adopt(self, job: BridgeJob):
+        # Job repris après redémarrage : déjà dans la file ComfyUI, il occupe un slot de son backend
+        job.reattach = True
+        job.state = "running"
+        job.dispatched_at = time.monotonic()
+        job.backend.inflight += 1
+        backend_pool.remember(job.prompt_id, job.backend)
+        self.inflight[job.prompt_id] = job
+        asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: BridgeJob):
+        try:
+            await run_comfy_job(job)
+        finally:
+            stage_seconds.observe("total", time.monotonic() - job.submitted_at)
+            job.backend.inflight -= 1
+            self.inflight.pop(job.prompt_id, None)
+            try:
+                await settle_coalesced(job)
+            except Exception:
+                print(f"ERREUR coalescence {job.prompt_id}: {traceback.format_exc()}")
+            job.done.set()
+            self._wakeup.set()
+
+    def broadcast_positions(self, changed_only: bool = False):
+        # changed_only : réveil sans soumission, retrait ni dispatch ; seuls les jobs dont la position ou
+        # l'attente prévue a vraiment bougé reçoivent un message (chaque message est aussi une ligne d'état partagé)
+        order = self.order()
+        waits = predicted_waits(order, list(self.inflight.values()))
+        for i, job in enumerate(order):
+            sent = (i + 1, len(order), waits[i])
+            if changed_only and job.last_queue is not None and job.last_queue[:2] == sent[:2]:
+                old_wait = job.last_queue[2]
+                if old_wait is None and waits[i] is None:
+                    continue
+                if old_wait is not None and waits[i] is not None and abs(waits[i] - old_wait) < SCHEDULER_ETA_MIN_CHANGE:
+                    continue
+            job.last_queue = sent
+            progress_hub.publish(job.prompt_id, queue_message(*sent))
+
+
+def queue_message(position: int, length: int, eta_wait: Optional[float] = None) -> dict:
+    return {"type": "queue", "position": position, "queue_length": length, "eta_wait": eta_wait}
+
+
+async def run_comfy_job(job: BridgeJob):
+    backend = job.backend
+    # Abonnement avant la soumission : aucun évènement perdu
+    backend.events.subscribe(job.prompt_id)
+    if job.reattach:
+        # Terminé pendant l'arrêt du bridge : la fin est rejouée depuis /history
+        if job.prompt_id in await get_history(job.prompt_id, backend):
+            backend.events.notify_done(job.prompt_id)
+        await run_prompt_and_stream(job.prompt_id, BRIDGE_CLIENT_ID, job.workflow, backend, profile=job.profile)
+        job.state = "done"
+        return
+
+    try:
+        if job.input_image:
+            await ensure_input_image(job.input_image, backend)
+        await queue_prompt(job.workflow, job.prompt_id, backend)
+        submitted_at = time.monotonic()
+    except Exception as e:
+        backend.events.unsubscribe(job.prompt_id)
+        job.state = "failed"
+        jobs_total.inc("rejected")
+        detail = e.detail if isinstance(e, HTTPException) else f"Soumission ComfyUI impossible: {e}"
+        await publish_error(job.prompt_id, detail)
+        progress_hub.end(job.prompt_id)
+        return
+
+    if job.cancelled:
+        # Annulé pendant la soumission : retiré de ComfyUI aussitôt
+        asyncio.create_task(cancel_on_backend(backend, job.prompt_id))
+
+    job.state = "running"
+    journal.record(job.prompt_id, "running", backend=backend.name)
+    await run_prompt_and_stream(job.prompt_id, BRIDGE_CLIENT_ID, job.workflow, backend, submitted_at, job.profile)
+    job.state = "done"
+
+
+def alias_result(result: dict, prompt_id: str) -> dict:
+    # Même sortie, exposée sous le prompt_id d'une demande identique (sans la variante choisie par l'autre)
+    msg = dict(result, prompt_id=prompt_id)
+    msg.pop("variant", None)
+    if result.get("type") == "output":
+        msg["url"] = f"/result/{prompt_id}/file"
+        if result.get("items"):
+            msg["items"] = [dict(item, url=f"/result/{prompt_id}/file?index={i}") for i, item in enumerate(result["items"])]
+    return msg
+
+
+def submit_generation(prompt_id: str, user_key: str, priority: str, workflow: dict,
+                      input_image: Optional[str] = None, cacheable: bool = False,
+                      workflow_name: Optional[str] = None) -> Optional[asyncio.Event]:
+    # Sortie déjà en cache : résultat immédiat (None) ; sinon évènement de fin du job qui la calcule
+    key = workflow_cache_key(workflow) if cacheable and OUTPUT_CACHE_ENABLED else None
+    if key:
+        entry = output_cache.lookup(key)
+        if entry is not None:
+            output_cache.hits += 1
+            msg = output_cache.output_message(prompt_id, entry)
+            journal.record(prompt_id, "cached", kind="comfy", user=user_key, priority=priority,
+                           workflow_name=workflow_name)
+            publish_result(prompt_id, msg)
+            progress_hub.end(prompt_id)
+            return None
+
+        # Même workflow déjà en file / en cours : on se greffe sur ce job
+        primary = output_cache.inflight.get(key)
+        if primary is not None:
+            if not primary.done.is_set():
+                output_cache.coalesced += 1
+                output_cache.followers.setdefault(primary.prompt_id, []).append(prompt_id)
+                progress_hub.open(prompt_id)
+                journal.record(prompt_id, "coalesced", kind="comfy", user=user_key, priority=priority,
+                               workflow_name=workflow_name, primary=primary.prompt_id)
+                return primary.done
+            result = prompt_results.get(primary.prompt_id)
+            if result and result.get("type") == "output":
+                output_cache.coalesced += 1
+                journal.record(prompt_id, "cached", kind="comfy", user=user_key, priority=priority,
+                               workflow_name=workflow_name)
+                publish_result(prompt_id, alias_result(result, prompt_id))
+                progress_hub.end(prompt_id)
+                return None
+
+    job = BridgeJob(prompt_id, user_key, priority, workflow, input_image, workflow_name)
+    job.cache_key = key
+    scheduler.submit(job)
+    progress_hub.open(prompt_id)
+    journal.record(prompt_id, "queued", kind="comfy", user=user_key, priority=priority, workflow_name=workflow_name,
+                   checkpoints=job.checkpoints, input_image=input_image, workflow=workflow)
+    if key:
+        output_cache.misses += 1
+        output_cache.inflight[key] = job
+    return job.done
+
+
+async def settle_coalesced(job: BridgeJob):
+    result = prompt_results.get(job.prompt_id)
+    for prompt_id in output_cache.followers.pop(job.prompt_id, []):
+        if not result or result.get("type") != "output":
+            await publish_error(prompt_id, (result or {}).get("detail", "Aucune sortie"))
+        else:
+            publish_result(prompt_id, alias_result(result, prompt_id))
+        progress_hub.end(prompt_id)
+
+    if job.cache_key:
+        if result and result.get("type") == "output":
+            asyncio.create_task(store_output(job, result))
+        elif output_cache.inflight.get(job.cache_key) is job:
+            del output_cache.inflight[job.cache_key]
+
+
+async def store_output(job: BridgeJob, result: dict):
+    # Le job reste la référence de sa clé jusqu'à l'écriture : les demandes identiques reprennent son résultat
+    try:
+        await output_cache.store(job.cache_key, result)
+    except Exception as e:
+        print(f"Cache des sorties: écriture impossible pour {job.prompt_id}: {e}")
+    finally:
+        if output_cache.inflight.get(job.cache_key) is job:
+            del output_cache.inflight[job.cache_key]
+
+
+async def comfy_queue_has(backend: ComfyBackend, prompt_id: str) -> bool:
+    resp = await get_comfy_http().get(f"{backend.url}/queue")
+    resp.raise_for_status()
+    queue = resp.json()
+    return any(len(e) > 1 and e[1] == prompt_id for e in queue.get("queue_running", []) + queue.get("queue_pending", []))
+
+
+def restore_results():
+    # Résultats récents du journal : /result et /progress répondent encore après un redémarrage
+    cutoff = time.time() - RESULT_STORE_TTL
+    for prompt_id, entry in journal.jobs.items():
+        if entry["updated_at"] < cutoff or prompt_id in prompt_results:
+            continue
+        if entry["state"] == "completed" and entry.get("result"):
+            prompt_results.put(prompt_id, entry["result"])
+        elif entry["state"] == "failed":
+            prompt_results.put(prompt_id, {"type": "error", "prompt_id": prompt_id, "detail": entry.get("detail")})
+        elif entry["state"] == "cancelled":
+            prompt_results.put(prompt_id, {"type": "error", "prompt_id": prompt_id, "detail": entry.get("detail"),
+                                           "cancelled": True})
+
+
+async def recover_jobs():
+    # Jobs non terminés au dernier arrêt : suivi repris si ComfyUI les connaît, sinon nouvelle soumission
+    pending = journal.unfinished()
+    for entry in [e for e in pending if e["state"] != "coalesced"]:
+        prompt_id = entry["prompt_id"]
+        workflow = journal.workflows.get(prompt_id)
+        progress_hub.open(prompt_id)
+        if entry.get("kind") != "comfy" or workflow is None:
+            # Runway : la clé API n'est pas journalisée, la tâche ne peut pas être suivie
+            await publish_error(prompt_id, "Job interrompu par le redémarrage du bridge.")
+            progress_hub.end(prompt_id)
+            continue
+
+        job = BridgeJob(prompt_id, entry.get("user") or "recovered", entry.get("priority") or "interactive",
+                        workflow, entry.get("input_image"), entry.get("workflow_name"))
+        backend = backend_pool.by_name.get(entry.get("backend"))
+        if entry["state"] in ("submitting", "running") and backend is not None:
+            try:
+                known = prompt_id in await get_history(prompt_id, backend) or await comfy_queue_has(backend, prompt_id)
+            except Exception:
+                # Backend injoignable : on reste attaché, la reconnexion WS relira /history
+                known = True
+            if known:
+                job.backend = backend
+                scheduler.adopt(job)
+                journal.record(prompt_id, "running", recovered=True)
+                journal.recovered += 1
+                continue
+
+        # Jamais parti vers ComfyUI, ou perdu par ComfyUI : nouvelle soumission sous le même prompt_id
+        try:
+            scheduler.submit(job)
+        except HTTPException as e:
+            await publish_error(prompt_id, e.detail)
+            progress_hub.end(prompt_id)
+            continue
+        journal.record(prompt_id, "queued", recovered=True)
+        journal.requeued += 1
+
+    # Demandes greffées sur un job identique : rattachées au job repris, ou à son résultat
+    for entry in [e for e in pending if e["state"] == "coalesced"]:
+        prompt_id, primary = entry["prompt_id"], entry.get("primary")
+        progress_hub.open(prompt_id)
+        if primary in scheduler.queued or primary in scheduler.inflight:
+            output_cache.followers.setdefault(primary, []).append(prompt_id)
+            continue
+        result = (journal.get(primary) or {}).get("result")
+        if result:
+            publish_result(prompt_id, alias_result(result, prompt_id))
+        else:
+            await publish_error(prompt_id, "Job interrompu par le redémarrage du bridge.")
+        progress_hub.end(prompt_id)
+
+
+def warmup_workflow(checkpoint: str) -> dict:
+    # Graphe minimal (64x64, 1 step, aperçu non enregistré) : ComfyUI charge le checkpoint en VRAM
+    return {
+        "1": {"class_type": NODE_TYPE_CHECKPOINT, "inputs": {"ckpt_name": checkpoint}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "warmup", "clip": ["1", 1]}},
+        "3": {"class_type": "EmptyLatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "4": {"class_type": "KSampler", "inputs": {
+            "seed": 0, "steps": 1, "cfg": 1.0, "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0,
+            "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0]}},
+        "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "PreviewImage", "inputs": {"images": ["5", 0]}},
+    }
+
+
+def warmup_checkpoints() -> List[str]:
+    if WARMUP_COUNT <= 0:
+        return []
+    if WARMUP_CHECKPOINTS:
+        return WARMUP_CHECKPOINTS
+    # Les plus demandés d'après le journal ; premier démarrage : checkpoint par défaut
+    counts = {}
+    for entry in journal.jobs.values():
+        for name in entry.get("checkpoints") or ():
+            counts[name] = counts.get(name, 0) + 1
+    return sorted(counts, key=counts.get, reverse=True)[:WARMUP_COUNT] or [MODEL_CHECKPOINT]
+
+
+async def warmup_backend(backend: ComfyBackend, checkpoints: List[str]):
+    deadline = time.monotonic() + WARMUP_TIMEOUT
+    while not (backend.available and backend.checkpoints is not None):
+        if time.monotonic() > deadline:
+            print(f"[WARMUP] {backend.name} indisponible, préchauffage abandonné")
+            return
+        await asyncio.sleep(BACKEND_POLL_INTERVAL)
+
+    # Le plus demandé en dernier : c'est lui qui reste chargé
+    for checkpoint in reversed(checkpoints):
+        if not backend.has_checkpoints([checkpoint]):
+            continue
+        prompt_id = str(uuid.uuid4())
+        events = backend.events.subscribe(prompt_id)
+        t0 = time.monotonic()
+        # Le préchauffage occupe un slot du backend : l'ordonnanceur n'y envoie pas plus de jobs que le plafond
+        backend.inflight += 1
+        try:
+            await queue_prompt(warmup_workflow(checkpoint), prompt_id, backend)
+            while True:
+                msg = await asyncio.wait_for(events.get(), timeout=max(0.1, deadline - time.monotonic()))
+                if msg.get("type") in ("execution_error", "execution_interrupted"):
+                    raise RuntimeError(msg["data"].get("exception_message") or msg["type"])
+                if msg.get("type") == "executing" and msg["data"].get("node") is None:
+                    break
+            # Chargé seulement une fois l'exécution terminée (affinité de checkpoint)
+            backend.loaded = frozenset([checkpoint])
+            stage_seconds.observe("warmup", time.monotonic() - t0)
+            print(f"[WARMUP] {backend.name}: {checkpoint} chargé en {time.monotonic() - t0:.1f}s")
+        except Exception as e:
+            print(f"[WARMUP] {backend.name}: préchauffage de {checkpoint} impossible: {e or e.__class__.__name__}")
+        finally:
+            backend.events.unsubscribe(prompt_id)
+            backend.inflight -= 1
+            scheduler.wakeup()
+
+
+async def warmup():
+    global _warmup_done
+    checkpoints = warmup_checkpoints()
+    if checkpoints:
+        await asyncio.gather(*(warmup_backend(b, checkpoints) for b in backend_pool.backends))
+    _warmup_done = True
+
+
+def get_user_key(request: Request) -> str:
+    # Identité pour la file équitable : clé API, sinon token, sinon IP
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        return "key:" + hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:16]
+    auth = request.headers.get("authorization")
+    if auth:
+        return "auth:" + hashlib.sha1(auth.encode("utf-8")).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+scheduler = JobScheduler(MAX_INFLIGHT_JOBS)
+
+# ---------------------------------------------------------------------
+# GÉNÉRATION PAR LOTS (balayage seeds / cfg / samplers / prompts)
+# ---------------------------------------------------------------------
+
+class BatchRun:
+    # Un lot = N variations réparties en exécutions ComfyUI (plusieurs seeds par exécution si batch_size)
+
+    def __init__(self, batch_id: str, user_key: str, priority: str, template, base_values: dict,
+                 executions: list, items: list, input_image: Optional[str] = None):
+        self.batch_id = batch_id
+        self.user_key = user_key
+        self.priority = priority
+        self.template = template
+        self.base_values = base_values
+        self.executions = executions
+        self.items = items
+        self.input_image = input_image
+        self.cacheable = False
+        self.subscribers: List[ProgressSubscriber] = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def summary(self) -> dict:
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        for item in self.items:
+            counts[item["state"]] += 1
+        total = len(self.items)
+        return {
+            "type": "batch_progress",
+            "batch_id": self.batch_id,
+            "workflow_name": self.template.name,
+            "total": total,
+            "executions": len(self.executions),
+            "queued": counts["queued"],
+            "running": counts["running"],
+            "completed": counts["done"],
+            "failed": counts["failed"],
+            "progress": round((counts["done"] + counts["failed"]) / total, 4) if total else 1.0,
+            "finished": self.finished_at is not None,
+        }
+
+    def render(self, execution: dict) -> dict:
+        values = dict(self.base_values, **execution["values"])
+        values["cfg"] = values["cfg_scale"]
+        workflow = self.template.render(values)
+        if execution["latent_batch"] > 1:
+            latent = dict(workflow[NODE_IDS["LATENT_IMAGE"]])
+            latent["inputs"] = dict(latent["inputs"], batch_size=execution["latent_batch"])
+            workflow[NODE_IDS["LATENT_IMAGE"]] = latent
+        return workflow
+
+    def subscriber(self) -> ProgressSubscriber:
+        # Chaque item n'est publié qu'une fois (+ un récapitulatif) : file assez grande pour ne rien perdre
+        return ProgressSubscriber(2 * len(self.items) + 4)
+
+    def publish(self, msg: Optional[dict]):
+        # Comme les jobs : publier ne bloque jamais, chaque socket a sa file et sa boucle d'envoi
+        for sub in list(self.subscribers):
+            sub.offer(msg)
+
+
+batch_runs: "OrderedDict[str, BatchRun]" = OrderedDict()
+
+
+def latent_batch_capacity(template) -> int:
+    # batch_size utilisable seulement sur un EmptyLatentImage à batch_size fixe (ni lien ni placeholder)
+    node = template.graph.get(NODE_IDS["LATENT_IMAGE"])
+    if not isinstance(node, dict) or node.get("class_type") != "EmptyLatentImage":
+        return 1
+    if not isinstance(node.get("inputs", {}).get("batch_size"), int):
+        return 1
+    return max(1, BATCH_LATENT_MAX)
+
+
+def expand_batch(req: BatchRequest, template, base_values: dict):
+    base, sweep = req.params, req.sweep
+
+    packable = False
+    if sweep.seeds:
+        seeds = [s if s >= 0 else random.randint(0, 2**32 - 1) for s in sweep.seeds]
+    elif sweep.seed_count:
+        start = sweep.seed_start if sweep.seed_start is not None and sweep.seed_start >= 0 else random.randint(0, 2**32 - 1)
+        seeds = [(start + i) % 2**32 for i in range(sweep.seed_count)]
+        packable = True
+    else:
+        seeds = [base_values["seed"]]
+
+    prompts = sweep.prompts or [base.prompt]
+    cfg_scales = sweep.cfg_scales or [base.cfg_scale]
+    samplers = sweep.samplers or [base.sampler]
+
+    total = len(seeds) * len(prompts) * len(cfg_scales) * len(samplers)
+    if total == 0:
+        raise HTTPException(400, "Lot vide : aucune variation à générer")
+    if total > BATCH_MAX_ITEMS:
+        raise HTTPException(400, f"Lot trop grand: {total} variations (max {BATCH_MAX_ITEMS})")
+
+    # Plage de seeds : k images par exécution ; image i = (seed de l'exécution, batch_index i).
+    # Seeds explicites : une exécution par seed, pour reproduire exactement chaque image.
+    per_exec = 1
+    if packable and req.latent_batch and not base.input_image_path:
+        per_exec = latent_batch_capacity(template)
+
+    executions, items = [], []
+    for prompt in prompts:
+        for sampler in samplers:
+            for cfg_scale in cfg_scales:
+                for i in range(0, len(seeds), per_exec):
+                    chunk = seeds[i:i + per_exec]
+                    execution = {
+                        "values": {"prompt": prompt, "sampler": sampler, "cfg_scale": cfg_scale, "seed": chunk[0]},
+                        "latent_batch": len(chunk),
+                        "items": [],
+                    }
+                    for batch_index in range(len(chunk)):
+                        execution["items"].append(len(items))
+                        items.append({
+                            "index": len(items),
+                            "prompt": prompt,
+                            "sampler": sampler,
+                            "cfg_scale": cfg_scale,
+                            "seed": chunk[0],
+                            "batch_index": batch_index,
+                            "prompt_id": None,
+                            "state": "queued",
+                            "url": None,
+                        })
+                    executions.append(execution)
+    return executions, items
+
+
+async def run_batch(batch: BatchRun):
+    # Fenêtre glissante : le lot n'occupe qu'une partie de la file, les autres utilisateurs passent entre
+    window = asyncio.Semaphore(max(1, min(BATCH_WINDOW, SCHEDULER_MAX_QUEUED_PER_USER)))
+
+    async def run_one(execution):
+        async with window:
+            prompt_id = str(uuid.uuid4())
+            items = [batch.items[i] for i in execution["items"]]
+            for item in items:
+                item["prompt_id"] = prompt_id
+
+            try:
+                workflow = batch.render(execution)
+                while True:
+                    try:
+                        done = submit_generation(prompt_id, batch.user_key, batch.priority, workflow,
+                                                 batch.input_image, batch.cacheable, batch.template.name)
+                        break
+                    except HTTPException as e:
+                        if e.status_code != 429:
+                            raise
+                        await asyncio.sleep(BACKEND_POLL_INTERVAL)
+            except HTTPException as e:
+                finish_items(batch, items, None, e.detail)
+                return
+
+            if done is not None:
+                for item in items:
+                    item["state"] = "running"
+                await done.wait()
+
+            result = prompt_results.get(prompt_id)
+            if not result or result.get("type") != "output":
+                finish_items(batch, items, None, (result or {}).get("detail", "Aucune sortie"))
+            else:
+                finish_items(batch, items, result.get("items") or [result], None)
+
+    try:
+        await asyncio.gather(*(run_one(e) for e in batch.executions))
+    finally:
+        batch.finished_at = time.time()
+        batch.publish(dict(batch.summary(), type="batch_done"))
+        batch.publish(None)
+        batch.subscribers.clear()
+
+
+def finish_items(batch: BatchRun, items: list, files: Optional[list], error: Optional[str]):
+    for item in items:
+        if files is not None and item["batch_index"] < len(files):
+            item["state"] = "done"
+            item["url"] = files[item["batch_index"]]["url"]
+        else:
+            item["state"] = "failed"
+            item["detail"] = error or "Sortie manquante pour cette image"
+        batch.publish(dict(item, type="batch_item", batch_id=batch.batch_id))
+    batch.publish(batch.summary())
+
+
+def prune_batch_runs():
+    # Lots terminés gardés le temps du cache des résultats, dans la limite de BATCH_MAX_RUNS
+    now = time.time()
+    for batch_id, batch in list(batch_runs.items()):
+        if batch.finished_at is None:
+            continue
+        if now - batch.finished_at > RESULT_STORE_TTL or len(batch_runs) > BATCH_MAX_RUNS:
+            batch_runs.pop(batch_id, None)
+
+# ---------------------------------------------------------------------
+# AFFICHES PRÉ-GÉNÉRÉES (temps morts du GPU, /affiche/random)
+# ---------------------------------------------------------------------
+
+def random_affiche_params(data: dict) -> dict:
+    # Même tirage que le bouton "Aléatoire" du front (script.js)
+    def pick(key):
+        values = data.get(key) or []
+        return random.choice(values) if values else ""
+
+    return {
+        "titre": pick("titres"),
+        "sous_titre": pick("sous_titres"),
+        "tagline": pick("taglines"),
+        "theme": pick("themes"),
+        "ambiance": pick("ambiances"),
+        "personnage": pick("personnages"),
+        "environnement": pick("environnements"),
+        "action": pick("actions"),
+        "palette": pick("palettes"),
+        "style_titre": pick("styles_titre"),
+        "details": pick("details"),
+    }
+
+
+def affiche_prompt(p: dict) -> str:
+    # Même prompt que generateAffichePrompt() (script.js)
+    text_block = ""
+    if p["titre"] or p["sous_titre"] or p["tagline"]:
+        title = f'TITLE: "{p["titre"]}" (top area, clean, sharp, readable, no distortion)' if p["titre"] else ""
+        subtitle = f'SUBTITLE: "{p["sous_titre"]}" (under title, smaller, crisp, readable)' if p["sous_titre"] else ""
+        tagline = f'TAGLINE: "{p["tagline"]}" (bottom area, subtle, readable)' if p["tagline"] else ""
+        text_block = (f"\nALLOWED TEXT ONLY:\n\n{title}\n{subtitle}\n{tagline}\n\n"
+                      f"ONLY ONE INSTANCE OF EACH TEXT ELEMENT.\n\n"
+                      f"TEXT STYLE / MATERIAL (APPLIES ONLY TO LETTERING):\n{p['style_titre'] or 'cinematic, elegant contrast'}\n")
+    visual = ", ".join(v for v in (p["theme"], p["ambiance"], p["personnage"], p["environnement"], p["action"],
+                                   p["palette"]) if v.strip())
+    prompt = (f"\nUltra detailed cinematic poster, dramatic lighting, depth, atmospheric effects.\n\n{text_block}\n\n"
+              f"Visual elements:\n{visual}\n\n"
+              f"Extra details:\n{p['details'] or 'cinematic particles, depth fog, volumetric light'}\n\n"
+              f"Image style:\nPremium poster design, professional layout, ultra high resolution, visually striking.\n  ")
+    return re.sub(r"\s{2,}", " ", re.sub(r"\n\s*\n", "\n", prompt.strip()))
+
+
+class AffichePool:
+    # Une affiche = image + fiche JSON (paramètres tirés, prompt, génération) dans le dossier du pool,
+    # partagé par les workers. Servir une affiche la déplace dans IMAGES_DIR : le renommage est atomique,
+    # deux workers ne peuvent pas servir la même.
+
+    def __init__(self, directory: str, size: int, max_bytes: int):
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self.data: Optional[dict] = None
+        self.current: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.generated = 0
+        self.served = 0
+        self.misses = 0
+        self.preempted = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def entries(self) -> List[dict]:
+        # Plus anciennes d'abord ; une fiche sans image (servie entre-temps) est ignorée
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                entry["bytes"] = os.path.getsize(os.path.join(self.directory, entry["filename"]))
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append(entry)
+        return sorted(entries, key=lambda e: e["created_at"])
+
+    def full(self) -> bool:
+        entries = self.entries()
+        return len(entries) >= self.size or sum(e["bytes"] for e in entries) >= self.max_bytes
+
+    def add(self, entry: dict, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        _write_file(os.path.join(self.directory, entry["filename"]), data)
+        _write_file(os.path.join(self.directory, f"{entry['id']}.json"), json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        # Budget disque : les plus anciennes sortent, la nouvelle reste
+        entries = self.entries()
+        total = sum(e["bytes"] for e in entries)
+        for old in entries[:-1]:
+            if total <= self.max_bytes and len(entries) <= self.size:
+                break
+            self.remove(old)
+            total -= old["bytes"]
+            entries = [e for e in entries if e is not old]
+            self.evicted += 1
+
+    def remove(self, entry: dict):
+        _remove_file(os.path.join(self.directory, entry["filename"]))
+        _remove_file(os.path.join(self.directory, f"{entry['id']}.json"))
+
+    def claim(self) -> Optional[dict]:
+        # Affiche la plus ancienne, déplacée dans IMAGES_DIR ; None si le pool est vide
+        for entry in self.entries():
+            try:
+                os.replace(os.path.join(self.directory, entry["filename"]), os.path.join(IMAGES_DIR, entry["filename"]))
+            except FileNotFoundError:
+                continue  # servie par un autre worker
+            _remove_file(os.path.join(self.directory, f"{entry['id']}.json"))
+            return entry
+        return None
+
+    def load_data(self) -> dict:
+        if self.data is None:
+            with open(AFFICHE_DATA_PATH, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        return self.data
+
+    def idle(self) -> bool:
+        # Aucun job du bridge, rien dans la file d'aucun backend (autres clients et autres workers compris)
+        return (not scheduler.queued and not scheduler.inflight
+                and all(b.available and b.queue_depth == 0 for b in backend_pool.backends))
+
+    def busy_elsewhere(self) -> bool:
+        return (any(j.priority != "idle" for j in list(scheduler.queued.values()) + list(scheduler.inflight.values()))
+                or any(b.external_depth for b in backend_pool.backends))
+
+    def preempt(self):
+        if self.current is not None:
+            prompt_id, self.current = self.current, None
+            self.preempted += 1
+            asyncio.create_task(cancel_quietly(prompt_id, "Affiche pré-générée préemptée par un autre job.", "preempted"))
+
+    def start(self):
+        if self.size > 0 and WORKER_SLOT == 0 and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(AFFICHE_IDLE_CHECK_INTERVAL)
+            try:
+                if not self.idle() or await loop.run_in_executor(None, self.full):
+                    continue
+                await self.fill_one()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                print(f"ERREUR affiches pré-générées: {traceback.format_exc()}")
+
+    async def fill_one(self):
+        loop = asyncio.get_event_loop()
+        params = random_affiche_params(await loop.run_in_executor(None, self.load_data))
+        prompt = affiche_prompt(params)
+        width, height = AFFICHE_SIZE
+        values = GenerateParams(prompt=prompt, width=width, height=height, seed=random.randint(0, 2**32 - 1)).dict()
+        workflow = get_workflow_template(AFFICHE_WORKFLOW).render(placeholder_values(AFFICHE_WORKFLOW, values))
+
+        prompt_id = str(uuid.uuid4())
+        done = submit_generation(prompt_id, "affiche-pool", "idle", workflow, workflow_name=AFFICHE_WORKFLOW)
+        self.current = prompt_id
+        try:
+            # Autres clients de ComfyUI (ou autres workers) : ils ne passent pas par notre ordonnanceur
+            while not done.is_set():
+                try:
+                    await asyncio.wait_for(done.wait(), timeout=BACKEND_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    if self.current == prompt_id and self.busy_elsewhere():
+                        self.preempt()
+        finally:
+            if self.current == prompt_id:
+                self.current = None
+
+        result = prompt_results.get(prompt_id)
+        if not result or result.get("type") != "output":
+            if not (result or {}).get("cancelled"):
+                self.failed += 1
+            return
+        data = await read_output_bytes(result)
+        ext = os.path.splitext(result["filename"])[1] or ".png"
+        entry = {"id": prompt_id, "filename": f"affiche_{prompt_id}{ext}", "params": params, "prompt": prompt,
+                 "width": width, "height": height, "generation": result.get("generation"), "created_at": time.time()}
+        await loop.run_in_executor(None, self.add, entry, data)
+        self.generated += 1
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        return {
+            "enabled": self.size > 0,
+            "filler": self.task is not None,
+            "workflow": AFFICHE_WORKFLOW,
+            "ready": len(entries),
+            "target": self.size,
+            "bytes": sum(e["bytes"] for e in entries),
+            "max_bytes": self.max_bytes,
+            "generating": self.current,
+            "generated": self.generated,
+            "served": self.served,
+            "misses": self.misses,
+            "preempted": self.preempted,
+            "failed": self.failed,
+            "evicted": self.evicted,
+        }
+
+
+affiche_pool = AffichePool(AFFICHE_POOL_DIR, AFFICHE_POOL_SIZE, AFFICHE_POOL_MAX_BYTES)
 
 # ---------------------------------------------------------------------
 # UTILS RUNWAYML
 # ---------------------------------------------------------------------
 
+_runway_http: Optional[httpx.AsyncClient] = None
+runway_slots: Dict[str, asyncio.Semaphore] = {}
+
+def get_runway_http() -> httpx.AsyncClient:
+    global _runway_http
+    if _runway_http is None or _runway_http.is_closed:
+        _runway_http = httpx.AsyncClient(timeout=httpx.Timeout(RUNWAY_HTTP_TIMEOUT, connect=COMFY_HTTP_CONNECT_TIMEOUT))
+    return _runway_http
+
+async def close_runway_http():
+    global _runway_http
+    if _runway_http is not None:
+        await _runway_http.aclose()
+        _runway_http = None
+
+def runway_headers(api_key):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    if RUNWAY_API_VERSION:
+        headers["X-Runway-Version"] = RUNWAY_API_VERSION
+    return headers
+
+def runway_slot(api_key) -> asyncio.Semaphore:
+    # Jobs Runway simultanés par clé API (la clé n'est jamais gardée en clair)
+    key = hashlib.sha1(api_key.encode("utf-8")).hexdigest()
+    slot = runway_slots.get(key)
+    if slot is None:
+        slot = runway_slots[key] = asyncio.Semaphore(RUNWAY_MAX_CONCURRENT_PER_KEY)
+    return slot
+
+def retry_after(resp, default):
+    try:
+        return min(float(resp.headers.get("retry-after", default)), RUNWAY_POLL_MAX_INTERVAL)
+    except ValueError:
+        return default
+
+
 async def call_runway_i2v(api_key, prompt, image_url, ratio, duration, seed):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "model": "gen4_turbo",
         "promptText": prompt,
@@ -283,131 +3697,636 @@ async def call_runway_i2v(api_key, prompt, image_url, ratio, duration, seed):
         "seed": seed
     }
 
-    loop = asyncio.get_event_loop()
-    resp = await loop.run_in_executor(
-        None,
-        lambda: requests.post(RUNWAY_API_URL, json=payload, headers=headers)
-    )
+    delay = RUNWAY_POLL_MIN_INTERVAL
+    for _ in range(RUNWAY_SUBMIT_RETRIES):
+        resp = await get_runway_http().post(RUNWAY_API_URL, json=payload, headers=runway_headers(api_key))
+        # Quota Runway atteint : on réessaie plus tard
+        if resp.status_code == 429:
+            await asyncio.sleep(retry_after(resp, delay))
+            delay = min(delay * 2, RUNWAY_POLL_MAX_INTERVAL)
+            continue
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {"status_code": resp.status_code, "body": resp.text[:500]}
+        if resp.status_code >= 400 or "id" not in data:
+            raise RuntimeError(f"Runway error: {data}")
+        return data["id"]
+
+    raise RuntimeError("Runway error: trop de requêtes (429)")
+
+
+async def wait_runway_result(api_key, task_id, on_status=None):
+    # Sondage adaptatif : rapide au début, espacé tant que rien ne change, resserré quand ça avance
+    url = f"{RUNWAY_API_BASE}/tasks/{task_id}"
+    deadline = time.monotonic() + RUNWAY_MAX_WAIT_TIME
+    delay = RUNWAY_POLL_MIN_INTERVAL
+    last = None
+
+    while time.monotonic() < deadline:
+        resp = await get_runway_http().get(url, headers=runway_headers(api_key))
+        if resp.status_code == 429 or resp.status_code >= 500:
+            await asyncio.sleep(retry_after(resp, delay))
+            delay = min(delay * 2, RUNWAY_POLL_MAX_INTERVAL)
+            continue
+        if resp.status_code >= 400:
+            raise RuntimeError(f"Runway error: HTTP {resp.status_code} {resp.text[:500]}")
+
+        j = resp.json()
+        status = str(j.get("status", "")).upper()
 
-    data = resp.json()
-    if "id" not in data:
-        raise HTTPException(500, f"Runway error: {data}")
-    return data["id"]
+        if status == "SUCCEEDED":
+            outputs = j.get("output") or j.get("outputs") or []
+            if not outputs:
+                raise RuntimeError("Runway: tâche terminée sans sortie")
+            first = outputs[0]
+            return first["uri"] if isinstance(first, dict) else first
 
+        if status in ("FAILED", "CANCELLED", "CANCELED"):
+            reason = j.get("failure") or j.get("error") or status.lower()
+            code = j.get("failureCode")
+            raise RuntimeError(f"Runway: {reason}" + (f" ({code})" if code else ""))
 
-async def wait_runway_result(api_key, task_id):
-    headers = {"Authorization": f"Bearer {api_key}"}
-    url = f"https://api.runwayml.com/v1/tasks/{task_id}"
+        current = (status, j.get("progress"))
+        if on_status:
+            on_status(status, j.get("progress"))
+        delay = RUNWAY_POLL_MIN_INTERVAL if current != last and status == "RUNNING" else min(delay * 1.5, RUNWAY_POLL_MAX_INTERVAL)
+        last = current
+        await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
 
+    raise RuntimeError("Runway timeout")
+
+
+async def download_runway_video(url):
+    # Téléchargement en flux, directement dans IMAGES_DIR (fichier temporaire puis renommage)
+    fname = f"runway_{uuid.uuid4().hex}.mp4"
+    path = os.path.join(IMAGES_DIR, fname)
+    tmp = f"{path}.part"
     loop = asyncio.get_event_loop()
+    f = await loop.run_in_executor(None, open, tmp, "wb")
+    try:
+        with timed("download"):
+            async with get_runway_http().stream("GET", url, timeout=httpx.Timeout(RUNWAY_HTTP_TIMEOUT, read=RUNWAY_DOWNLOAD_TIMEOUT)) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(RESULT_STREAM_CHUNK_SIZE):
+                    await loop.run_in_executor(None, f.write, chunk)
+        await loop.run_in_executor(None, f.close)
+        os.replace(tmp, path)
+    except BaseException:
+        f.close()
+        _remove_file(tmp)
+        raise
+    return fname
 
-    for _ in range(60):
-        resp = await loop.run_in_executor(None, lambda: requests.get(url, headers=headers))
-        j = resp.json()
 
-        if j.get("status") == "succeeded":
-            return j["outputs"][0]["uri"]
+def runway_status_message(status, progress):
+    # Statut Runway -> message de progression du bridge
+    if status == "RUNNING":
+        value = int(round(float(progress or 0) * 100))
+        return {"type": "progress", "value": value, "max_value": 100, "node": "runway"}
+    return {"type": "status", "message": f"RunwayML: {status.lower() or 'pending'}"}
 
-        await asyncio.sleep(2)
 
-    raise HTTPException(500, "Runway timeout")
+async def cancel_runway_task(api_key, task_id):
+    # DELETE /tasks/{id} : annule la tâche (ou la supprime si elle est déjà terminée)
+    resp = await get_runway_http().delete(f"{RUNWAY_API_BASE}/tasks/{task_id}", headers=runway_headers(api_key))
+    if resp.status_code >= 400 and resp.status_code != 404:
+        raise RuntimeError(f"Runway error: HTTP {resp.status_code} {resp.text[:500]}")
 
 
-def download_runway_video(url):
-    resp = requests.get(url)
-    resp.raise_for_status()
-    fname = f"runway_{uuid.uuid4().hex}.mp4"
-    path = os.path.join(IMAGES_DIR, fname)
-    with open(path, "wb") as f:
-        f.write(resp.content)
-    return fname
+# Jobs Runway en cours dans ce worker : tâche asyncio, clé et id de tâche Runway (annulation)
+runway_runs: Dict[str, dict] = {}
 
 
 async def run_runway_and_stream(prompt_id, api_key, prompt, image_url, ratio, duration, seed):
+    run = runway_runs[prompt_id] = {"task": asyncio.current_task(), "api_key": api_key, "task_id": None,
+                                    "state": "queued", "cancelled": None}
     try:
-        if prompt_id in active_connections:
-            await active_connections[prompt_id].send_json({
+        slot = runway_slot(api_key)
+        if slot.locked():
+            progress_hub.publish(prompt_id, {"type": "status", "message": "RunwayML: en attente d'un slot pour cette clé"})
+
+        async with slot:
+            progress_hub.publish(prompt_id, {
                 "type": "status",
                 "message": "RunwayML job started"
             })
 
-        rid = await call_runway_i2v(api_key, prompt, image_url, ratio, duration, seed)
-
-        # Fake progress (Runway ne fournit pas de vrai pourcentage)
-        p = 0
-        for _ in range(5):
-            await asyncio.sleep(1)
-            p += 20
-            if prompt_id in active_connections:
-                await active_connections[prompt_id].send_json({
-                    "type": "progress",
-                    "value": p,
-                    "max_value": 100
-                })
-
-        url = await wait_runway_result(api_key, rid)
-
-        fname = download_runway_video(url)
-        
-        file_path = os.path.join(IMAGES_DIR, fname)
-        with open(file_path, "rb") as file_to_read:
-            encoded = base64.b64encode(file_to_read.read()).decode('utf-8')
-
-        final_msg = {
-            "type": "output",
-            "media_type": "video",
-            "mime_type": "video/mp4",
-            "image_base64": encoded,
-            "filename": fname
-        }
+            # Pas d'annulation pendant la création : la tâche Runway serait lancée sans qu'on connaisse son id
+            run["state"] = "submitting"
+            rid = await call_runway_i2v(api_key, prompt, image_url, ratio, duration, seed)
+            run.update(task_id=rid, state="running")
+            if run["cancelled"]:
+                await cancel_runway_task(api_key, rid)
+                raise JobCancelled(run["cancelled"])
+            journal.record(prompt_id, "running", task_id=rid)
+
+            url = await wait_runway_result(
+                api_key, rid,
+                on_status=lambda status, progress: progress_hub.publish(prompt_id, runway_status_message(status, progress))
+            )
+
+            progress_hub.publish(prompt_id, {"type": "progress", "value": 100, "max_value": 100, "node": "runway"})
+            fname = await download_runway_video(url)
+
+        final_msg = build_output_message(prompt_id, {"filename": fname}, "video", source="local")
+
+        publish_result(prompt_id, final_msg)
+        jobs_total.inc("success")
 
-        if prompt_id in active_connections:
-            prompt_results[prompt_id] = final_msg
-            await active_connections[prompt_id].send_json(final_msg)
+    except (JobCancelled, asyncio.CancelledError):
+        if not run["cancelled"]:
+            raise
+        jobs_total.inc("cancelled")
+        await publish_error(prompt_id, run["cancelled"], cancelled=True)
 
     except Exception as e:
-        if prompt_id in active_connections:
-            await active_connections[prompt_id].send_json({
-                "type": "error",
-                "detail": str(e)
-            })
+        jobs_total.inc("error")
+        await publish_error(prompt_id, str(e))
 
     finally:
-        if prompt_id in active_connections:
-            try:
-                await active_connections[prompt_id].close()
-            except:
-                pass
-            active_connections.pop(prompt_id, None)
+        runway_runs.pop(prompt_id, None)
+        progress_hub.end(prompt_id)
+
+# ---------------------------------------------------------------------
+# ANNULATION DES JOBS (DELETE /jobs/{id}, jobs abandonnés)
+# ---------------------------------------------------------------------
+
+class JobCancelled(Exception):
+    pass
+
+
+async def cancel_on_backend(backend: ComfyBackend, prompt_id: str):
+    # Retire le prompt de la file ComfyUI ; s'il est déjà en cours d'exécution, l'interrompt
+    http = get_comfy_http()
+    try:
+        resp = await http.post(f"{backend.url}/queue", json={"delete": [prompt_id]})
+        resp.raise_for_status()
+        resp = await http.get(f"{backend.url}/queue")
+        resp.raise_for_status()
+        running = [e[1] for e in resp.json().get("queue_running", []) if len(e) > 1]
+        if prompt_id in running:
+            # prompt_id ciblé (ComfyUI récent) : l'interruption ne peut pas tomber sur le job suivant
+            resp = await http.post(f"{backend.url}/interrupt", json={"prompt_id": prompt_id})
+            resp.raise_for_status()
+    except Exception as e:
+        print(f"Annulation ComfyUI impossible pour {prompt_id} ({backend.name}): {e}")
+
+
+async def cancel_job(prompt_id: str, reason: str) -> Optional[str]:
+    # Annule un job exécuté par ce worker ; renvoie l'étape à laquelle il a été arrêté, None s'il n'est pas ici
+
+    # Demande greffée sur un job identique : elle seule est retirée, le job continue pour les autres
+    for followers in output_cache.followers.values():
+        if prompt_id in followers:
+            followers.remove(prompt_id)
+            await publish_error(prompt_id, reason, cancelled=True)
+            progress_hub.end(prompt_id)
+            return "coalesced"
+
+    # Job Runway
+    run = runway_runs.get(prompt_id)
+    if run is not None:
+        if not run["cancelled"]:
+            run["cancelled"] = reason
+            if run["state"] == "running":
+                try:
+                    await cancel_runway_task(run["api_key"], run["task_id"])
+                except Exception as e:
+                    print(f"Annulation Runway impossible pour {prompt_id}: {e}")
+            if run["state"] != "submitting":
+                run["task"].cancel()
+        return run["state"]
+
+    job = scheduler.queued.get(prompt_id) or scheduler.inflight.get(prompt_id)
+    if job is None:
+        return None
+    if output_cache.followers.get(prompt_id):
+        raise HTTPException(status_code=409, detail="Des demandes identiques attendent ce job, annulation impossible.")
+    if job.cancelled:
+        return job.state
+    stage = job.state
+    job.cancelled = reason
+    # Plus aucune demande identique ne doit se greffer sur ce job
+    if job.cache_key and output_cache.inflight.get(job.cache_key) is job:
+        del output_cache.inflight[job.cache_key]
+
+    # Encore dans la file du bridge : ComfyUI ne l'a jamais vu
+    if scheduler.remove(prompt_id) is not None:
+        job.state = "cancelled"
+        jobs_total.inc("cancelled")
+        await publish_error(prompt_id, reason, cancelled=True)
+        progress_hub.end(prompt_id)
+        job.done.set()
+        return stage
+
+    # Soumis : le stream s'arrête tout de suite et libère le slot ; ComfyUI retire ou interrompt le prompt
+    # (pendant la soumission, run_comfy_job s'en charge dès que ComfyUI a répondu)
+    job.backend.events.cancel(prompt_id, reason)
+    if stage == "running":
+        await cancel_on_backend(job.backend, prompt_id)
+    return stage
+
+
+async def cancel_quietly(prompt_id: str, reason: str, origin: str) -> Optional[str]:
+    try:
+        stage = await cancel_job(prompt_id, reason)
+    except HTTPException as e:
+        print(f"Annulation de {prompt_id} refusée: {e.detail}")
+        return None
+    if stage is not None:
+        cancellations_total.inc(origin)
+    return stage
+
+
+_abandon_task: Optional[asyncio.Task] = None
+
+async def abandoned_jobs_loop():
+    # Jobs suivis puis délaissés : plus d'abonné WS/SSE ni d'appel à /progress depuis JOB_ABANDON_GRACE secondes
+    while True:
+        await asyncio.sleep(JOB_ABANDON_CHECK_INTERVAL)
+        try:
+            # Présence publiée pour les autres workers : le client peut suivre son job ailleurs
+            shared_state.touch(progress_hub.watched())
+            jobs = list(scheduler.queued.values()) + [j for j in scheduler.inflight.values() if not j.reattach]
+            now = time.time()
+            for job in jobs:
+                ch = progress_hub.get(job.prompt_id)
+                if ch is None or ch.subscribers or job.cancelled or output_cache.followers.get(job.prompt_id):
+                    continue
+                # Soumis mais encore en attente dans la file ComfyUI : toujours "en file" pour le client
+                if ch.state != "queued" and not JOB_ABANDON_RUNNING:
+                    continue
+                seen = [t for t in (ch.seen_at, await shared_state.last_seen(job.prompt_id)) if t is not None]
+                if not seen or now - max(seen) < JOB_ABANDON_GRACE:
+                    continue
+                await cancel_quietly(job.prompt_id, "Job annulé : plus aucun client ne le suit.", "abandoned")
+        except Exception:
+            print(f"ERREUR jobs abandonnés: {traceback.format_exc()}")
 
 
 # ---------------------------------------------------------------------
 # PLACEHOLDER ENGINE
 # ---------------------------------------------------------------------
 
-def apply_placeholders(obj, values):
-    if isinstance(obj, dict):
-        return {k: apply_placeholders(v, values) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [apply_placeholders(v, values) for v in obj]
-    if isinstance(obj, str):
-        for key, val in values.items():
-            obj = obj.replace("{{"+key+"}}", "" if val is None else str(val))
-        return obj
-    return obj
-def load_workflow_json(name):
+# {{cle}} ou {{cle:int}} / {{cle:float}} / {{cle:str}} / {{cle:bool}}
+PLACEHOLDER_RE = re.compile(r"\{\{(\w+)(?::(int|float|str|bool))?\}\}")
+
+def _convert_placeholder(val, kind):
+    if val is None:
+        return ""
+    if kind == "int":
+        return int(float(val))
+    if kind == "float":
+        return float(val)
+    if kind == "bool":
+        return val if isinstance(val, bool) else str(val).lower() in ("1", "true", "yes", "on")
+    if kind == "str":
+        return str(val)
+    return val
+
+
+class PlaceholderSlot:
+    # Chaîne du template contenant au moins un placeholder, découpée une fois pour toutes
+
+    def __init__(self, text: str):
+        self.text = text
+        self.parts = PLACEHOLDER_RE.split(text)  # [littéral, clé, type, littéral, clé, type, ..., littéral]
+        # Placeholder seul ("{{width}}") : la valeur garde son type (int, float...) au lieu d'une chaîne
+        self.exact = len(self.parts) == 4 and self.parts[0] == "" and self.parts[3] == ""
+        self.keys = set(self.parts[1::3])
+
+    def render(self, values: dict):
+        parts = self.parts
+        if self.exact:
+            key, kind = parts[1], parts[2]
+            if key not in values:
+                return self.text
+            return _convert_placeholder(values[key], kind)
+
+        out = [parts[0]]
+        for i in range(1, len(parts), 3):
+            key = parts[i]
+            if key in values:
+                val = values[key]
+                out.append("" if val is None else str(val))
+            else:
+                out.append("{{" + key + (":" + parts[i + 1] if parts[i + 1] else "") + "}}")
+            out.append(parts[i + 2])
+        return "".join(out)
+
+
+class WorkflowTemplate:
+    # Workflow parsé une fois, avec la liste des emplacements (chemin, slot) à remplir
+
+    def __init__(self, name: str, path: str, mtime: float, graph: dict):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+        self.graph = graph
+        self.slots = []
+        self._compile(graph, ())
+        self.placeholders = sorted(set().union(*(slot.keys for _, slot in self.slots))) if self.slots else []
+
+    def _compile(self, obj, path):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                self._compile(v, path + (k,))
+        elif isinstance(obj, list):
+            for i, v in enumerate(obj):
+                self._compile(v, path + (i,))
+        elif isinstance(obj, str) and "{{" in obj and PLACEHOLDER_RE.search(obj):
+            self.slots.append((path, PlaceholderSlot(obj)))
+
+    def render(self, values: dict) -> dict:
+        # Copie légère : chaque nœud et ses inputs sont copiés (modifiables sans toucher au template),
+        # le reste n'est copié que sur le chemin d'un placeholder
+        t0 = time.perf_counter()
+        graph = {}
+        copied = set()
+        for nid, node in self.graph.items():
+            if isinstance(node, dict):
+                node = dict(node)
+                copied.add(id(node))
+                if isinstance(node.get("inputs"), dict):
+                    node["inputs"] = dict(node["inputs"])
+                    copied.add(id(node["inputs"]))
+            graph[nid] = node
+
+        for path, slot in self.slots:
+            container = graph
+            for key in path[:-1]:
+                child = container[key]
+                if id(child) not in copied:
+                    child = list(child) if isinstance(child, list) else dict(child)
+                    copied.add(id(child))
+                    container[key] = child
+                container = child
+            container[path[-1]] = slot.render(values)
+        stage_seconds.observe("render", time.perf_counter() - t0)
+        return graph
+
+
+workflow_templates: Dict[str, WorkflowTemplate] = {}
+
+def _workflow_path(name):
     if not name.endswith(".json"):
         name += ".json"
-    path = os.path.join(WORKFLOWS_DIR, name)
+    return name, os.path.join(WORKFLOWS_DIR, name)
+
+def get_workflow_template(name) -> WorkflowTemplate:
+    name, path = _workflow_path(name)
+    tpl = workflow_templates.get(name)
+    now = time.monotonic()
+    if tpl is not None and now - tpl.checked_at < TEMPLATE_STAT_INTERVAL:
+        return tpl
+
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        mtime = os.stat(path).st_mtime
     except FileNotFoundError:
+        workflow_templates.pop(name, None)
         raise HTTPException(status_code=404, detail=f"Fichier de workflow non trouvé: {name}")
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Erreur JSON dans {name}: {e}")
 
-    return data.get("prompt", data)
+    if tpl is not None and tpl.mtime == mtime:
+        tpl.checked_at = now
+        return tpl
+
+    with timed("template_load"):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Fichier de workflow non trouvé: {name}")
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=500, detail=f"Erreur JSON dans {name}: {e}")
+
+        tpl = WorkflowTemplate(name, path, mtime, data.get("prompt", data))
+    workflow_templates[name] = tpl
+    return tpl
+
+# ---------------------------------------------------------------------
+# CATALOGUE DES WORKFLOWS (/workflows)
+# ---------------------------------------------------------------------
+
+# Nœuds reconnus pour décrire un workflow au front
+WORKFLOW_MODEL_NODES = ("CheckpointLoaderSimple", "CheckpointLoader", "ImageOnlyCheckpointLoader", "UNETLoader",
+                        "DiffusersLoader", "unCLIPCheckpointLoader")
+WORKFLOW_IMAGE_NODES = ("LoadImage", "LoadImageMask")
+REFINER_PLACEHOLDERS = ("base_end_step", "refiner_start_step", "refiner_end_step")
+VIGNETTES_DIR = os.path.join(os.path.dirname(__file__), "vignettes")
+
+
+def encode_json(body) -> dict:
+    # Corps JSON encodé une fois : ETag (contenu) et version gzip précalculés
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    etag = '"' + hashlib.sha1(data).hexdigest()[:20] + '"'
+    return {
+        "data": data,
+        "etag": etag,
+        "gzip": gzip.compress(data, 6) if len(data) >= GZIP_MIN_SIZE else None,
+        "gzip_etag": etag[:-1] + '-gz"',
+    }
+
+
+def encoded_json_response(request: Request, encoded: dict) -> Response:
+    # Revalidation par ETag (304 sans corps), gzip si le client l'accepte
+    use_gzip = encoded["gzip"] is not None and "gzip" in request.headers.get("accept-encoding", "")
+    etag = encoded["gzip_etag"] if use_gzip else encoded["etag"]
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache", "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") in (encoded["etag"], encoded["gzip_etag"]):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(encoded["gzip"], media_type="application/json", headers=headers)
+    return Response(encoded["data"], media_type="application/json", headers=headers)
+
+
+class WorkflowCatalog:
+    # Index des workflows construit une fois ; au plus un listing du dossier par TEMPLATE_STAT_INTERVAL,
+    # seuls les fichiers modifiés (mtime, taille) sont réindexés. Le JSON servi est encodé à chaque changement.
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.entries: Dict[str, dict] = {}
+        self.stamps: Dict[str, tuple] = {}
+        self.graphs: Dict[str, dict] = {}
+        self.encoded: Optional[dict] = None
+        self.checked_at = 0.0
+        self.rebuilds = 0
+        self.indexed = 0
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.encoded is not None and now - self.checked_at < TEMPLATE_STAT_INTERVAL:
+            return
+        self.checked_at = now
+
+        stamps = {}
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(".json") and e.is_file():
+                    st = e.stat()
+                    stamps[e.name] = (st.st_mtime, st.st_size)
+        if self.encoded is not None and stamps == self.stamps:
+            return
+
+        # Copies remplacées d'un bloc : une requête concurrente voit l'ancien ou le nouveau catalogue
+        entries = {}
+        graphs = {}
+        for name, stamp in stamps.items():
+            if self.stamps.get(name) == stamp and name in self.entries:
+                entries[name] = self.entries[name]
+                if name in self.graphs:
+                    graphs[name] = self.graphs[name]
+                continue
+            try:
+                entries[name] = self._index(name)
+                self.indexed += 1
+            except HTTPException as e:
+                print(f"Workflow ignoré ({name}): {e.detail}")
+        self.entries, self.graphs, self.stamps = entries, graphs, stamps
+        self.encoded = encode_json({
+            "workflows": sorted(entries),
+            "items": [entries[name] for name in sorted(entries)],
+        })
+        self.rebuilds += 1
+
+    def _index(self, name: str) -> dict:
+        # Fichier modifié : le template en cache a pu être vérifié il y a moins de TEMPLATE_STAT_INTERVAL
+        workflow_templates.pop(name, None)
+        tpl = get_workflow_template(name)
+        with open(tpl.path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+
+        nodes = [(nid, node) for nid, node in tpl.graph.items() if isinstance(node, dict)]
+        models = [nid for nid, node in nodes if node.get("class_type") in WORKFLOW_MODEL_NODES]
+        images = [nid for nid, node in nodes if node.get("class_type") in WORKFLOW_IMAGE_NODES]
+        refiner = (len(models) > 1 or any(p in tpl.placeholders for p in REFINER_PLACEHOLDERS)
+                   or any("refiner" in str((node.get("_meta") or {}).get("title", "")).lower() for _, node in nodes))
+
+        # Défauts du formulaire (/generate) pour les placeholders du workflow
+        values = placeholder_values(name, GenerateParams().dict())
+        base = name[:-len(".json")]
+        thumbnail = f"vignettes/{base}.png"
+        if not os.path.exists(os.path.join(VIGNETTES_DIR, f"{base}.png")):
+            thumbnail = "vignettes/default.png"
+        return {
+            "name": name,
+            "label": base,
+            "hash": content_hash,
+            "thumbnail": thumbnail,
+            "placeholders": tpl.placeholders,
+            "defaults": {p: values[p] for p in tpl.placeholders if p in values},
+            "model_nodes": models,
+            "image_input_nodes": images,
+            "image_input": bool(images) or "input_image_path" in tpl.placeholders,
+            "refiner": refiner,
+            "sdxl": refiner or "sdxl" in name.lower() or any(p.startswith("sdxl_") for p in tpl.placeholders),
+            "nodes": len(nodes),
+        }
+
+    def listing(self) -> dict:
+        self.refresh()
+        return self.encoded
+
+    def graph(self, name: str) -> dict:
+        self.refresh()
+        name, _ = _workflow_path(name)
+        if name not in self.entries:
+            raise HTTPException(status_code=404, detail=f"Fichier de workflow non trouvé: {name}")
+        encoded = self.graphs.get(name)
+        if encoded is None:
+            encoded = self.graphs[name] = encode_json(get_workflow_template(name).graph)
+        return encoded
+
+    def stats(self) -> dict:
+        return {
+            "workflows": len(self.entries),
+            "rebuilds": self.rebuilds,
+            "indexed": self.indexed,
+            "bytes": len(self.encoded["data"]) if self.encoded else 0,
+            "gzip_bytes": len(self.encoded["gzip"]) if self.encoded and self.encoded["gzip"] else None,
+        }
+
+
+workflow_catalog = WorkflowCatalog(WORKFLOWS_DIR)
+
+# ---------------------------------------------------------------------
+# STARTUP / SHUTDOWN
+# ---------------------------------------------------------------------
+
+def claim_worker_slot():
+    # Emplacement du worker, puis ses dossiers (journal, résultats, cache des sorties) et son client ID ComfyUI
+    global WORKER_SLOT, BRIDGE_CLIENT_ID
+    WORKER_SLOT = _claim_worker_slot(JOURNAL_DIR)
+    journal_dir = worker_dir(JOURNAL_DIR)
+    os.makedirs(journal_dir, exist_ok=True)
+    prompt_results.blob_dir = worker_dir(RESULT_STORE_DIR)
+    os.makedirs(prompt_results.blob_dir, exist_ok=True)
+    output_cache.set_root(worker_dir(OUTPUT_CACHE_DIR))
+    journal.path = os.path.join(journal_dir, "jobs.jsonl")
+    eta_model.path = os.path.join(journal_dir, "eta.json")
+    if isinstance(shared_state, SqliteState):
+        shared_state.origin = f"{os.getpid()}-{WORKER_SLOT}"
+    BRIDGE_CLIENT_ID = worker_client_id(journal_dir)
+    for backend in backend_pool.backends:
+        backend.events.client_id = BRIDGE_CLIENT_ID
+
+
+@app.on_event("startup")
+async def on_startup():
+    claim_worker_slot()
+    prompt_results.clear_orphan_blobs()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, output_cache.load)
+    await loop.run_in_executor(None, variant_cache.load)
+    await loop.run_in_executor(None, journal.load)
+    await loop.run_in_executor(None, eta_model.load)
+    restore_results()
+    journal.start()
+    shared_state.start()
+    backend_pool.start()
+    scheduler.start()
+    asyncio.create_task(recover_jobs())
+    asyncio.create_task(warmup())
+    global _gpu_task, _lag_task, _abandon_task
+    if JOB_ABANDON_GRACE > 0:
+        _abandon_task = asyncio.create_task(abandoned_jobs_loop())
+    _lag_task = asyncio.create_task(loop_lag_monitor())
+    if GPU is not None:
+        _gpu_task = asyncio.create_task(gpu_sampler_loop())
+    gallery.start()
+    affiche_pool.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for batch in batch_runs.values():
+        if batch.task and not batch.task.done():
+            batch.task.cancel()
+    if _gpu_task:
+        _gpu_task.cancel()
+    if _lag_task:
+        _lag_task.cancel()
+    if _abandon_task:
+        _abandon_task.cancel()
+    if affiche_pool.task:
+        affiche_pool.task.cancel()
+    await scheduler.stop()
+    await backend_pool.stop()
+    await close_comfy_http()
+    await close_runway_http()
+    await journal.stop()
+    await shared_state.stop()
+    if eta_model.unsaved:
+        _write_file(eta_model.path, eta_model.snapshot())
+    if gallery.task:
+        gallery.task.cancel()
+    if _image_pool is not None:
+        # Attente de la sortie des process du pool : sans elle, ils survivent au bridge
+        await asyncio.get_event_loop().run_in_executor(
+            None, lambda: _image_pool.shutdown(wait=True, cancel_futures=True))
 
 # ---------------------------------------------------------------------
 # ROUTES
@@ -415,157 +4334,995 @@ def load_workflow_json(name):
 
 @app.get("/")
 def root():
-    return {"status": "ok", "version": BRIDGE_VERSION}
+    return {"status": "ok", "version": BRIDGE_VERSION, "ready": _warmup_done, "worker": WORKER_SLOT}
+
+
+@app.get("/ready")
+def ready():
+    # Sonde de disponibilité : 503 pendant le préchauffage des modèles
+    if not _warmup_done:
+        raise HTTPException(status_code=503, detail="Préchauffage des modèles en cours.")
+    return {"status": "ready", "backends": sum(1 for b in backend_pool.backends if b.available)}
 
 
 @app.get("/gpu_status")
 async def gpu_status():
-    loop = asyncio.get_event_loop()
-    status = await loop.run_in_executor(None, get_gpu_status_sync)
-    return status
+    if GPU is None:
+        return get_gpu_status_sync()
+    if not gpu_telemetry:
+        # Premier appel avant le premier échantillon
+        loop = asyncio.get_event_loop()
+        gpu_telemetry.update(await loop.run_in_executor(None, sample_gpu_sync))
+    return gpu_telemetry
+
+
+def json_with_etag(request: Request, body: dict) -> Response:
+    # Listes servies depuis la mémoire : revalidation par ETag (304 sans corps)
+    return encoded_json_response(request, encode_json(body))
 
 
 @app.get("/checkpoints")
-async def list_checkpoints():
-    cps = await get_checkpoints_from_comfy()
-    return {"checkpoints": cps or [MODEL_CHECKPOINT]}
+def list_checkpoints(request: Request):
+    return json_with_etag(request, {"checkpoints": backend_pool.all_checkpoints() or [MODEL_CHECKPOINT]})
 
 
-@app.get("/workflows")
-def list_workflows():
-    return {"workflows": [f for f in os.listdir(WORKFLOWS_DIR) if f.endswith(".json")]}
+@app.get("/samplers")
+def list_samplers(request: Request):
+    return json_with_etag(request, {
+        "samplers": backend_pool.catalog("KSampler", "sampler_name"),
+        "schedulers": backend_pool.catalog("KSampler", "scheduler"),
+    })
 
 
-@app.get("/workflows/{workflow_name}")
-def get_workflow_json_raw(workflow_name: str):
-    return load_workflow_json(workflow_name)
+@app.get("/vaes")
+def list_vaes(request: Request):
+    return json_with_etag(request, {"vaes": backend_pool.catalog(NODE_TYPE_VAE, "vae_name")})
+
+
+@app.get("/backends")
+def list_backends():
+    return {"backends": [b.status() for b in backend_pool.backends], "queued": len(scheduler.queued)}
+
+
+@app.get("/results/stats")
+def result_store_stats():
+    return prompt_results.stats()
+
+
+@app.get("/cache/stats")
+def output_cache_stats():
+    return output_cache.stats()
+
+
+@app.get("/state/stats")
+def shared_state_stats():
+    return shared_state.stats()
+
+
+@app.get("/variants/stats")
+def variant_cache_stats():
+    return variant_cache.stats()
+
+
+@app.get("/affiche/stats")
+async def affiche_pool_stats():
+    return await asyncio.get_event_loop().run_in_executor(None, affiche_pool.stats)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    results = prompt_results.stats()
+    cache = output_cache.stats()
+    lines = stage_seconds.render() + jobs_total.render() + loop_lag_seconds.render() + progress_messages_total.render() + \
+        previews_total.render() + cancellations_total.render()
+    rss = process_rss_bytes()
+    if rss is not None:
+        lines += render_gauge("bridge_process_resident_memory_bytes", "Mémoire résidente du processus", [({}, rss)])
+    lines += render_gauge("bridge_progress_subscribers", "Abonnés WS / SSE à la progression", [({}, progress_hub.subscriber_count())])
+    lines += render_gauge("bridge_progress_channels", "Canaux de progression en mémoire", [({}, len(progress_hub.channels))])
+    lines += render_gauge("bridge_jobs_queued", "Jobs en attente dans l'ordonnanceur", [({}, len(scheduler.queued))])
+    lines += render_gauge("bridge_jobs_inflight", "Jobs soumis à ComfyUI, non terminés",
+                          [({"backend": b.name}, b.inflight) for b in backend_pool.backends])
+    lines += render_gauge("bridge_backend_queue_depth", "Profondeur de la file ComfyUI",
+                          [({"backend": b.name}, b.queue_depth) for b in backend_pool.backends])
+    lines += render_gauge("bridge_backend_healthy", "Backend ComfyUI joignable",
+                          [({"backend": b.name}, int(b.healthy)) for b in backend_pool.backends])
+    lines += render_gauge("bridge_backend_model_switches_total", "Jobs envoyés avec d'autres modèles que ceux chargés",
+                          [({"backend": b.name}, b.model_switches) for b in backend_pool.backends], "counter")
+    lines += render_gauge("bridge_scheduler_affinity_picks_total", "Jobs avancés dans la file car leurs modèles étaient chargés",
+                          [({}, scheduler.affinity_picks)], "counter")
+    lines += render_gauge("bridge_result_store_entries", "Entrées du cache de résultats", [({}, results["entries"])])
+    lines += render_gauge("bridge_result_store_bytes", "Octets du cache de résultats", [({}, results["bytes"])])
+    lines += render_gauge("bridge_result_store_lookups_total", "Lectures du cache de résultats",
+                          [({"result": "hit"}, results["hits"]), ({"result": "miss"}, results["misses"])], "counter")
+    lines += render_gauge("bridge_output_cache_entries", "Entrées du cache des sorties", [({}, cache["entries"])])
+    lines += render_gauge("bridge_output_cache_bytes", "Octets du cache des sorties", [({}, cache["bytes"])])
+    lines += render_gauge("bridge_output_cache_lookups_total", "Demandes passées par le cache des sorties",
+                          [({"result": k}, cache[k]) for k in ("hits", "coalesced", "misses")], "counter")
+    variants = variant_cache.stats()
+    lines += render_gauge("bridge_variant_cache_bytes", "Octets des variantes post-traitées", [({}, variants["bytes"])])
+    lines += render_gauge("bridge_variant_cache_lookups_total", "Demandes de variantes post-traitées",
+                          [({"result": k}, variants[k]) for k in ("hits", "coalesced", "misses", "failures")], "counter")
+    lines += render_gauge("bridge_batches_running", "Lots en cours",
+                          [({}, sum(1 for b in batch_runs.values() if b.finished_at is None))])
+    gpus = gpu_telemetry.get("gpus", [])
+    if gpus:
+        lines += render_gauge("bridge_gpu_load_percent", "Charge GPU",
+                              [({"gpu": g["id"], "name": g["name"]}, g["load"]) for g in gpus])
+        lines += render_gauge("bridge_gpu_memory_used_gb", "Mémoire GPU utilisée (Go)",
+                              [({"gpu": g["id"], "name": g["name"]}, g["memory_used"]) for g in gpus])
+    return "\n".join(lines) + "\n"
 
 
-@app.get("/result/{prompt_id}")
-async def get_result_image(prompt_id: str):
+@app.get("/workflows")
+def list_workflows(request: Request):
+    return encoded_json_response(request, workflow_catalog.listing())
 
-    # 1. Cache local
-    if prompt_id in prompt_results and prompt_results[prompt_id].get("media_type") in ["image", "video"]:
-        return prompt_results.pop(prompt_id)
 
-    # 2. Historique ComfyUI
-    loop = asyncio.get_event_loop()
-    history_data = await loop.run_in_executor(None, get_history, prompt_id)
+@app.get("/workflows/stats")
+def workflow_catalog_stats():
+    return workflow_catalog.stats()
 
-    if not history_data or prompt_id not in history_data:
-        raise HTTPException(status_code=404, detail="Prompt ID introuvable ou pas terminé.")
 
-    result = history_data[prompt_id]
-    file_info = None
-    media_type = "image"
+@app.get("/workflows/{workflow_name}")
+def get_workflow_json_raw(workflow_name: str, request: Request):
+    return encoded_json_response(request, workflow_catalog.graph(workflow_name))
 
-    for _, node_output in result["outputs"].items():
-        if "images" in node_output and node_output["images"]:
-            file_info = node_output["images"][0]
-            media_type = "image"
-            break
-        if "gifs" in node_output and node_output["gifs"]:
-            file_info = node_output["gifs"][0]
-            media_type = "video"
-            break
 
-    if not file_info:
-        raise HTTPException(status_code=404, detail="Aucune sortie image/vidéo trouvée.")
+@app.get("/jobs")
+def list_jobs(request: Request, offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500),
+              state: Optional[str] = Query(None), mine: bool = Query(False)):
+    entries, total = journal.page(offset, limit, state, get_user_key(request) if mine else None)
+    return {
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "items": [journal.public(e) for e in entries],
+    }
 
-    filename = file_info["filename"]
-    subfolder = file_info.get("subfolder", "output")
-    image_type = file_info.get("type", "output")
 
-    try:
-        response = requests.get(
-            f"{COMFYUI_HOST}/view",
-            params={"filename": filename, "subfolder": subfolder, "type": image_type}
-        )
-        response.raise_for_status()
-        encoded = base64.b64encode(response.content).decode('utf-8')
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Erreur de récupération du fichier final.")
+@app.get("/jobs/stats")
+def job_journal_stats():
+    return dict(journal.stats(), eta=eta_model.stats())
+
+
+@app.get("/jobs/{prompt_id}")
+async def get_job(prompt_id: str):
+    entry = journal.get(prompt_id)
+    if entry is None:
+        # Job soumis à un autre worker
+        shared = await shared_state.get_job(prompt_id)
+        if shared is None:
+            raise HTTPException(status_code=404, detail="Job inconnu.")
+        shared.pop("user", None)
+        return dict(shared, queue_position=None)
+    return dict(journal.public(entry), queue_position=scheduler.position(prompt_id))
+
+
+@app.delete("/jobs/{prompt_id}")
+async def delete_job(prompt_id: str, request: Request):
+    # En file : retiré de la file (bridge ou ComfyUI) ; en cours : interrompu (ComfyUI /interrupt, Runway DELETE)
+    entry = journal.get(prompt_id)
+    shared = None if entry is not None else await shared_state.get_job(prompt_id)
+    if entry is None and shared is None:
+        raise HTTPException(status_code=404, detail="Job inconnu.")
+    user = get_user_key(request)
+    if (entry or shared).get("user") not in (None, user):
+        raise HTTPException(status_code=403, detail="Ce job appartient à un autre utilisateur.")
+    state = (entry or shared)["state"]
+    if state in JOURNAL_FINAL_STATES:
+        raise HTTPException(status_code=409, detail=f"Job déjà terminé ({state}).")
+
+    reason = "Job annulé à la demande du client."
+    stage = await cancel_job(prompt_id, reason)
+    if stage is not None:
+        cancellations_total.inc("client")
+        await shared_state.flush()
+        return {"prompt_id": prompt_id, "status": "cancelled", "stage": stage}
+    if entry is not None:
+        raise HTTPException(status_code=409, detail="Job en cours de finalisation, annulation impossible.")
+
+    # Job exécuté par un autre worker : la demande lui parvient par l'état partagé, avec le demandeur
+    # (le worker propriétaire la vérifie contre son journal)
+    shared_state.publish(prompt_id, {"type": "cancel_request", "detail": reason, "user": user})
+    await shared_state.flush()
+    return {"prompt_id": prompt_id, "status": "cancelling", "stage": state}
 
-    mime_type = response.headers.get("Content-Type", "image/png")
 
-    final_http_result = {
-        "type": "output",
-        "image_base64": encoded,
-        "filename": filename,
-        "mime_type": mime_type,
-        "media_type": media_type
-    }
+@app.get("/result/{prompt_id}")
+async def get_result_image(prompt_id: str, inline: bool = Query(False, alias="base64"),
+                           fmt: Optional[str] = Query(None, alias="format"), quality: Optional[int] = Query(None),
+                           width: Optional[int] = Query(None), metadata: Optional[str] = Query(None)):
+    spec = parse_variant(fmt, quality, width, metadata)
+
+    # 1. Cache local (lecture non destructive), ou résultat d'un autre worker
+    result = await shared_result(prompt_id)
+    if result and result.get("cancelled"):
+        raise HTTPException(status_code=410, detail=result["detail"])
+    if result and result.get("type") == "error":
+        raise HTTPException(status_code=500, detail=result["detail"])
+    if not result or result.get("media_type") not in ["image", "video"]:
+        # 2. Historique ComfyUI
+        history_data = await get_history(prompt_id)
+
+        if not history_data or prompt_id not in history_data:
+            raise HTTPException(status_code=404, detail="Prompt ID introuvable ou pas terminé.")
+
+        result = result_from_history(prompt_id, history_data[prompt_id])
+        if not result:
+            raise HTTPException(status_code=404, detail="Aucune sortie image/vidéo trouvée.")
+        prompt_results.put(prompt_id, result)
+
+    # Variante demandée ici : remplace celle choisie à la soumission
+    if spec:
+        result = with_variant_urls(result, spec)
+    if inline or RESULT_INLINE_BASE64:
+        try:
+            result = await with_inline_base64(result)
+        except HTTPException:
+            raise
+        except Exception:
+            raise HTTPException(status_code=500, detail="Erreur de récupération du fichier final.")
+    return result
+
+
+@app.get("/result/{prompt_id}/file")
+async def get_result_file(prompt_id: str, request: Request, index: int = Query(0, ge=0),
+                          fmt: Optional[str] = Query(None, alias="format"), quality: Optional[int] = Query(None),
+                          width: Optional[int] = Query(None), metadata: Optional[str] = Query(None)):
+    spec = parse_variant(fmt, quality, width, metadata)
+    result = await shared_result(prompt_id)
+    if not result:
+        history_data = await get_history(prompt_id)
+        if prompt_id in history_data:
+            result = result_from_history(prompt_id, history_data[prompt_id])
+    if not result:
+        raise HTTPException(status_code=404, detail="Prompt ID introuvable ou pas terminé.")
+    # Job annulé ou en échec : mêmes codes que /result, pas de fichier
+    if result.get("cancelled"):
+        raise HTTPException(status_code=410, detail=result["detail"])
+    if result.get("type") == "error":
+        raise HTTPException(status_code=500, detail=result["detail"])
+
+    # Exécution à plusieurs images (batch_size) : fichier n° index
+    if index:
+        items = result.get("items") or []
+        if index >= len(items):
+            raise HTTPException(status_code=404, detail="Index de sortie introuvable.")
+        result = dict(result, **items[index])
+
+    # Variante post-traitée : rendue une fois dans le pool de processus, puis servie depuis le disque
+    if spec:
+        name = variant_name(result, spec)
+        etag = f'"{name}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+        try:
+            path = await result_variant_path(prompt_id, index, result, spec)
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"Post-traitement impossible pour {prompt_id}: {e}")
+            raise HTTPException(status_code=500, detail="Post-traitement impossible.")
+        return FileResponse(path, media_type=VARIANT_MIME[spec["format"]],
+                            headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+
+    # Sortie dédupliquée : blob adressé par contenu, l'ETag est son sha256
+    if result.get("source") == "cache":
+        path = output_cache.blob_path(result["blob"])
+        if path is None:
+            raise HTTPException(status_code=404, detail="Fichier évincé du cache.")
+        etag = f'"{result["blob"]}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return FileResponse(path, media_type=result["mime_type"],
+                            headers={"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"})
+
+    # Vidéos Runway : fichier local (FileResponse gère Range / ETag / Content-Length)
+    if result.get("source") == "local":
+        path = os.path.join(IMAGES_DIR, result["filename"])
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Fichier introuvable.")
+        return FileResponse(path, media_type=result["mime_type"], headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+    # Sorties ComfyUI : noms uniques et immuables, l'ETag se déduit de l'emplacement
+    etag = '"' + hashlib.sha1(output_location(result).encode("utf-8")).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    blob = prompt_results.blob_path(prompt_id) if index == 0 else None
+    if blob:
+        return FileResponse(blob, media_type=result["mime_type"],
+                            headers={"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"})
+
+    return await stream_comfy_output(result, request.headers.get("range"), etag)
+
+
+async def shared_result(prompt_id: str) -> Optional[dict]:
+    # Cache local, sinon résultat publié par un autre worker
+    return prompt_results.get(prompt_id) or await shared_state.get_result(prompt_id)
+
+
+async def subscribe_progress(prompt_id: str) -> Optional[ProgressSubscriber]:
+    # Canal en mémoire ; sinon résultat encore en cache (canal purgé, job d'un autre chemin)
+    if progress_hub.get(prompt_id) is None:
+        cached = await shared_result(prompt_id)
+        if cached is not None:
+            progress_hub.deliver(prompt_id, cached)
+            progress_hub.deliver(prompt_id, None)
+        elif await shared_state.get_job(prompt_id) is None:
+            return None
+        # Sinon job d'un autre worker, pas encore commencé : ses évènements arrivent par l'état partagé
+    return progress_hub.subscribe(prompt_id)
+
+
+@app.get("/progress/{prompt_id}")
+async def get_progress(prompt_id: str):
+    # Un client qui interroge /progress suit encore son job (jobs abandonnés)
+    progress_hub.touch(prompt_id)
+    snapshot = progress_hub.snapshot(prompt_id)
+    if snapshot is None:
+        cached = await shared_result(prompt_id)
+        if cached is None:
+            job = await shared_state.get_job(prompt_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail="Prompt ID inconnu.")
+            state = "running" if job["state"] in ("submitting", "running") else "queued"
+            return {"prompt_id": prompt_id, "state": state, "status": {"status_str": state, "completed": False},
+                    "queue_position": None, "queue_length": None, "progress": None, "result": None,
+                    "subscribers": 0, "updated_at": job["updated_at"]}
+        if cached.get("type") == "error":
+            state = "cancelled" if cached.get("cancelled") else "failed"
+        else:
+            state = "completed"
+        snapshot = {"prompt_id": prompt_id, "state": state, "status": {"status_str": state, "completed": True},
+                    "queue_position": None, "queue_length": None, "progress": None, "result": cached,
+                    "subscribers": 0, "updated_at": None}
+    return snapshot
+
+
+@app.get("/progress/{prompt_id}/events")
+async def progress_events(prompt_id: str):
+    sub = await subscribe_progress(prompt_id)
+    if sub is None:
+        raise HTTPException(status_code=404, detail="Prompt ID inconnu.")
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    msg = await asyncio.wait_for(sub.get(), timeout=SSE_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if msg is None:
+                    return
+                yield f"event: {msg.get('type', 'message')}\ndata: {json.dumps(msg)}\n\n"
+        finally:
+            progress_hub.unsubscribe(prompt_id, sub)
 
-    prompt_results[prompt_id] = final_http_result
-    return final_http_result
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.websocket("/ws/progress/{prompt_id}")
-async def websocket_endpoint(ws: WebSocket, prompt_id: str):
+async def websocket_endpoint(ws: WebSocket, prompt_id: str, inline: bool = Query(False, alias="base64"),
+                             preview: bool = Query(False)):
     await ws.accept()
-    active_connections[prompt_id] = ws
+    ws.state.inline_base64 = inline
 
-    if prompt_id in prompt_results:
-        await ws.send_json(prompt_results.pop(prompt_id))
+    sub = await subscribe_progress(prompt_id)
+    if sub is None:
+        await ws.send_json({"type": "error", "prompt_id": prompt_id, "detail": "Prompt ID inconnu."})
         await ws.close()
         return
+    # Previews latentes en frames binaires, sur demande (les clients JSON seuls ne les reçoivent pas)
+    sub.wants_preview = preview
 
-    try:
+    async def pump():
+        # Seul ce coroutine écrit sur la socket : un client lent ne ralentit que lui-même
+        while True:
+            msg = await sub.get()
+            if msg is None:
+                return
+            if msg is PREVIEW_READY:
+                frame = sub.take_preview()
+                if frame is not None:
+                    await ws.send_bytes(frame)
+            elif msg.get("type") in TERMINAL_MESSAGES:
+                await send_output(ws, msg)
+            else:
+                await ws.send_json(msg)
+
+    async def drain():
         while True:
             await ws.receive_text()
-    except:
-        pass
+
+    tasks = [asyncio.create_task(pump()), asyncio.create_task(drain())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
     finally:
-        active_connections.pop(prompt_id, None)
+        for task in tasks:
+            task.cancel()
+        progress_hub.unsubscribe(prompt_id, sub)
+        try:
+            await ws.close()
+        except:
+            pass
 
 # ---------------------------------------------------------------------
 # UPLOAD IMAGE
 # ---------------------------------------------------------------------
 
+# Images uploadées : nom ComfyUI -> copie locale + backends qui l'ont déjà reçue
+UPLOADED_INPUTS_MAX = 10000
+uploaded_inputs: "OrderedDict[str, dict]" = OrderedDict()
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+
+def get_image_pool() -> ProcessPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        # spawn : les process du pool ne chargent que bridge_images (ni fork du bridge, ni verrous hérités)
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _image_pool
+
+
+async def push_input_image(local_name: str, comfy_name: str, subfolder: str, backend: ComfyBackend) -> dict:
+    # Multipart écrit à la main pour envoyer le fichier en flux, sans le charger en mémoire
+    local_path = os.path.join(IMAGES_DIR, local_name)
+    boundary = uuid.uuid4().hex
+    fields = {"subfolder": subfolder, "type": "input", "overwrite": "true"}
+    head = "".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n' for k, v in fields.items())
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{comfy_name}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n')
+    head = head.encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    size = os.path.getsize(local_path)
+    loop = asyncio.get_event_loop()
+
+    async def body():
+        yield head
+        f = await loop.run_in_executor(None, open, local_path, "rb")
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+        yield tail
+
+    resp = await get_comfy_http().post(
+        f"{backend.url}/upload/image", content=body(),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}",
+                 "Content-Length": str(len(head) + size + len(tail))},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+async def ensure_input_image(comfy_name: str, backend: ComfyBackend):
+    # Le job peut être routé vers un autre backend que celui de l'upload : on recopie l'image
+    entry = uploaded_inputs.get(comfy_name)
+    if entry is None or backend.name in entry["backends"]:
+        return
+    await push_input_image(entry["local"], comfy_name, entry["subfolder"], backend)
+    entry["backends"].add(backend.name)
+
+def input_image_backend(comfy_name: str) -> ComfyBackend:
+    entry = uploaded_inputs.get(comfy_name)
+    if entry:
+        for name in entry["backends"]:
+            return backend_pool.get(name)
+    return backend_pool.default
+
+
+async def receive_upload(file: UploadFile, tmp_path: str) -> str:
+    # Écriture par morceaux + hash au fil de l'eau ; renvoie le sha256 du contenu
+    loop = asyncio.get_event_loop()
+    digest = hashlib.sha256()
+    size = 0
+    f = await loop.run_in_executor(None, open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Image trop volumineuse.")
+            digest.update(chunk)
+            await loop.run_in_executor(None, f.write, chunk)
+    except BaseException:
+        f.close()
+        _remove_file(tmp_path)
+        raise
+    await loop.run_in_executor(None, f.close)
+    return digest.hexdigest()
+
+
+def upload_response(name: str, entry: dict, sha: str, deduplicated: bool) -> dict:
+    return {
+        "local_path": f"images/{entry['local']}",
+        "comfy_path": name,
+        "subfolder": entry["subfolder"],
+        "type": "input",
+        "backend": next(iter(entry["backends"]), None),
+        "sha256": sha,
+        "deduplicated": deduplicated,
+    }
+
+
 @app.post("/upload/image")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(
+    file: UploadFile = File(...),
+    # Résolution cible du workflow : réduction côté serveur si l'image est plus grande
+    width: Optional[int] = Form(None),
+    height: Optional[int] = Form(None),
+):
 
     ext = os.path.splitext(file.filename)[1].lower()
     if ext not in [".png", ".jpg", ".jpeg", ".webp"]:
         raise HTTPException(status_code=400, detail="Format non supporté.")
 
-    safe_name = f"{uuid.uuid4().hex}{ext}"
+    tmp_path = os.path.join(IMAGES_DIR, f"upload_{uuid.uuid4().hex}.part")
+    sha = await receive_upload(file, tmp_path)
+
+    # Nom dérivé du contenu (et de la cible de réduction) : même image -> même nom
+    downscale = Image is not None and bool(width) and bool(height) and width > 0 and height > 0
+    safe_name = f"{sha[:32]}_{width}x{height}{ext}" if downscale else f"{sha[:32]}{ext}"
     local_path = os.path.join(IMAGES_DIR, safe_name)
-    content = await file.read()
 
-    with open(local_path, "wb") as f:
-        f.write(content)
+    entry = uploaded_inputs.get(safe_name)
+    if entry is not None and os.path.isfile(local_path):
+        _remove_file(tmp_path)
+        uploaded_inputs.move_to_end(safe_name)
+        return upload_response(safe_name, entry, sha, True)
 
-    # Upload vers ComfyUI
+    loop = asyncio.get_event_loop()
+    if os.path.isfile(local_path):
+        # Déjà sur disque (process précédent) : seul l'envoi à ComfyUI manque
+        _remove_file(tmp_path)
+    elif downscale:
+        try:
+            resized = await loop.run_in_executor(get_image_pool(), downscale_image, tmp_path, local_path, width, height)
+        except Exception:
+            _remove_file(tmp_path)
+            raise HTTPException(status_code=400, detail="Image illisible.")
+        if resized:
+            _remove_file(tmp_path)
+        else:
+            os.replace(tmp_path, local_path)
+    else:
+        os.replace(tmp_path, local_path)
+
+    # Upload vers le backend ComfyUI le moins chargé
+    backend = backend_pool.choose() or backend_pool.default
     try:
-        with open(local_path, "rb") as f:
-            files = {"image": (safe_name, f, "application/octet-stream")}
-            data = {"subfolder": "user_images", "type": "input"}
-            resp = requests.post(f"{COMFYUI_HOST}/upload/image", files=files, data=data)
-            resp.raise_for_status()
-            j = resp.json()
+        j = await push_input_image(safe_name, safe_name, "user_images", backend)
     except Exception as e:
-        if os.path.exists(local_path):
-            os.remove(local_path)
         raise HTTPException(status_code=500, detail=f"Erreur upload ComfyUI: {e}")
 
     comfy_name = j.get("name", safe_name)
     comfy_subfolder = j.get("subfolder", "user_images")
-    comfy_type = j.get("type", "input")
 
-    return {
-        "local_path": f"images/{safe_name}",
-        "comfy_path": comfy_name,
-        "subfolder": comfy_subfolder,
-        "type": comfy_type
+    entry = {"local": safe_name, "subfolder": comfy_subfolder, "backends": {backend.name}}
+    uploaded_inputs[comfy_name] = entry
+    while len(uploaded_inputs) > UPLOADED_INPUTS_MAX:
+        uploaded_inputs.popitem(last=False)
+
+    return upload_response(comfy_name, entry, sha, False)
+
+# ---------------------------------------------------------------------
+# GALERIE (index automatique + vignettes / variantes)
+# ---------------------------------------------------------------------
+
+def gallery_formats() -> List[str]:
+    if Image is None:
+        return []
+    formats = ["webp"] if pil_features.check("webp") else ["jpeg"]
+    try:
+        if pil_features.check("avif"):
+            formats.append("avif")
+    except ValueError:
+        pass
+    return formats
+
+
+
+class GalleryIndex:
+    # Index des images des dossiers de galerie, mis à jour par sondage des mtime.
+    # Les variantes portent une clé dérivée de (chemin, mtime, taille) : immuables, cache long côté client.
+
+    def __init__(self, sources: Dict[str, str], cache_dir: str):
+        self.sources = sources
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.items: Dict[str, dict] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.scans = 0
+        self.generated = 0
+        self.failures = 0
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                self.items = json.load(f)
+        except (OSError, ValueError):
+            self.items = {}
+
+    def save(self):
+        _write_file(self.index_path, json.dumps(self.items, ensure_ascii=False).encode("utf-8"))
+
+    def list_sources(self) -> List[dict]:
+        # Un original par nom de base : PNG en priorité, les *_thumb.jpg faits main sont ignorés
+        found = {}
+        for source, directory in self.sources.items():
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                stem, ext = os.path.splitext(entry.name)
+                if not entry.is_file() or ext.lower() not in GALLERY_EXTENSIONS or stem.endswith("_thumb"):
+                    continue
+                item_id = f"{source}/{stem}"
+                rank = GALLERY_EXTENSIONS.index(ext.lower())
+                if item_id in found and found[item_id]["rank"] <= rank:
+                    continue
+                st = entry.stat()
+                found[item_id] = {"id": item_id, "source": source, "name": entry.name, "path": entry.path,
+                                  "mtime": st.st_mtime, "size": st.st_size, "rank": rank}
+        return list(found.values())
+
+    async def scan(self):
+        loop = asyncio.get_event_loop()
+        listing = await loop.run_in_executor(None, self.list_sources)
+        seen = {f["id"] for f in listing}
+        changed = False
+
+        for item_id in [i for i in self.items if i not in seen]:
+            await loop.run_in_executor(None, self.remove_variants, self.items.pop(item_id))
+            changed = True
+
+        todo = []
+        for f in listing:
+            item = self.items.get(f["id"])
+            if item is None or item["name"] != f["name"] or item["mtime"] != f["mtime"] or item["size"] != f["size"]:
+                todo.append(f)
+
+        # Variantes générées dans le pool de processus, IMAGE_WORKERS à la fois
+        formats = gallery_formats()
+        sem = asyncio.Semaphore(IMAGE_WORKERS)
+
+        async def process(f):
+            key = hashlib.sha1(f"{f['id']}:{f['name']}:{f['mtime']}:{f['size']}".encode("utf-8")).hexdigest()[:20]
+            info = {"width": None, "height": None, "variants": []}
+            if formats:
+                async with sem:
+                    try:
+                        info = await loop.run_in_executor(get_image_pool(), make_gallery_variants, f["path"],
+                                                          self.cache_dir, key, GALLERY_WIDTHS, formats)
+                        self.generated += 1
+                    except Exception as e:
+                        self.failures += 1
+                        print(f"Galerie: variantes impossibles pour {f['path']}: {e}")
+            old = self.items.get(f["id"])
+            self.items[f["id"]] = {"id": f["id"], "source": f["source"], "name": f["name"], "mtime": f["mtime"],
+                                   "size": f["size"], "key": key, **info}
+            if old and old.get("key") != key:
+                await loop.run_in_executor(None, self.remove_variants, old)
+
+        if todo:
+            await asyncio.gather(*(process(f) for f in todo))
+            changed = True
+        if changed:
+            await loop.run_in_executor(None, self.save)
+        self.scans += 1
+
+    def remove_variants(self, item: dict):
+        for v in item.get("variants", []):
+            _remove_file(os.path.join(self.cache_dir, v["file"]))
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.load()
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.scan()
+            except Exception:
+                print(f"Galerie: erreur d'indexation: {traceback.format_exc()}")
+            await asyncio.sleep(GALLERY_SCAN_INTERVAL)
+
+    def public_item(self, item: dict) -> dict:
+        variants = {}
+        for v in item.get("variants", []):
+            variants.setdefault(v["format"], []).append({"width": v["width"], "height": v["height"],
+                                                         "url": f"/gallery/file/{v['file']}", "bytes": v["bytes"]})
+        preferred = variants.get("webp") or variants.get("jpeg") or []
+        source, name = item["source"], item["name"]
+        return {
+            "id": item["id"],
+            "source": source,
+            "name": name,
+            "width": item.get("width"),
+            "height": item.get("height"),
+            "mtime": item["mtime"],
+            "original": f"/gallery/original/{quote(source)}/{quote(name)}?v={item['key']}",
+            "thumb": preferred[0]["url"] if preferred else None,
+            "large": preferred[-1]["url"] if preferred else None,
+            "variants": variants,
+        }
+
+    def page(self, source: Optional[str], page: int, per_page: int):
+        items = [i for i in self.items.values() if source is None or i["source"] == source]
+        items.sort(key=lambda i: (-i["mtime"], i["id"]))
+        start = (page - 1) * per_page
+        return items[start:start + per_page], len(items)
+
+
+gallery = GalleryIndex(GALLERY_DIRS, GALLERY_CACHE_DIR)
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+@app.get("/gallery")
+def list_gallery(request: Request, source: Optional[str] = Query(None), page: int = Query(1, ge=1),
+                 per_page: int = Query(48, ge=1, le=GALLERY_PAGE_MAX)):
+    items, total = gallery.page(source, page, per_page)
+    etag = '"' + hashlib.sha1(json.dumps([total, page, per_page] + [i["key"] for i in items]).encode("utf-8")).hexdigest() + '"'
+    # L'index change : revalidation à chaque fois (304 sans corps si rien n'a bougé)
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    body = {
+        "items": [gallery.public_item(i) for i in items],
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "pages": (total + per_page - 1) // per_page,
     }
+    return Response(json.dumps(body, ensure_ascii=False), media_type="application/json", headers=headers)
+
+
+@app.get("/gallery/file/{name}")
+def gallery_file(name: str, request: Request):
+    if "/" in name or "\\" in name or name.startswith("."):
+        raise HTTPException(status_code=404, detail="Variante introuvable.")
+    path = os.path.join(gallery.cache_dir, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Variante introuvable.")
+    etag = f'"{name}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+    return FileResponse(path, media_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+                        headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+
+
+@app.get("/gallery/original/{source}/{name}")
+def gallery_original(source: str, name: str, request: Request):
+    item = gallery.items.get(f"{source}/{os.path.splitext(name)[0]}")
+    if item is None or item["name"] != name or source not in gallery.sources:
+        raise HTTPException(status_code=404, detail="Image introuvable.")
+    etag = f'"{item["key"]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+    return FileResponse(os.path.join(gallery.sources[source], name),
+                        headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+
+# ---------------------------------------------------------------------
+# POST-TRAITEMENT DES SORTIES (conversion, réduction, métadonnées)
+# ---------------------------------------------------------------------
+
+VARIANT_MIME = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+VARIANT_METADATA = ("strip", "embed")
+
+# Variantes demandées à la soumission (/generate) : appliquées au message final du job
+output_variants: Dict[str, dict] = {}
+
+def variant_formats() -> List[str]:
+    return sorted({"png", "jpeg"} | set(gallery_formats()))
+
+def parse_variant(fmt: Optional[str], quality: Optional[int], width: Optional[int],
+                  metadata: Optional[str]) -> Optional[dict]:
+    # Aucun paramètre : sortie brute, sans post-traitement
+    if fmt is None and quality is None and width is None and metadata is None:
+        return None
+    if Image is None:
+        raise HTTPException(status_code=501, detail="Post-traitement indisponible (Pillow absent).")
+    fmt = (fmt or "png").lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in variant_formats():
+        raise HTTPException(status_code=400, detail=f"Format non supporté: {fmt} ({', '.join(variant_formats())})")
+    metadata = metadata or "strip"
+    if metadata not in VARIANT_METADATA:
+        raise HTTPException(status_code=400, detail=f"Métadonnées: {' ou '.join(VARIANT_METADATA)}")
+    if width is not None and not 16 <= width <= VARIANT_MAX_WIDTH:
+        raise HTTPException(status_code=400, detail=f"Largeur hors bornes (16..{VARIANT_MAX_WIDTH})")
+    if quality is not None and not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="Qualité hors bornes (1..100)")
+    return {"format": fmt, "quality": (quality or VARIANT_QUALITY[fmt]) if fmt in VARIANT_QUALITY else 0,
+            "width": width or 0, "metadata": metadata}
+
+def variant_query(spec: dict) -> str:
+    # Forme canonique : sert d'URL et de clé de cache
+    params = {"format": spec["format"]}
+    if spec["quality"]:
+        params["quality"] = spec["quality"]
+    if spec["width"]:
+        params["width"] = spec["width"]
+    params["metadata"] = spec["metadata"]
+    return urlencode(params)
+
+def with_variant_urls(msg: dict, spec: Optional[dict]) -> dict:
+    if not spec or msg.get("type") != "output" or msg.get("media_type") != "image":
+        return msg
+    query = variant_query(spec)
+    msg = dict(msg, variant=spec, url=f"/result/{msg['prompt_id']}/file?{query}")
+    if msg.get("items"):
+        msg["items"] = [dict(item, url=f"/result/{msg['prompt_id']}/file?index={i}&{query}")
+                        for i, item in enumerate(msg["items"])]
+    return msg
+
+
+
+class VariantCache:
+    # Variantes sur disque, LRU borné en octets. Le nom dérive de (sortie, variante) : contenu immuable.
+    # Une variante demandée plusieurs fois pendant son rendu n'est calculée qu'une fois.
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.evictions = 0
+
+    def load(self):
+        # Variantes d'un process précédent : reprises, les plus anciennes évincées en premier
+        found = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".tmp"):
+                _remove_file(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._enforce()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    async def get(self, name: str, spec: dict, load_source, generation: Optional[dict]) -> str:
+        if name in self.entries and os.path.isfile(self.path(name)):
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return self.path(name)
+        pending = self.pending.get(name)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending[name] = future
+        try:
+            src = await load_source()
+            with timed("postprocess"):
+                info = await loop.run_in_executor(
+                    get_image_pool(), render_variant, src, self.path(name), spec["format"], spec["quality"],
+                    spec["width"], generation if spec["metadata"] == "embed" else None)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.failures += 1
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self.pending[name]
+        self.entries[name] = info["bytes"]
+        self.total_bytes += info["bytes"]
+        self._enforce()
+        future.set_result(self.path(name))
+        return self.path(name)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "rendering": len(self.pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "evictions": self.evictions,
+        }
+
+    def _enforce(self):
+        # La variante la plus récente reste, même seule au-dessus du budget : elle va être servie
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            _remove_file(self.path(name))
+
+
+variant_cache = VariantCache(VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES)
+
+def variant_name(result: dict, spec: dict) -> str:
+    identity = f"blob:{result['blob']}" if result.get("source") == "cache" else output_location(result)
+    key = hashlib.sha1(f"{identity}|{variant_query(spec)}".encode("utf-8")).hexdigest()[:24]
+    return f"{key}.{'jpg' if spec['format'] == 'jpeg' else spec['format']}"
+
+async def result_variant_path(prompt_id: str, index: int, result: dict, spec: dict) -> str:
+    if result.get("media_type") != "image":
+        raise HTTPException(status_code=400, detail="Post-traitement réservé aux images.")
+
+    async def load_source():
+        # Chemin si la sortie est déjà sur disque (cache dédupliqué, blob du cache de résultats), sinon octets
+        if result.get("source") == "cache":
+            path = output_cache.blob_path(result["blob"])
+            if path is None:
+                raise HTTPException(status_code=404, detail="Fichier évincé du cache.")
+            return path
+        blob = prompt_results.blob_path(prompt_id) if index == 0 else None
+        if blob:
+            return blob
+        data = await read_output_bytes(result)
+        if index == 0 and result.get("source") == "comfyui":
+            await prompt_results.put_blob(prompt_id, data)
+        return data
+
+    return await variant_cache.get(variant_name(result, spec), spec, load_source, result.get("generation"))
+
+async def prerender_variants(prompt_id: str, msg: dict):
+    # Variante demandée à la soumission : rendue avant la livraison, le premier téléchargement est immédiat
+    spec = output_variants.get(prompt_id)
+    if not spec or msg.get("media_type") != "image":
+        return
+    items = msg.get("items") or [{}]
+    try:
+        await asyncio.gather(*(result_variant_path(prompt_id, i, dict(msg, **item), spec)
+                               for i, item in enumerate(items)))
+    except Exception as e:
+        # La sortie brute reste livrable ; la variante sera retentée au téléchargement
+        print(f"Post-traitement impossible pour {prompt_id}: {e}")
 
 # ---------------------------------------------------------------------
 # GENERATE (ENTRY POINT)
 # ---------------------------------------------------------------------
 
+def placeholder_values(workflow_name: str, params: dict) -> dict:
+    values = dict(params)
+    values["cfg"] = values["cfg_scale"]
+
+    if workflow_name == "sdxl_simple_example.json" or "sdxl" in workflow_name.lower():
+        if values.get("base_end_step") is None:
+            values["base_end_step"] = 18.0
+        if values.get("refiner_start_step") is None:
+            values["refiner_start_step"] = 18.0
+        if values.get("refiner_end_step") is None:
+            values["refiner_end_step"] = 30.0
+    return values
+
+
 @app.post("/generate")
 async def generate(
+    request: Request,
     background_tasks: BackgroundTasks,
     workflow_name: str = Query(...),
 
@@ -595,8 +5352,22 @@ async def generate(
     sdxl_mode: Optional[str] = Form(None),
     sdxl_quality: Optional[str] = Form(None),
 
-    runway_api_key: Optional[str] = Form(None)
+    runway_api_key: Optional[str] = Form(None),
+
+    priority: str = Form("interactive"),
+
+    output_format: Optional[str] = Form(None),
+    output_quality: Optional[int] = Form(None),
+    output_width: Optional[int] = Form(None),
+    output_metadata: Optional[str] = Form(None)
 ):
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(400, f"Priorité inconnue: {priority}")
+    variant = parse_variant(output_format, output_quality, output_width, output_metadata)
+
+    # Seed fixe : le résultat est reproductible, donc partageable (cache des sorties)
+    cacheable = seed >= 0
+
     # Correction du seed
     if seed < 0:
         seed = random.randint(0, 2**32 - 1)
@@ -613,8 +5384,11 @@ async def generate(
             raise HTTPException(400, "Missing input image")
 
         prompt_id = str(uuid.uuid4())
+        progress_hub.open(prompt_id)
+        journal.record(prompt_id, "queued", kind="runway", user=get_user_key(request), priority=priority,
+                       workflow_name=workflow_name)
 
-        img_url = f"{COMFYUI_HOST}/view?filename={input_image_path}&subfolder=user_images&type=input"
+        img_url = f"{input_image_backend(input_image_path).url}/view?filename={input_image_path}&subfolder=user_images&type=input"
 
         background_tasks.add_task(
             run_runway_and_stream,
@@ -627,29 +5401,22 @@ async def generate(
             seed
         )
 
+        # Visible des autres workers avant que le client ne s'abonne
+        await shared_state.flush()
         return {"status": "processing_started", "prompt_id": prompt_id}
 
     # -----------------------------------------------------------------
     # COMFYUI NORMAL WORKFLOW
     # -----------------------------------------------------------------
 
-    if workflow_name == "sdxl_simple_example.json" or "sdxl" in workflow_name.lower():
-        if base_end_step is None:
-            base_end_step = 18.0
-        if refiner_start_step is None:
-            refiner_start_step = 18.0
-        if refiner_end_step is None:
-            refiner_end_step = 30.0
-
-    base = load_workflow_json(workflow_name)
-    workflow = apply_placeholders(base, {
+    template = get_workflow_template(workflow_name)
+    workflow = template.render(placeholder_values(workflow_name, {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
         "width": width,
         "height": height,
         "steps": steps,
         "cfg_scale": cfg_scale,
-        "cfg": cfg_scale,
         "sampler": sampler,
         "seed": seed,
         "checkpoint": checkpoint,
@@ -667,18 +5434,150 @@ async def generate(
 
         "sdxl_mode": sdxl_mode,
         "sdxl_quality": sdxl_quality
-    })
+    }))
 
-    prompt_id, client_id = queue_prompt(workflow)
+    # Soumission différée : l'ordonnanceur envoie le job à ComfyUI quand un slot se libère
+    prompt_id = str(uuid.uuid4())
+    if variant:
+        output_variants[prompt_id] = variant
+    try:
+        done = submit_generation(prompt_id, get_user_key(request), priority, workflow, input_image_path, cacheable,
+                                 workflow_name)
+    except HTTPException:
+        output_variants.pop(prompt_id, None)
+        raise
 
-    background_tasks.add_task(
-        run_prompt_and_stream,
-        prompt_id=prompt_id,
-        client_id=client_id,
-        prompt_workflow=workflow
-    )
+    await shared_state.flush()
+    return {
+        "status": "processing_started",
+        "prompt_id": prompt_id,
+        "queue_position": scheduler.position(prompt_id),
+        "cached": done is None,
+    }
+
+
+@app.get("/affiche/random")
+async def affiche_random(request: Request):
+    # Affiche pré-générée : servie comme un job déjà terminé (/result, /jobs, variantes…)
+    entry = await asyncio.get_event_loop().run_in_executor(None, affiche_pool.claim)
+    if entry is None:
+        affiche_pool.misses += 1
+        raise HTTPException(status_code=404, detail="Aucune affiche pré-générée disponible.")
+    affiche_pool.served += 1
+
+    prompt_id = str(uuid.uuid4())
+    msg = build_output_message(prompt_id, {"filename": entry["filename"]}, "image", source="local")
+    if entry.get("generation"):
+        msg["generation"] = entry["generation"]
+    journal.record(prompt_id, "cached", kind="affiche", user=get_user_key(request), workflow_name=AFFICHE_WORKFLOW)
+    publish_result(prompt_id, msg)
+    progress_hub.end(prompt_id)
+    await shared_state.flush()
+    return {
+        "status": "completed",
+        "prompt_id": prompt_id,
+        "params": entry["params"],
+        "prompt": entry["prompt"],
+        "result": msg,
+    }
+
+
+@app.post("/generate/batch")
+async def generate_batch(req: BatchRequest, request: Request):
+    if req.priority not in JOB_PRIORITIES:
+        raise HTTPException(400, f"Priorité inconnue: {req.priority}")
+    if req.workflow_name == "runwayml_i2v_gen4.json":
+        raise HTTPException(400, "Le workflow Runway n'est pas disponible en lot")
+
+    template = get_workflow_template(req.workflow_name)
+    base = req.params.dict()
+    sweep = req.sweep
+    if sweep.seeds:
+        cacheable = all(seed >= 0 for seed in sweep.seeds)
+    elif sweep.seed_count:
+        cacheable = sweep.seed_start is not None and sweep.seed_start >= 0
+    else:
+        cacheable = base["seed"] >= 0
+    if base["seed"] < 0:
+        base["seed"] = random.randint(0, 2**32 - 1)
+    base_values = placeholder_values(req.workflow_name, dict(base, duration=None, ratio=None))
+
+    executions, items = expand_batch(req, template, base_values)
+    batch = BatchRun(str(uuid.uuid4()), get_user_key(request), req.priority, template, base_values,
+                     executions, items, req.params.input_image_path)
+    batch.cacheable = cacheable
+
+    # Vérification immédiate sur la première variation (template, checkpoints)
+    checkpoints = workflow_checkpoints(batch.render(executions[0]))
+    if not backend_pool.supports(checkpoints):
+        raise HTTPException(400, f"Aucun backend ComfyUI ne possède: {', '.join(checkpoints)}")
+
+    prune_batch_runs()
+    batch_runs[batch.batch_id] = batch
+    batch.task = asyncio.create_task(run_batch(batch))
+
+    return {
+        "status": "processing_started",
+        "batch_id": batch.batch_id,
+        "total": len(items),
+        "executions": len(executions),
+    }
 
-    return {"status": "processing_started", "prompt_id": prompt_id}
+
+@app.get("/batch/{batch_id}")
+def get_batch(batch_id: str, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    batch = batch_runs.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Lot introuvable.")
+    return dict(batch.summary(), items=batch.items[offset:offset + limit], offset=offset)
+
+
+@app.websocket("/ws/batch/{batch_id}")
+async def websocket_batch(ws: WebSocket, batch_id: str):
+    await ws.accept()
+    batch = batch_runs.get(batch_id)
+    if batch is None:
+        await ws.send_json({"type": "error", "batch_id": batch_id, "detail": "Lot introuvable."})
+        await ws.close()
+        return
+
+    # Rattrapage : items déjà terminés, puis l'avancement global. Mis en file dans la même étape que
+    # l'abonnement : aucun item ne peut se terminer entre les deux
+    sub = batch.subscriber()
+    for item in batch.items:
+        if item["state"] in ("done", "failed"):
+            sub.offer(dict(item, type="batch_item", batch_id=batch_id))
+    if batch.finished_at is not None:
+        sub.offer(dict(batch.summary(), type="batch_done"))
+        sub.offer(None)
+    else:
+        sub.offer(batch.summary())
+        batch.subscribers.append(sub)
+
+    async def pump():
+        # Seul ce coroutine écrit sur la socket : un client lent ne retarde ni le lot ni les autres
+        while True:
+            msg = await sub.get()
+            if msg is None:
+                return
+            await ws.send_json(msg)
+
+    async def drain():
+        while True:
+            await ws.receive_text()
+
+    tasks = [asyncio.create_task(pump()), asyncio.create_task(drain())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if sub in batch.subscribers:
+            batch.subscribers.remove(sub)
+        try:
+            await ws.close()
+        except:
+            pass
 
 # ---------------------------------------------------------------------
 # START SERVER
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Traitements d'image exécutés dans le pool de processus du bridge (get_image_pool dans bridge_api.py).
+# Aucun effet de bord à l'import : les process du pool ne chargent que ce module, jamais bridge_api
+# (ni ses verrous de worker, ni sa configuration).
+import io
+import os
+import json
+import uuid
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps, PngImagePlugin
+except ImportError:
+    Image = None
+
+
+def downscale_image(src: str, dst: str, width: int, height: int) -> bool:
+    # Exécuté dans le pool de processus. Réduit l'image pour couvrir width x height (jamais d'agrandissement).
+    with Image.open(src) as im:
+        fmt = im.format or "PNG"
+        im = ImageOps.exif_transpose(im)
+        scale = max(width / im.width, height / im.height)
+        if scale >= 1:
+            return False
+        out = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), Image.LANCZOS)
+        options = {}
+        if fmt == "JPEG":
+            out = out.convert("RGB")
+            options["quality"] = 92
+        tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+        out.save(tmp, format=fmt, **options)
+        os.replace(tmp, dst)
+    return True
+
+
+def make_gallery_variants(src: str, out_dir: str, key: str, widths, formats) -> dict:
+    # Exécuté dans le pool de processus : image ouverte une fois, une variante par (largeur, format)
+    options = {"webp": {"quality": 82, "method": 4}, "avif": {"quality": 60}, "jpeg": {"quality": 85}}
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        width, height = im.size
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if im.mode in ("LA", "P", "PA") else "RGB")
+        variants = []
+        for target in sorted(widths):
+            w = min(target, width)
+            if any(v["width"] == w for v in variants):
+                break  # pas d'agrandissement
+            h = max(1, round(height * w / width))
+            resized = im.resize((w, h), Image.LANCZOS) if w < width else im
+            for fmt in formats:
+                name = f"{key}_{w}.{'jpg' if fmt == 'jpeg' else fmt}"
+                path = os.path.join(out_dir, name)
+                if not os.path.isfile(path):
+                    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+                    (resized.convert("RGB") if fmt == "jpeg" else resized).save(tmp, format=fmt.upper(), **options[fmt])
+                    os.replace(tmp, path)
+                variants.append({"width": w, "height": h, "format": fmt, "file": name, "bytes": os.path.getsize(path)})
+    return {"width": width, "height": height, "variants": variants}
+
+
+def render_variant(src, dst: str, fmt: str, quality: int, width: int, generation: Optional[dict]) -> dict:
+    # Exécuté dans le pool de processus. src : chemin ou octets de la sortie ; jamais d'agrandissement.
+    # Sans generation, les métadonnées d'origine (workflow ComfyUI, EXIF) ne sont pas recopiées.
+    with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as im:
+        im = ImageOps.exif_transpose(im)
+        if width and width < im.width:
+            im = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if im.mode in ("LA", "P", "PA") else "RGB")
+        if fmt == "jpeg":
+            im = im.convert("RGB")
+
+        options = {"quality": quality} if quality else {}
+        if fmt == "webp":
+            options["method"] = 4
+        if fmt == "png":
+            options["optimize"] = True
+            if generation:
+                info = PngImagePlugin.PngInfo()
+                info.add_text("Software", "ComfyUI bridge")
+                if generation.get("prompt"):
+                    info.add_itxt("Description", generation["prompt"])
+                info.add_itxt("Comment", json.dumps(generation, ensure_ascii=False))
+                options["pnginfo"] = info
+        elif generation:
+            # EXIF ASCII : JSON échappé, sans perte sur les accents
+            exif = Image.Exif()
+            exif[0x0131] = "ComfyUI bridge"
+            exif[0x010E] = json.dumps(generation)
+            options["exif"] = exif.tobytes()
+
+        tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+        im.save(tmp, format=fmt.upper(), **options)
+        os.replace(tmp, dst)
+        return {"width": im.width, "height": im.height, "bytes": os.path.getsize(dst)}
+
+
+def render_preview(data: bytes, max_size: int, quality: int) -> bytes:
+    # Exécuté dans le pool de processus : preview réduite (jamais agrandie) et réencodée en JPEG
+    with Image.open(io.BytesIO(data)) as im:
+        im.thumbnail((max_size, max_size))
+        out = io.BytesIO()
+        im.convert("RGB").save(out, format="JPEG", quality=quality)
+    return out.getvalue()
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# Faux serveur ComfyUI pour les tests locaux et les benchmarks du bridge.
+#
+#   python fake_comfyui.py --port 8188 --job-duration 2 --steps 20
+#
+import os
+import json
+import uuid
+import zlib
+import time
+import random
+import struct
+import asyncio
+import argparse
+from typing import Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
+from fastapi.responses import Response, JSONResponse
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+
+CONFIG = {
+    "latency": float(os.environ.get("FAKE_COMFY_LATENCY", "0")),
+    "job_duration": float(os.environ.get("FAKE_COMFY_JOB_DURATION", "1.0")),
+    "steps": int(os.environ.get("FAKE_COMFY_STEPS", "10")),
+    "failure_rate": float(os.environ.get("FAKE_COMFY_FAILURE_RATE", "0")),
+    # Part des POST /prompt refusés (500), comme un ComfyUI saturé
+    "reject_rate": float(os.environ.get("FAKE_COMFY_REJECT_RATE", "0")),
+    # Frame binaire de preview tous les N steps (0 = aucune) et sa taille en pixels
+    "preview_every": int(os.environ.get("FAKE_COMFY_PREVIEW_EVERY", "5")),
+    "preview_size": int(os.environ.get("FAKE_COMFY_PREVIEW_SIZE", "8")),
+    "parallel": int(os.environ.get("FAKE_COMFY_PARALLEL", "1")),
+    "image_size": int(os.environ.get("FAKE_COMFY_IMAGE_SIZE", "64")),
+    "checkpoints": os.environ.get(
+        "FAKE_COMFY_CHECKPOINTS",
+        "v1-5-pruned-emaonly-fp16.safetensors,sd_xl_base_1.0.safetensors,sd_xl_refiner_1.0.safetensors"
+    ).split(","),
+}
+
+SAMPLERS = ["euler", "euler_ancestral", "heun", "dpm_2", "dpmpp_2m", "dpmpp_sde", "ddim", "uni_pc"]
+SCHEDULERS = ["normal", "karras", "exponential", "simple", "sgm_uniform"]
+
+# ---------------------------------------------------------------------
+# ÉTAT
+# ---------------------------------------------------------------------
+
+app = FastAPI(title="Fake ComfyUI")
+
+clients: Dict[str, WebSocket] = {}
+history: Dict[str, dict] = {}
+pending: List[dict] = []
+running: Dict[str, dict] = {}
+uploads: Dict[str, bytes] = {}
+images: Dict[str, bytes] = {}
+interrupted: set = set()
+job_queue: "asyncio.Queue[dict]" = None
+counter = {"number": 0}
+
+
+def make_png(size: int, seed: int) -> bytes:
+    # PNG RGB minimal, sans dépendance (Pillow non requis)
+    rnd = random.Random(seed)
+    color = bytes([rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)])
+    raw = b"".join(b"\x00" + color * size for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+
+def object_info() -> dict:
+    def node(required, output=("",)):
+        return {"input": {"required": required, "optional": {}}, "output": list(output),
+                "output_node": False, "category": "fake"}
+
+    return {
+        "CheckpointLoaderSimple": node({"ckpt_name": [CONFIG["checkpoints"]]}, ("MODEL", "CLIP", "VAE")),
+        "EmptyLatentImage": node({
+            "width": ["INT", {"default": 512, "min": 16, "max": 16384, "step": 8}],
+            "height": ["INT", {"default": 512, "min": 16, "max": 16384, "step": 8}],
+            "batch_size": ["INT", {"default": 1, "min": 1, "max": 4096}],
+        }, ("LATENT",)),
+        "CLIPTextEncode": node({"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}, ("CONDITIONING",)),
+        "KSampler": node({
+            "model": ["MODEL"],
+            "seed": ["INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}],
+            "steps": ["INT", {"default": 20, "min": 1, "max": 10000}],
+            "cfg": ["FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}],
+            "sampler_name": [SAMPLERS],
+            "scheduler": [SCHEDULERS],
+            "positive": ["CONDITIONING"],
+            "negative": ["CONDITIONING"],
+            "latent_image": ["LATENT"],
+            "denoise": ["FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0}],
+        }, ("LATENT",)),
+        "KSamplerAdvanced": node({
+            "model": ["MODEL"],
+            "add_noise": [["enable", "disable"]],
+            "noise_seed": ["INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}],
+            "steps": ["INT", {"default": 20, "min": 1, "max": 10000}],
+            "cfg": ["FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0}],
+            "sampler_name": [SAMPLERS],
+            "scheduler": [SCHEDULERS],
+            "positive": ["CONDITIONING"],
+            "negative": ["CONDITIONING"],
+            "latent_image": ["LATENT"],
+            "start_at_step": ["INT", {"default": 0, "min": 0, "max": 10000}],
+            "end_at_step": ["INT", {"default": 10000, "min": 0, "max": 10000}],
+            "return_with_leftover_noise": [["disable", "enable"]],
+        }, ("LATENT",)),
+        "VAEDecode": node({"samples": ["LATENT"], "vae": ["VAE"]}, ("IMAGE",)),
+        "VAELoader": node({"vae_name": [["sdxl_vae.safetensors", "vae-ft-mse-840000.safetensors"]]}, ("VAE",)),
+        "LoadImage": node({"image": [sorted(uploads) or ["example.png"], {"image_upload": True}]}, ("IMAGE", "MASK")),
+        "SaveImage": dict(node({"images": ["IMAGE"], "filename_prefix": ["STRING", {"default": "ComfyUI"}]}, ()),
+                          output_node=True),
+        "PreviewImage": dict(node({"images": ["IMAGE"]}, ()), output_node=True),
+    }
+
+
+async def sleep_latency():
+    if CONFIG["latency"] > 0:
+        await asyncio.sleep(CONFIG["latency"])
+
+
+async def send(client_id: str, msg):
+    ws = clients.get(client_id)
+    if ws is None:
+        return
+    try:
+        if isinstance(msg, (bytes, bytearray)):
+            await ws.send_bytes(msg)
+        else:
+            await ws.send_text(json.dumps(msg))
+    except Exception:
+        clients.pop(client_id, None)
+
+
+async def broadcast_status():
+    msg = {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": len(pending) + len(running)}}}}
+    for cid in list(clients):
+        await send(cid, msg)
+
+# ---------------------------------------------------------------------
+# EXÉCUTION DES JOBS
+# ---------------------------------------------------------------------
+
+async def execute(job: dict):
+    prompt_id, client_id, graph = job["prompt_id"], job["client_id"], job["prompt"]
+    running[prompt_id] = job
+    await broadcast_status()
+    await send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}})
+
+    nodes = list(graph.keys())
+    samplers = [nid for nid in nodes if "KSampler" in str(graph[nid].get("class_type", ""))] or nodes[:1]
+    steps = CONFIG["steps"]
+    step_time = CONFIG["job_duration"] / max(1, steps * len(samplers))
+    outputs = {}
+    seed = 0
+
+    try:
+        for nid in nodes:
+            if prompt_id in interrupted:
+                raise InterruptedError()
+            await send(client_id, {"type": "executing", "data": {"node": nid, "display_node": nid, "prompt_id": prompt_id}})
+            inputs = graph[nid].get("inputs", {})
+            seed = inputs.get("seed", inputs.get("noise_seed", seed))
+            if nid in samplers:
+                for step in range(1, steps + 1):
+                    if prompt_id in interrupted:
+                        raise InterruptedError()
+                    await asyncio.sleep(step_time)
+                    await send(client_id, {"type": "progress", "data": {
+                        "value": step, "max": steps, "prompt_id": prompt_id, "node": nid}})
+                    # Frame binaire de preview (type 1 = PREVIEW_IMAGE, 2 = PNG)
+                    if CONFIG["preview_every"] and step % CONFIG["preview_every"] == 0:
+                        await send(client_id, struct.pack(">II", 1, 2) + make_png(CONFIG["preview_size"], step))
+            if graph[nid].get("class_type") == "SaveImage":
+                if random.random() < CONFIG["failure_rate"]:
+                    raise RuntimeError("Fake ComfyUI: échec simulé")
+                batch = 1
+                for other in graph.values():
+                    if other.get("class_type") == "EmptyLatentImage":
+                        batch = int(other.get("inputs", {}).get("batch_size", 1) or 1)
+                imgs = []
+                for i in range(batch):
+                    fname = f"ComfyUI_{counter['number']:05d}_{i}_.png"
+                    images[fname] = make_png(CONFIG["image_size"], hash((seed, i)) & 0xFFFFFFFF)
+                    imgs.append({"filename": fname, "subfolder": "", "type": "output"})
+                outputs[nid] = {"images": imgs}
+                await send(client_id, {"type": "executed", "data": {"node": nid, "output": outputs[nid], "prompt_id": prompt_id}})
+
+        history[prompt_id] = {"prompt": [job["number"], prompt_id, graph, {}, []], "outputs": outputs,
+                              "status": {"status_str": "success", "completed": True, "messages": []}}
+        await send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+        await send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+
+    except InterruptedError:
+        history[prompt_id] = {"prompt": [job["number"], prompt_id, graph, {}, []], "outputs": {},
+                              "status": {"status_str": "error", "completed": False, "messages": []}}
+        await send(client_id, {"type": "execution_interrupted", "data": {"prompt_id": prompt_id}})
+    except Exception as e:
+        history[prompt_id] = {"prompt": [job["number"], prompt_id, graph, {}, []], "outputs": {},
+                              "status": {"status_str": "error", "completed": False, "messages": []}}
+        await send(client_id, {"type": "execution_error", "data": {
+            "prompt_id": prompt_id, "exception_message": str(e), "node_id": nid}})
+    finally:
+        running.pop(prompt_id, None)
+        interrupted.discard(prompt_id)
+        await broadcast_status()
+
+
+async def worker():
+    while True:
+        job = await job_queue.get()
+        if job in pending:
+            pending.remove(job)
+        else:
+            continue  # supprimé de la file
+        await execute(job)
+
+
+@app.on_event("startup")
+async def startup():
+    global job_queue
+    job_queue = asyncio.Queue()
+    for _ in range(CONFIG["parallel"]):
+        asyncio.create_task(worker())
+
+# ---------------------------------------------------------------------
+# ROUTES
+# ---------------------------------------------------------------------
+
+@app.post("/prompt")
+async def post_prompt(request: Request):
+    await sleep_latency()
+    body = await request.json()
+    graph = body.get("prompt")
+    if not isinstance(graph, dict) or not graph:
+        return JSONResponse({"error": {"type": "invalid_prompt", "message": "Invalid prompt",
+                                       "details": "prompt manquant"}, "node_errors": {}}, status_code=400)
+    for nid, node in graph.items():
+        if node.get("class_type") not in object_info():
+            return JSONResponse({"error": {"type": "invalid_prompt", "message": "Cannot execute because node "
+                                           f"{node.get('class_type')} does not exist.", "details": f"Node ID '#{nid}'"},
+                                 "node_errors": {}}, status_code=400)
+    if random.random() < CONFIG["reject_rate"]:
+        return JSONResponse({"error": {"type": "server_error", "message": "Fake ComfyUI: refus simulé",
+                                       "details": ""}, "node_errors": {}}, status_code=500)
+    prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+    counter["number"] += 1
+    job = {"prompt_id": prompt_id, "client_id": body.get("client_id", ""), "prompt": graph, "number": counter["number"]}
+    pending.append(job)
+    job_queue.put_nowait(job)
+    await broadcast_status()
+    return {"prompt_id": prompt_id, "number": job["number"], "node_errors": {}}
+
+
+@app.get("/history/{prompt_id}")
+async def get_history(prompt_id: str):
+    await sleep_latency()
+    return {prompt_id: history[prompt_id]} if prompt_id in history else {}
+
+
+@app.get("/history")
+async def get_all_history(max_items: int = 200):
+    return dict(list(history.items())[-max_items:])
+
+
+@app.get("/queue")
+async def get_queue():
+    def entry(job):
+        return [job["number"], job["prompt_id"], job["prompt"], {"client_id": job["client_id"]}, []]
+    return {"queue_running": [entry(j) for j in running.values()], "queue_pending": [entry(j) for j in pending]}
+
+
+@app.post("/queue")
+async def post_queue(request: Request):
+    body = await request.json()
+    if body.get("clear"):
+        pending.clear()
+    for pid in body.get("delete", []):
+        for job in list(pending):
+            if job["prompt_id"] == pid:
+                pending.remove(job)
+    return {}
+
+
+@app.post("/interrupt")
+async def interrupt(request: Request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    targets = [body["prompt_id"]] if body.get("prompt_id") else list(running)
+    interrupted.update(targets)
+    return {}
+
+
+@app.get("/view")
+async def view(filename: str, subfolder: str = "", type: str = "output"):
+    await sleep_latency()
+    data = images.get(filename) if type == "output" else uploads.get(filename)
+    if data is None:
+        raise HTTPException(404)
+    return Response(data, media_type="image/png")
+
+
+@app.post("/upload/image")
+async def upload_image(image: UploadFile = File(...), subfolder: str = Form(""), type: str = Form("input")):
+    await sleep_latency()
+    uploads[image.filename] = await image.read()
+    return {"name": image.filename, "subfolder": subfolder, "type": type}
+
+
+@app.get("/object_info")
+async def get_object_info():
+    await sleep_latency()
+    return object_info()
+
+
+@app.get("/object_info/{node_class}")
+async def get_object_info_node(node_class: str):
+    await sleep_latency()
+    info = object_info()
+    return {node_class: info[node_class]} if node_class in info else {}
+
+
+@app.get("/system_stats")
+async def system_stats():
+    return {"system": {"os": "fake", "comfyui_version": "fake"}, "devices": [
+        {"name": "Fake GPU", "type": "cuda", "vram_total": 8 << 30, "vram_free": 6 << 30}]}
+
+
+@app.websocket("/ws")
+async def ws_endpoint(ws: WebSocket, clientId: str = ""):
+    await ws.accept()
+    client_id = clientId or uuid.uuid4().hex
+    clients[client_id] = ws
+    await send(client_id, {"type": "status", "data": {"sid": client_id, "status": {
+        "exec_info": {"queue_remaining": len(pending) + len(running)}}}})
+    try:
+        while True:
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if clients.get(client_id) is ws:
+            clients.pop(client_id, None)
+
+# ---------------------------------------------------------------------
+# START SERVER
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Faux serveur ComfyUI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"], help="latence HTTP ajoutée (s)")
+    parser.add_argument("--job-duration", type=float, default=CONFIG["job_duration"], help="durée d'un job (s)")
+    parser.add_argument("--steps", type=int, default=CONFIG["steps"])
+    parser.add_argument("--failure-rate", type=float, default=CONFIG["failure_rate"])
+    parser.add_argument("--parallel", type=int, default=CONFIG["parallel"], help="jobs exécutés en parallèle")
+    parser.add_argument("--image-size", type=int, default=CONFIG["image_size"])
+    parser.add_argument("--reject-rate", type=float, default=CONFIG["reject_rate"], help="part des /prompt refusés (500)")
+    parser.add_argument("--preview-every", type=int, default=CONFIG["preview_every"], help="preview binaire tous les N steps")
+    parser.add_argument("--preview-size", type=int, default=CONFIG["preview_size"])
+    args = parser.parse_args()
+    CONFIG.update(latency=args.latency, job_duration=args.job_duration, steps=args.steps,
+                  failure_rate=args.failure_rate, parallel=args.parallel, image_size=args.image_size,
+                  reject_rate=args.reject_rate, preview_every=args.preview_every, preview_size=args.preview_size)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Faux serveur RunwayML (image -> vidéo) pour tester le bridge sans clé ni crédits.
+#
+#   python fake_runway.py --port 8190 --task-duration 3
+#   RUNWAY_API_BASE=http://127.0.0.1:8190/v1 uvicorn bridge_api:app
+#
+# Cycle d'une tâche : PENDING -> (THROTTLED) -> RUNNING (progress 0..1) -> SUCCEEDED / FAILED.
+# Un promptText contenant FAIL_MARKER échoue à coup sûr (tests de la gestion des FAILED).
+import os
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from typing import Dict
+
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, Response
+
+# ---------------------------------------------------------------------
+# CONFIG
+# ---------------------------------------------------------------------
+
+CONFIG = {
+    "latency": float(os.environ.get("FAKE_RUNWAY_LATENCY", "0")),
+    "pending_duration": float(os.environ.get("FAKE_RUNWAY_PENDING", "0.5")),
+    "task_duration": float(os.environ.get("FAKE_RUNWAY_TASK_DURATION", "3")),
+    "failure_rate": float(os.environ.get("FAKE_RUNWAY_FAILURE_RATE", "0")),
+    # Tâches RUNNING simultanées par clé ; au-delà : THROTTLED
+    "concurrency": int(os.environ.get("FAKE_RUNWAY_CONCURRENCY", "2")),
+    # Taille de la vidéo renvoyée, servie par morceaux
+    "video_size": int(os.environ.get("FAKE_RUNWAY_VIDEO_SIZE", str(2 * 1024 * 1024))),
+    "chunk_size": 64 * 1024,
+}
+
+FAIL_MARKER = "[fake:fail]"
+
+# ---------------------------------------------------------------------
+# ÉTAT
+# ---------------------------------------------------------------------
+
+app = FastAPI(title="Fake RunwayML")
+
+tasks: Dict[str, dict] = {}
+stats = {"created": 0, "polls": 0, "downloads": 0, "max_running_per_key": 0}
+
+
+async def sleep_latency():
+    if CONFIG["latency"]:
+        await asyncio.sleep(CONFIG["latency"])
+
+
+def api_key(request: Request) -> str:
+    auth = request.headers.get("authorization", "")
+    if not auth.startswith("Bearer ") or len(auth) <= 7:
+        raise HTTPException(status_code=401, detail="Missing API key")
+    return auth[7:]
+
+
+def running_for(key: str) -> int:
+    return sum(1 for t in tasks.values() if t["key"] == key and t["status"] == "RUNNING")
+
+
+async def run_task(task: dict):
+    await asyncio.sleep(CONFIG["pending_duration"])
+    while running_for(task["key"]) >= CONFIG["concurrency"]:
+        task["status"] = "THROTTLED"
+        await asyncio.sleep(0.2)
+        if task["status"] == "CANCELLED":
+            return
+    if task["status"] == "CANCELLED":
+        return
+
+    task["status"] = "RUNNING"
+    task["progress"] = 0.0
+    stats["max_running_per_key"] = max(stats["max_running_per_key"], running_for(task["key"]))
+    steps = 10
+    fail_at = random.randint(1, steps) if random.random() < CONFIG["failure_rate"] else None
+    if FAIL_MARKER in (task["request"].get("promptText") or ""):
+        fail_at = steps // 2
+    for i in range(1, steps + 1):
+        await asyncio.sleep(CONFIG["task_duration"] / steps)
+        if task["status"] == "CANCELLED":
+            return
+        if i == fail_at:
+            task["status"] = "FAILED"
+            task["failure"] = "Simulated generation failure"
+            task["failureCode"] = "INTERNAL.FAKE"
+            return
+        task["progress"] = round(i / steps, 2)
+
+    task["status"] = "SUCCEEDED"
+    task["output"] = [f"{task['base_url']}files/{task['id']}.mp4"]
+
+# ---------------------------------------------------------------------
+# ROUTES
+# ---------------------------------------------------------------------
+
+@app.post("/v1/images-to-video")
+@app.post("/v1/image_to_video")
+async def image_to_video(request: Request):
+    await sleep_latency()
+    key = api_key(request)
+    body = await request.json()
+    if not body.get("promptImage"):
+        raise HTTPException(status_code=400, detail="promptImage is required")
+
+    task_id = str(uuid.uuid4())
+    task = {
+        "id": task_id,
+        "key": key,
+        "status": "PENDING",
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "base_url": str(request.base_url),
+        "request": body,
+    }
+    tasks[task_id] = task
+    stats["created"] += 1
+    asyncio.create_task(run_task(task))
+    return {"id": task_id}
+
+
+@app.get("/v1/tasks/{task_id}")
+async def get_task(task_id: str, request: Request):
+    await sleep_latency()
+    api_key(request)
+    stats["polls"] += 1
+    task = tasks.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return {k: v for k, v in task.items() if k not in ("key", "base_url", "request")}
+
+
+@app.delete("/v1/tasks/{task_id}")
+async def cancel_task(task_id: str, request: Request):
+    await sleep_latency()
+    api_key(request)
+    task = tasks.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task["status"] not in ("SUCCEEDED", "FAILED"):
+        task["status"] = "CANCELLED"
+    return Response(status_code=204)
+
+
+@app.get("/files/{task_id}.mp4")
+async def download(task_id: str):
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail="File not found")
+    stats["downloads"] += 1
+    size, chunk = CONFIG["video_size"], CONFIG["chunk_size"]
+    header = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+
+    async def body():
+        sent = 0
+        while sent < size:
+            n = min(chunk, size - sent)
+            data = (header if sent == 0 else b"") + b"\x00" * n
+            yield data[:n]
+            sent += n
+            await asyncio.sleep(0)
+
+    return StreamingResponse(body(), media_type="video/mp4", headers={"Content-Length": str(size)})
+
+
+@app.get("/stats")
+async def get_stats():
+    return dict(stats, tasks=len(tasks))
+
+# ---------------------------------------------------------------------
+# START SERVER
+# ---------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Faux serveur RunwayML")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8190)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"], help="latence HTTP ajoutée (s)")
+    parser.add_argument("--pending-duration", type=float, default=CONFIG["pending_duration"])
+    parser.add_argument("--task-duration", type=float, default=CONFIG["task_duration"], help="durée d'une tâche RUNNING (s)")
+    parser.add_argument("--failure-rate", type=float, default=CONFIG["failure_rate"])
+    parser.add_argument("--concurrency", type=int, default=CONFIG["concurrency"], help="tâches RUNNING simultanées par clé")
+    parser.add_argument("--video-size", type=int, default=CONFIG["video_size"])
+    args = parser.parse_args()
+    CONFIG.update(latency=args.latency, pending_duration=args.pending_duration, task_duration=args.task_duration,
+                  failure_rate=args.failure_rate, concurrency=args.concurrency, video_size=args.video_size)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
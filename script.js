@@ -115,6 +115,9 @@ function inferFormatFromSize(w, h) {
 async function loadCarrouselGallery() {
   console.log("🟢 loadCarrouselGallery START");
 
+  // Index du bridge (vignettes + variantes WebP/AVIF) ; repli sur carrousel.json
+  if (await loadIndexedGallery()) return;
+
   let images;
   try {
     const resp = await fetch("/carrousel.json", { cache: "no-store" });
@@ -160,6 +163,50 @@ async function loadCarrouselGallery() {
   console.log("✅ gallery populated:", images.length);
 }
 
+async function loadIndexedGallery() {
+  const gallery = document.getElementById("gallery-grid");
+  if (!gallery) return false;
+
+  let data;
+  try {
+    const resp = await fetch(`${API_BASE_URL}/gallery?source=carrousel&per_page=200`);
+    if (!resp.ok) throw new Error("HTTP " + resp.status);
+    data = await resp.json();
+  } catch (e) {
+    console.warn("⚠️ /gallery indisponible, repli sur carrousel.json", e);
+    return false;
+  }
+  if (!data.items || !data.items.length) return false;
+
+  gallery.innerHTML = "";
+
+  data.items.forEach((item) => {
+    // Le modal sert aussi au téléchargement : on garde l'original
+    const fullPath = `${API_BASE_URL}${item.original}`;
+    const variants = (item.variants && (item.variants.webp || item.variants.jpeg)) || [];
+
+    const thumb = document.createElement("img");
+    thumb.src = item.thumb ? `${API_BASE_URL}${item.thumb}` : `${API_BASE_URL}${item.original}`;
+    if (variants.length > 1) {
+      thumb.srcset = variants.map((v) => `${API_BASE_URL}${v.url} ${v.width}w`).join(", ");
+      thumb.sizes = "(max-width: 600px) 50vw, 320px";
+    }
+    thumb.className = "gallery-thumb";
+    thumb.loading = "lazy";
+    thumb.decoding = "async";
+    thumb.alt = item.name;
+
+    thumb.addEventListener("click", () => {
+      openImageModal(fullPath, item.name);
+    });
+
+    gallery.appendChild(thumb);
+  });
+
+  console.log("✅ gallery populated (index):", data.items.length);
+  return true;
+}
+
 // =========================================================
 // 🆕 LISTE DES STYLES DE TITRE
 // =========================================================
@@ -253,8 +300,24 @@ const MAX_POLLING_FAILURES = 5;
 // VARIABLES GLOBALES
 // =========================================================
 let currentPromptId = null;
+// Catalogue des workflows (placeholders, nœuds détectés, vignette) renvoyé par /workflows
+let workflowCatalog = {};
 let lastGenerationStartTime = null;
 
+// Onglet fermé pendant une génération : le job est annulé côté serveur (libère le GPU)
+window.addEventListener("pagehide", () => {
+  if (!pollingProgressInterval || !currentPromptId) return;
+  try {
+    fetch(`${API_BASE_URL}/jobs/${currentPromptId}`, {
+      method: "DELETE",
+      headers: { ...authHeaders() },
+      keepalive: true
+    });
+  } catch (e) {
+    // Token expiré : le job sera récupéré par la politique des jobs abandonnés
+  }
+});
+
 // =========================================================
 // OUTILS D’AFFICHAGE (LOGS, ERREURS, PROGRESSION VISUELLE)
 // =========================================================
@@ -364,6 +427,8 @@ async function loadWorkflows() {
     const data = await resp.json();
 
     const workflows = data.workflows || [];
+    workflowCatalog = {};
+    (data.items || []).forEach(item => { workflowCatalog[item.name] = item; });
     log("Workflows reçus:", JSON.stringify(workflows));
 
     container.innerHTML = "";
@@ -391,13 +456,14 @@ async function loadWorkflows() {
 
       groupWfs.forEach(wf => {
         const base = wf.replace(/\.json$/,"");
+        const thumb = workflowCatalog[wf]?.thumbnail || `vignettes/${base}.png`;
         const v = document.createElement("div");
         v.className = "workflow-vignette";
         v.dataset.workflowName = wf;
 
         v.innerHTML = `
           <div class="workflow-thumb-wrapper">
-            <img class="workflow-thumb" src="./vignettes/${base}.png" onerror="this.src='./vignettes/default.png'">
+            <img class="workflow-thumb" src="./${thumb}" onerror="this.src='./vignettes/default.png'">
           </div>
           <div class="vignette-label-only">${base}</div>
         `;
@@ -502,7 +568,9 @@ function selectWorkflow(workflowName) {
     if (groupCfg) groupCfg.style.display = "block";
     if (groupSampler) groupSampler.style.display = "block";
     if (seedSection) seedSection.style.display = "block";
-    if (sdxlPanel) sdxlPanel.style.display = "block";
+    // Panneau SDXL inutile si le catalogue ne détecte ni SDXL ni refiner
+    const meta = workflowCatalog[workflowName];
+    if (sdxlPanel) sdxlPanel.style.display = (!meta || meta.sdxl) ? "block" : "none";
   }
 
   const videoParamsSection = document.getElementById("video-params-section");
@@ -640,12 +708,9 @@ async function pollProgress(promptId) {
     statusPill.classList.add("pill");
   }
 
-  pollingProgressInterval = setInterval(async () => {
-    fakeProgress = Math.min(fakeProgress + 7, 92);
-
-    if (percentSpan) percentSpan.textContent = fakeProgress + "%";
-    if (innerBar) innerBar.style.width = fakeProgress + "%";
+  const labelSpan = document.getElementById("progress-label");
 
+  pollingProgressInterval = setInterval(async () => {
     try {
       const resCheck = await fetch(`${API_BASE_URL}/progress/${promptId}`, { headers: { ...authHeaders() } });
 
@@ -653,6 +718,32 @@ async function pollProgress(promptId) {
         pollingFailureCount = 0;
         const data = await resCheck.json();
 
+        // Pourcentage global et ETA calculés par le bridge ; progression simulée en attendant
+        if (data.progress && typeof data.progress.value === "number") {
+          fakeProgress = Math.max(fakeProgress, Math.min(Math.round(data.progress.value), 99));
+        } else if (data.state !== "queued") {
+          fakeProgress = Math.min(fakeProgress + 7, 92);
+        }
+        if (percentSpan) percentSpan.textContent = fakeProgress + "%";
+        if (innerBar) innerBar.style.width = fakeProgress + "%";
+        if (labelSpan) {
+          if (data.state === "queued") {
+            labelSpan.textContent = data.queue_eta != null
+              ? `En file d'attente (position ${data.queue_position}) – début dans ~${Math.ceil(data.queue_eta)} s`
+              : "En file d'attente…";
+          } else if (data.progress && data.progress.eta != null) {
+            labelSpan.textContent = `Génération en cours… ~${Math.ceil(data.progress.eta)} s restantes`;
+          }
+        }
+
+        if (data.state === "cancelled") {
+          clearInterval(pollingProgressInterval);
+          pollingProgressInterval = null;
+          showProgressOverlay(false);
+          setError((data.result && data.result.detail) || "Génération annulée.");
+          return;
+        }
+
         if (data.status && data.status.completed) {
           clearInterval(pollingProgressInterval);
           pollingProgressInterval = null;
@@ -781,7 +872,10 @@ function openImageModal(src) {
 // =========================================================
 
 function displayImageAndMetadata(data) {
-  const base64 = data.image_base64;
+  // Binaire servi par /result/{id}/file ; image_base64 seulement si demandé (?base64=1)
+  const src = data.image_base64
+    ? `data:${data.mime_type || "image/png"};base64,${data.image_base64}`
+    : `${API_BASE_URL}${data.url}`;
 
   const resultArea = document.getElementById("result-area");
   const placeholder = document.getElementById("result-placeholder");
@@ -793,7 +887,7 @@ function displayImageAndMetadata(data) {
 
   const img = document.createElement("img");
   img.className = "result-image mj-img mj-blur clickable";
-  img.src = `data:image/png;base64,${base64}`;
+  img.src = src;
   img.alt = "Image générée";
   img.style.maxWidth = "100%";
   img.style.height = "auto";
@@ -1192,6 +1286,24 @@ document.addEventListener("DOMContentLoaded", () => {
     randomBtn.addEventListener("click", async () => {
       console.log("🎲 Clic random détecté !");
 
+      // Affiche pré-générée par le serveur pendant les temps morts du GPU : affichée tout de suite
+      if (!pollingProgressInterval) {
+        try {
+          const resp = await fetch(`${API_BASE_URL}/affiche/random`, { headers: { ...authHeaders() } });
+          if (resp.ok) {
+            const ready = await resp.json();
+            fillAfficheFieldsFromRandom(ready.params);
+            generateAffichePrompt();
+            currentPromptId = ready.prompt_id;
+            log("🎲 Affiche pré-générée:", ready.prompt_id);
+            handleCompletion(ready.prompt_id);
+            return;
+          }
+        } catch (e) {
+          console.warn("Pool d'affiches indisponible:", e);
+        }
+      }
+
       const data = await loadRandomAfficheJSON();
       if (!data) return;
 